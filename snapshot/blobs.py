@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from threading import Lock
+from weakref import WeakValueDictionary
+
+import numpy
+
+blob_dir_name = '.snapshot_blobs'
+
+# Arrays loaded from blobs, keyed by content hash. The same array object is
+# shared by all snapshots that reference the blob, for as long as any of them
+# uses it.
+_loaded_blobs = WeakValueDictionary()
+_loaded_blobs_lock = Lock()
+
+
+class BlobStore(object):
+    # Arrays smaller than this (in bytes) are stored in snapshot files.
+    default_min_bytes = 1 << 16
+
+    def __init__(self, save_dir, min_bytes=None):
+        """
+        Content-addressed store of large array values, shared by all save
+        files in a directory. It is the subdirectory .snapshot_blobs of the
+        save directory, with one .npy file per array, named by the hash of
+        its content, and an SQLite database with the number of save files
+        referencing each blob. References are added by store() and removed
+        by release(). A blob is deleted when no save file references it
+        anymore.
+
+        :param save_dir: Path to the directory with save files.
+        :param min_bytes: Only arrays of at least this size are stored as
+                          blobs. If None, default_min_bytes is used.
+
+        :return:
+        """
+        self.path = os.path.join(save_dir, blob_dir_name)
+        self.min_bytes = self.default_min_bytes if min_bytes is None \
+            else min_bytes
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def accepts(self, value):
+        """
+        :return: True if value should be stored as a blob.
+        """
+        return isinstance(value, numpy.ndarray) and value.ndim == 1 \
+            and value.dtype.kind in 'biufU' and value.nbytes >= self.min_bytes
+
+    def store(self, value, refs):
+        """
+        Store the array, unless an equal one is already stored, and add a
+        reference to it for the save file which is being written. The
+        reference is added in the same transaction in which it is checked
+        whether the blob exists, so that release() in another process cannot
+        delete the blob in the meantime.
+
+        :param value: Array, see accepts().
+        :param refs: Set of content hashes which the save file already
+                     references. No reference is added for these, and the
+                     hash of value is added to it.
+
+        :return: Content hash of the array.
+        """
+        value = numpy.ascontiguousarray(value)
+        digest = hashlib.sha256(value.dtype.str.encode('ascii'))
+        digest.update(value.data)
+        digest = digest.hexdigest()
+        if digest in refs:
+            return digest
+
+        path = self._blob_path(digest)
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO refs VALUES (?, 0)',
+                             (digest,))
+                conn.execute('UPDATE refs SET count = count + 1 '
+                             'WHERE digest = ?', (digest,))
+                if not os.path.exists(path):
+                    # Written under a temporary name, so readers never see
+                    # a partial blob.
+                    tmp_path = f"{path}.{os.getpid()}.tmp"
+                    try:
+                        with open(tmp_path, 'wb') as f:
+                            numpy.save(f, value, allow_pickle=False)
+                        os.replace(tmp_path, path)
+                    except OSError:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+                        raise
+        refs.add(digest)
+        return digest
+
+    def load(self, digest):
+        """
+        :param digest: Content hash of the array.
+
+        :return: Read-only array, shared with other users of the same blob,
+                 or None if the blob does not exist.
+        """
+        with _loaded_blobs_lock:
+            value = _loaded_blobs.get(digest)
+        if value is not None:
+            return value
+
+        try:
+            value = numpy.load(self._blob_path(digest), allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        value.flags.writeable = False
+        with _loaded_blobs_lock:
+            # Another thread may have loaded it in the meantime.
+            return _loaded_blobs.setdefault(digest, value)
+
+    def release(self, digests):
+        """
+        Remove one reference from each of the blobs and delete blobs which
+        are not referenced anymore.
+
+        :param digests: Iterable of content hashes.
+
+        :return:
+        """
+        digests = [(digest,) for digest in set(digests)]
+        if not digests:
+            return
+        with closing(self._connect()) as conn:
+            with conn:
+                conn.executemany('UPDATE refs SET count = count - 1 '
+                                 'WHERE digest = ?', digests)
+                unused = [row[0] for row in conn.execute(
+                    'SELECT digest FROM refs WHERE count <= 0')]
+                for digest in unused:
+                    try:
+                        os.remove(self._blob_path(digest))
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        # Keep the entry to try again next time.
+                        logging.warning(f"Cannot remove blob {digest}: {e}")
+                        continue
+                    conn.execute('DELETE FROM refs WHERE digest = ?',
+                                 (digest,))
+
+    def _blob_path(self, digest):
+        return os.path.join(self.path, digest + '.npy')
+
+    def _connect(self):
+        os.makedirs(self.path, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.path, 'refs.sqlite'),
+                               timeout=30)
+        conn.execute('CREATE TABLE IF NOT EXISTS refs ('
+                     'digest TEXT PRIMARY KEY, count INTEGER)')
+        return conn
@@ -5,18 +5,26 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 
+import atexit
 import numpy
 import json
 import os
+import re
 import time
 from enum import Enum
-from collections import OrderedDict
+from functools import partial
+from threading import Condition, Event, Lock, RLock, Thread
+from collections import OrderedDict, deque
 
 from epics import PV, ca, dbr
 
-from snapshot.core import SnapshotPv, PvStatus, background_workers
+from snapshot.core import SnapshotPv, PvStatus, MacroEngine, \
+    background_workers, get_pvs_with_metadata
+from snapshot.blobs import BlobStore
 from snapshot.parser import SnapshotReqFile, parse_macros, \
-    parse_from_save_file, parse_to_save_file
+    parse_from_save_file, parse_to_save_file, \
+    replace_save_file_metadata, SaveFileData, save_file_suffix, \
+    compressed_save_file_suffix, delta_save_data
 
 import logging
 
@@ -28,10 +36,45 @@ ca.AUTO_CLEANUP = True  # For pyepics versions older than 3.2.4, this was set to
                         # closed
 
 
+# Names of PVs that were connected recently, in this process or before
+# (stored in the cache of SnapshotReqFile). Their channels are created first,
+# as they are likely to connect quickly.
+_connected_pv_names = set()
+# Names connected in this process. They are stored in the cache once, when
+# the program exits.
+_new_connected_pv_names = set()
+_pv_names_loaded = False
+_pv_names_lock = Lock()
+
+
+def _load_connected_pv_names():
+    global _pv_names_loaded
+    with _pv_names_lock:
+        if not _pv_names_loaded:
+            cache = SnapshotReqFile.cache
+            if cache is not None:
+                _connected_pv_names.update(cache.get_connected_pvs())
+            _pv_names_loaded = True
+
+
+@atexit.register
+def _store_connected_pv_names():
+    with _pv_names_lock:
+        cache = SnapshotReqFile.cache
+        if _new_connected_pv_names and cache is not None:
+            cache.add_connected_pvs(_new_connected_pv_names.copy())
+        _new_connected_pv_names.clear()
+
+
+def _compare_tolerance(precision):
+    # Same tolerance as in the GUI comparison.
+    return 10**(-precision) if precision is not None and precision > 0 else 1e-6
+
+
 class ActionStatus(Enum):
     """
     Returned by Snapshot methods to indicate their stressfulness. Possible states:
-        busy: Returned by restore_pvs() if previous restore did not finished yet (non-blocking restore).
+        busy: Returned by restore_pvs() if a previous restore of some of the same PVs did not finish yet.
         ok: Action succeeded.
         no_data: Returned by restore_pvs() if no data was provided for restore.
         no_conn: Returned if one of the PVs is not connected and not in force mode.
@@ -45,14 +88,287 @@ class ActionStatus(Enum):
     os_error = 5
 
 
+class RestoreSession(object):
+    def __init__(self, pvnames, callback=None, forced=False, on_done=None, verify=None):
+        """
+        State of one restore started by Snapshot.restore_pvs(). Collects results of put callbacks, which can come
+        from any CA thread, and calls the callback once all PVs are restored.
+
+        :param pvnames: Names of PVs that are restored in this session.
+        :param callback: Called when all PVs are restored as callback(status={'pvname': PvStatus}, forced=forced).
+        :param forced: Was restore forced?
+        :param on_done: Called with the session as the only argument when all PVs are restored, before callback.
+        :param verify: If given, called in a separate thread when all put callbacks arrived, as
+                       verify(status={'pvname': PvStatus}). Must return a dict {'pvname': PvStatus} of statuses to
+                       update.
+
+        :return:
+        """
+        self.pvnames = frozenset(pvnames)
+        self.forced = forced
+        self.pvs_status = dict()
+        self.done = Event()
+
+        self._callback = callback
+        self._on_done = on_done
+        self._verify = verify
+        self._lock = Lock()
+        self._remaining = len(self.pvnames)
+        self._started = False
+
+    def pv_done(self, pvname, status, **kw):
+        """
+        Put callback of a single PV.
+
+        :param pvname: PV name.
+        :param status: PvStatus of the restore of this PV.
+
+        :return:
+        """
+        with self._lock:
+            if pvname not in self.pvnames or pvname in self.pvs_status:
+                return
+            self.pvs_status[pvname] = status
+            self._remaining -= 1
+            finished = self._started and self._remaining == 0
+        if finished:
+            self._finish()
+
+    def start(self):
+        """
+        Must be called once all puts are issued. Callbacks that arrive before that will not finish the session.
+
+        :return:
+        """
+        with self._lock:
+            self._started = True
+            finished = self._remaining == 0
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        if self._verify:
+            # Verification does CA requests and may take a while, so it must
+            # not block the thread of the last put callback.
+            Thread(target=self._verify_and_complete, daemon=True).start()
+        else:
+            self._complete()
+
+    def _verify_and_complete(self):
+        try:
+            ca.use_initial_context()
+            self.pvs_status.update(self._verify(status=dict(self.pvs_status)))
+        except Exception:
+            # Written PVs keep their status. The session must complete anyway, or it would block later restores.
+            logging.exception("Verification of restored PVs failed, they were not verified.")
+        finally:
+            self._complete()
+
+    def _complete(self):
+        if self._on_done:
+            self._on_done(self)
+        if self._callback:
+            self._callback(status=dict(self.pvs_status), forced=self.forced)
+        self.done.set()
+
+
+class RestorePlan(object):
+    def __init__(self):
+        """
+        Result of restore planning (see Snapshot.plan_restore()). PVs are sorted by what a restore will do with
+        them. Each of the following is a dict of {'pvname': saved value}:
+            to_put: Saved value differs from the current one. PV will be written.
+            equal: Saved value is equal to the current one (no need to restore).
+            no_value: There is no saved value.
+            type_err: Saved value is of the wrong type (e.g. a string which is not a number for a numeric PV).
+            no_access: PV is not connected or has no write access.
+
+        Current values of compared PVs are in a dict {'pvname': current value} named current.
+
+        :return:
+        """
+        self.to_put = dict()
+        self.equal = dict()
+        self.no_value = dict()
+        self.type_err = dict()
+        self.no_access = dict()
+        self.current = dict()
+
+
+class PutScheduler(object):
+    # If a put callback does not arrive in this time (in seconds), the put
+    # no longer occupies a slot of its IOC.
+    put_timeout = 5.0
+
+    def __init__(self, max_in_flight=None, puts_per_second=None):
+        """
+        Writes values to PVs, limiting the load on each IOC. PVs are grouped by the host that serves them. For each
+        host, at most max_in_flight puts are waiting for their put callbacks and at most puts_per_second puts are
+        issued. The next put to a host is issued when one of the previous ones completes. Without limits, all puts
+        are issued at once.
+
+        :param max_in_flight: Max number of unfinished puts per IOC host or None for no limit.
+        :param puts_per_second: Max rate of puts per IOC host or None for no limit.
+
+        :return:
+        """
+        self.max_in_flight = max_in_flight
+        self.puts_per_second = puts_per_second
+
+    @property
+    def limited(self):
+        return bool(self.max_in_flight or self.puts_per_second)
+
+    def put(self, puts, callback):
+        """
+        Issue puts. If there are limits, puts are issued from a separate thread and this method returns immediately.
+
+        :param puts: List of (pv_ref, value) to write.
+        :param callback: Called as callback(pvname, status) once each put completes (status is PvStatus.ok) or
+                         fails to start (PvStatus.type_err).
+
+        :return:
+        """
+        if self.limited:
+            Thread(target=self._put_all, args=(puts, callback), daemon=True).start()
+        else:
+            self._put_all(puts, callback)
+
+    def put_stages(self, stages, callback):
+        """
+        Issue puts in stages. Puts of each stage are issued only after all puts of the previous stage completed. Puts
+        are issued from a separate thread and this method returns immediately.
+
+        :param stages: List of (stage_name, puts), where puts are as in put().
+        :param callback: Same as in put().
+
+        :return:
+        """
+        Thread(target=self._put_stages, args=(stages, callback), daemon=True).start()
+
+    def _put_stages(self, stages, callback):
+        ca.use_initial_context()
+        cond = Condition()
+        for name, puts in stages:
+            pending = {pv_ref.pvname for pv_ref, value in puts}
+
+            def stage_done(pvname, status, _pending=pending, **kw):
+                with cond:
+                    _pending.discard(pvname)
+                    cond.notify()
+                callback(pvname, status)
+
+            logging.debug(f"Restoring stage {name} ({len(puts)} PVs).")
+            self._put_all(puts, stage_done)
+            with cond:
+                # If put callbacks stop coming, do not block the following
+                # stages forever.
+                while pending:
+                    n_pending = len(pending)
+                    cond.wait(self.put_timeout)
+                    if len(pending) == n_pending:
+                        logging.warning(f"Stage {name}: no put callback from {n_pending} PVs in "
+                                        f"{self.put_timeout} s, continuing with the next stage.")
+                        break
+
+    @staticmethod
+    def _put_one(pv_ref, value, callback):
+        try:
+            pv_ref.put(value, wait=False, callback=callback, callback_data={"status": PvStatus.ok})
+        except TypeError:
+            callback(pv_ref.pvname, PvStatus.type_err)
+
+    def _put_all(self, puts, callback):
+        if not self.limited:
+            for pv_ref, value in puts:
+                self._put_one(pv_ref, value, callback)
+            ca.flush_io()
+            return
+
+        ca.use_initial_context()
+        by_host = OrderedDict()
+        for pv_ref, value in puts:
+            by_host.setdefault(ca.host_name(pv_ref.chid), deque()).append((pv_ref, value))
+
+        # The condition is reentrant because a put callback can be called
+        # synchronously if the put fails.
+        cond = Condition(RLock())
+        in_flight = {host: dict() for host in by_host}  # {pvname: issue time}
+        next_put = {host: 0. for host in by_host}
+        interval = 1. / self.puts_per_second if self.puts_per_second else 0.
+
+        def put_done(pvname, status, host, **kw):
+            with cond:
+                if in_flight[host].pop(pvname, None) is not None:
+                    cond.notify()
+            callback(pvname, status)
+
+        with cond:
+            while by_host:
+                now = time.monotonic()
+                wake = now + self.put_timeout
+                for host in list(by_host):
+                    queue = by_host[host]
+                    flying = in_flight[host]
+                    # Free the slots of puts whose callbacks were lost.
+                    for pvname, t in list(flying.items()):
+                        if now - t > self.put_timeout:
+                            logging.warning(f"No put callback from {pvname} in {self.put_timeout} s.")
+                            del flying[pvname]
+                        else:
+                            wake = min(wake, t + self.put_timeout)
+
+                    while queue and (not self.max_in_flight or len(flying) < self.max_in_flight) \
+                            and next_put[host] <= now:
+                        pv_ref, value = queue.popleft()
+                        flying[pv_ref.pvname] = now
+                        next_put[host] = now + interval
+                        self._put_one(pv_ref, value,
+                                      lambda pvname, status, _host=host, **kw: put_done(pvname, status, _host))
+                    if not queue:
+                        del by_host[host]
+                    elif next_put[host] > now:
+                        wake = min(wake, next_put[host])
+                ca.flush_io()
+                if by_host:
+                    cond.wait(max(wake - time.monotonic(), 0.))
+
+
 class Snapshot(object):
-    def __init__(self, req_file_path=None, macros=None):
+    # Time in seconds to wait for values of all PVs in pipelined gets (when
+    # saving and planning a restore).
+    get_timeout = 5.0
+    # Delays in seconds before each read-back of restored PVs when verifying a
+    # restore. PVs that do not reach their values after the last one are
+    # reported as not settled.
+    verify_schedule = (0., 0.2, 0.5, 1., 2.)
+    # Pacing of channel creation, to avoid bursts of CA searches. At most a
+    # window of channels may be searching at once. The window starts at the
+    # minimum, grows by one with each connection and is halved when searches
+    # are not answered within search_timeout seconds. Such channels keep
+    # searching, but do not occupy the window anymore, so each window of
+    # unanswered searches delays the rest by at most search_timeout.
+    search_window_min = 500
+    search_window_max = 20000
+    # The first CA search is answered within a few milliseconds by IOCs on
+    # the same network, so PVs which are not answered in 0.1 s are most likely
+    # unreachable. Slower IOCs still connect, but shrink the window. It can be
+    # set with the --search-timeout option.
+    search_timeout = 0.1
+    # Percentages of connected PVs at which the time since the start of
+    # channel creation is reported (see connection_times).
+    connection_milestones = (50, 90, 100)
+
+    def __init__(self, req_file_path=None, macros=None, previous=None):
         """
         Main snapshot class. Provides methods to handle PVs from request or snapshot files and to create, delete, etc
         snap (saved) files
 
         :param req_file_path: Path to the request file.
         :param macros: macros to be substituted in request file (can be dict {'A': 'B', 'C': 'D'} or str "A=B,C=D").
+        :param previous: Snapshot which is replaced by this one, e.g. when the request file or macros are changed.
+                         Its PVs which are also in the new request file (after macros are replaced) are taken over
+                         with their channels, the rest are removed from it.
 
         :return:
         """
@@ -64,19 +380,70 @@ class Snapshot(object):
 
         self.pvs = dict()
         self.macros = macros
+
+        # Connection state index, kept up to date by _handle_pv_conn(). Each
+        # waiter in wait_for_connection() has a set of PVs it is still
+        # waiting for.
+        conn_lock = RLock()
+        self._conn_cond = Condition(conn_lock)
+        self._connected_pvs = set()
+        self._disconnected_pvs = set()
+        self._conn_waiters = list()
         self.req_file_path = ''
         self.req_file_metadata = {}
 
-        # Other important states
-        self._restore_started = False
-        self._restore_blocking_done = False
-        self._blocking_restore_pvs_status = dict()
-        self._restore_callback = None
-        self._current_restore_forced = False
+        # Restores that are in progress
+        self._restore_lock = Lock()
+        self._restore_sessions = set()
+
+        # Limits of puts per IOC host during restore (see PutScheduler). None
+        # means no limit.
+        self.put_window = None
+        self.put_rate = None
+        # Restore stages as a list of (name, compiled regex)
+        self.restore_stages = list()
+        # Verify restored values by default?
+        self.verify = False
+        # Format of saved files, 'text' or 'binary'
+        self.save_format = 'text'
+        # Compression of saved text files (see parse_to_save_file()), None
+        # means uncompressed.
+        self.compression = None
+        # Configuration of the BlobStore for large arrays, None means arrays
+        # are stored in save files.
+        self.blob_store_config = None
+        self.restore_config = dict()
+        # Snapshot whose PVs are taken over by add_pvs() while this one is
+        # being initialized
+        self._previous = previous
+        # Thread which creates channels of added PVs (see _queue_pvs()) and
+        # the names waiting for it, those which were connected before first.
+        # Names of its channels which are searching are kept as {name:
+        # deadline} in the order of creation, and removed when they connect.
+        # Guarded by _conn_cond. The feeder waits on _feeder_cond, which
+        # shares its lock.
+        self._channel_feeder = None
+        self._feeder_cond = Condition(conn_lock)
+        self._pending_pvs = (deque(), deque())
+        self._searching = OrderedDict()
+        self._search_answers = 0
+        self._feeder_flush = False
+        self._feeder_error = None
+        # Seconds from the start of channel creation until the percentages
+        # of connection_milestones of PVs were connected, as {percent:
+        # seconds}. Milestones are only checked once all PVs are added.
+        self.connection_times = dict()
+        self._channels_start = None
+        self._milestones = list()
 
-        self.restored_pvs_list = list()
-        self.restore_callback = None
+        try:
+            self._init_from_req_file(req_file_path, macros)
+        finally:
+            self._previous = None
+            if previous is not None:
+                previous.clear_pvs()
 
+    def _init_from_req_file(self, req_file_path, macros):
         if req_file_path:
             since_start("Started parsing reqfile")
             # holds path to the req_file_path as this is sort of identifier
@@ -84,11 +451,46 @@ class Snapshot(object):
                 os.path.normpath(os.path.abspath(req_file_path))
             req_f = SnapshotReqFile(self.req_file_path,
                                     changeable_macros=list(macros.keys()))
-            pvs, metadata = req_f.read()
+            # Channels are created for each batch of PVs as soon as it is
+            # parsed, so that searches overlap with parsing of the rest.
+            try:
+                _, metadata = req_f.read(on_batch=self._queue_pvs)
+            except BaseException:
+                self._finish_channels(cancel=True)
+                self.clear_pvs()
+                raise
+            self._finish_channels()
             since_start("Finished parsing reqfile")
 
             self.req_file_metadata = metadata
-            self.add_pvs(pvs)
+            self.configure_restore(metadata.get('restore', dict()))
+            self.save_format = metadata.get('save_format', 'text')
+            self.compression = metadata.get('compression', None)
+            self.blob_store_config = metadata.get('blob_store', None)
+
+    @property
+    def save_file_suffix(self):
+        """
+        Suffix of files saved with the configured format and compression.
+        """
+        if self.compression is not None and self.save_format == 'text':
+            return compressed_save_file_suffix
+        return save_file_suffix
+
+    def configure_restore(self, config):
+        """
+        Set how PVs are restored. The config is the "restore" dict from the request file (see Readme) and is also
+        stored in the metadata of saved files.
+
+        :param config: Dict with optional keys "max_in_flight", "puts_per_second", "stages" and "verify".
+
+        :return:
+        """
+        self.restore_config = config
+        self.put_window = config.get('max_in_flight', None)
+        self.put_rate = config.get('puts_per_second', None)
+        self.restore_stages = [(name, re.compile(pattern)) for name, pattern in config.get('stages', list())]
+        self.verify = config.get('verify', False)
 
     def add_pvs(self, pv_list):
         """
@@ -98,22 +500,234 @@ class Snapshot(object):
 
         :return:
         """
+        self._queue_pvs(pv_list)
+        self._finish_channels()
 
-        since_start("Started adding PVs")
+    def _queue_pvs(self, pv_list):
+        # Adds PVs with placeholders (None) in self.pvs. Their channels are
+        # created by _create_channels() in another thread, so that the caller
+        # (e.g. the request file parser) is not blocked by the pacing. Until
+        # then, PVs are disconnected. PVs of the previous snapshot are taken
+        # over right away.
+        _load_connected_pv_names()
 
         # pyepics will handle PVs to have only one connection per PV.
         # If pv not yet on list add it.
-        for pvname_raw in pv_list:
-
-            p_name = SnapshotPv.macros_substitution(pvname_raw, self.macros)
-            if not self.pvs.get(p_name):
-
-                pv_ref = SnapshotPv(p_name)
-
-            # if not self.pvs.get(pv_ref.pvname):
-                self.pvs[pv_ref.pvname] = pv_ref
-
+        new_names = list()
+        for p_name in MacroEngine.get(self.macros).substitute_many(pv_list):
+            # Names are stripped as by pyepics, which reports connections
+            # of the stripped name.
+            p_name = p_name.strip()
+            if p_name in self.pvs:
+                continue
+            pv_ref = self._take_previous_pv(p_name)
+            if pv_ref is not None:
+                pv_ref.add_conn_callback(self._handle_pv_conn)
+                self.pvs[p_name] = pv_ref
+                with self._conn_cond:
+                    self._set_pv_conn_state(p_name, pv_ref.connected)
+            else:
+                self.pvs[p_name] = None
+                new_names.append(p_name)
+
+        if not new_names:
+            return
+        hinted, other = self._pending_pvs
+        with self._conn_cond:
+            for p_name in new_names:
+                self._set_pv_conn_state(p_name, False)
+                if p_name in _connected_pv_names:
+                    hinted.append(p_name)
+                else:
+                    other.append(p_name)
+            if self._channel_feeder is None:
+                since_start("Started adding PVs")
+                self._channels_start = time.monotonic()
+                self.connection_times = dict()
+                self._milestones = list()
+                self._feeder_flush = False
+                self._channel_feeder = Thread(target=self._create_channels,
+                                              daemon=True)
+                self._channel_feeder.start()
+            else:
+                self._feeder_cond.notify()
+
+    def _finish_channels(self, cancel=False):
+        # Waits until channels of all queued PVs are created. If cancel is
+        # True, queued PVs without a channel are removed instead.
+        with self._conn_cond:
+            feeder = self._channel_feeder
+            if feeder is None:
+                return
+            if cancel:
+                for pending in self._pending_pvs:
+                    pending.clear()
+            else:
+                # All PVs are known, so the percentages are final.
+                self._milestones = sorted(self.connection_milestones)
+                self._check_milestones()
+            self._feeder_flush = True
+            self._feeder_cond.notify()
+        feeder.join()
+
+        with self._conn_cond:
+            self._channel_feeder = None
+            error, self._feeder_error = self._feeder_error, None
+            for pending in self._pending_pvs:
+                pending.clear()
+        # Placeholders of cancelled PVs, or left after an error
+        for p_name in [name for name, pv_ref in self.pvs.items()
+                       if pv_ref is None]:
+            del self.pvs[p_name]
+            self._forget_pv_conn_state(p_name)
         since_start("Finished adding PVs")
+        if error is not None:
+            raise error
+
+    def _create_channels(self):
+        # Thread started by _queue_pvs(). It is paced by the window (see
+        # search_window_min) until all queued names are created, also after
+        # _finish_channels() was called. A caller which waits for it waits at
+        # most search_timeout for each window of searches which are not
+        # answered. Answered searches are counted by _set_pv_conn_state(),
+        # which wakes the feeder, so it only waits when the window is full.
+        start = time.monotonic()
+        window = self.search_window_min
+        searching = self._searching
+        created = 0
+        unanswered = 0
+        try:
+            while True:
+                with self._conn_cond:
+                    answered, self._search_answers = self._search_answers, 0
+                    now = time.monotonic()
+                    timed_out = 0
+                    while searching and next(iter(searching.values())) <= now:
+                        searching.popitem(last=False)
+                        timed_out += 1
+                    unanswered += timed_out
+                    window = min(window + answered, self.search_window_max)
+                    if timed_out:
+                        window = max(window // 2, self.search_window_min)
+
+                    hinted, other = self._pending_pvs
+                    n_pending = len(hinted) + len(other)
+                    if self._feeder_flush and not n_pending:
+                        break
+                    n_free = min(window - len(searching), n_pending)
+                    if n_free <= 0:
+                        # Until an answer, more names, a flush, or the
+                        # oldest search times out
+                        self._feeder_cond.wait(
+                            next(iter(searching.values())) - now
+                            if searching else None)
+                        continue
+                    names = [(hinted or other).popleft()
+                             for _ in range(n_free)]
+
+                for p_name in names:
+                    pv_ref = SnapshotPv(
+                        p_name, connection_callback=self._handle_pv_conn)
+                    if pv_ref.pvname != p_name:
+                        # The index must use the name which pyepics reports.
+                        del self.pvs[p_name]
+                        self._forget_pv_conn_state(p_name)
+                    self.pvs[pv_ref.pvname] = pv_ref
+                    # The connection callback may have been called before
+                    # the PV was fully constructed, or not at all if the
+                    # channel was already connected. Once the lock is held,
+                    # it must find the name in searching.
+                    with self._conn_cond:
+                        connected = pv_ref.connected
+                        self._set_pv_conn_state(pv_ref.pvname, connected)
+                        if not connected:
+                            searching[pv_ref.pvname] = \
+                                time.monotonic() + self.search_timeout
+                    created += 1
+        except BaseException as e:
+            with self._conn_cond:
+                self._feeder_error = e
+        finally:
+            with self._conn_cond:
+                searching.clear()
+                self._search_answers = 0
+
+        logging.info(f"Created {created} channels in "
+                     f"{time.monotonic() - start:.2f} s, {unanswered} "
+                     f"searches not answered in {self.search_timeout} s, "
+                     f"final window {window}.")
+
+    def _take_previous_pv(self, pvname):
+        # Returns the SnapshotPv of the previous snapshot (see __init__()),
+        # without its callbacks, or None.
+        if self._previous is None:
+            return None
+        pv_ref = self._previous.pvs.pop(pvname, None)
+        if pv_ref is not None:
+            pv_ref.clear_callbacks()
+            self._previous._forget_pv_conn_state(pvname)
+        return pv_ref
+
+    def _handle_pv_conn(self, pvname=None, conn=False, **kw):
+        if conn:
+            _connected_pv_names.add(pvname)
+            _new_connected_pv_names.add(pvname)
+        with self._conn_cond:
+            if pvname in self._connected_pvs or \
+               pvname in self._disconnected_pvs:
+                self._set_pv_conn_state(pvname, conn)
+
+    def _set_pv_conn_state(self, pvname, conn):
+        # Must be called with _conn_cond held.
+        if conn:
+            self._disconnected_pvs.discard(pvname)
+            self._connected_pvs.add(pvname)
+            if self._milestones:
+                self._check_milestones()
+            if self._searching.pop(pvname, None) is not None:
+                self._search_answers += 1
+                self._feeder_cond.notify()
+        else:
+            self._connected_pvs.discard(pvname)
+            self._disconnected_pvs.add(pvname)
+
+        notify = conn and not self._disconnected_pvs
+        for selected, pending in self._conn_waiters:
+            if selected is not None and pvname not in selected:
+                continue
+            if conn:
+                pending.discard(pvname)
+                notify = notify or not pending
+            else:
+                pending.add(pvname)
+        if notify:
+            self._conn_cond.notify_all()
+
+    def _check_milestones(self):
+        # Records and reports milestones of connection_milestones which were
+        # reached. Must be called with _conn_cond held.
+        n_connected = len(self._connected_pvs)
+        n_pvs = n_connected + len(self._disconnected_pvs)
+        while self._milestones and \
+                n_connected * 100 >= self._milestones[0] * n_pvs:
+            percent = self._milestones.pop(0)
+            seconds = time.monotonic() - self._channels_start
+            self.connection_times[percent] = seconds
+            since_start(f"{percent}% of PVs connected")
+            logging.info(f"{percent}% of {n_pvs} PVs connected in "
+                         f"{seconds:.2f} s.")
+
+    def _forget_pv_conn_state(self, pvname):
+        with self._conn_cond:
+            self._connected_pvs.discard(pvname)
+            self._disconnected_pvs.discard(pvname)
+            notify = not self._disconnected_pvs
+            for _, pending in self._conn_waiters:
+                if pvname in pending:
+                    pending.discard(pvname)
+                    notify = notify or not pending
+            if notify:
+                self._conn_cond.notify_all()
 
     def remove_pvs(self, pv_list):
         """
@@ -129,11 +743,13 @@ class Snapshot(object):
             if self.pvs.get(pvname, None):
                 pv_ref = self.pvs.pop(pvname)
                 pv_ref.clear_callbacks()
+                self._forget_pv_conn_state(pvname)
 
     def clear_pvs(self):
         self.remove_pvs(list(self.pvs.keys()))
 
-    def save_pvs(self, save_file_path, force=False, symlink_path=None, **kw):
+    def save_pvs(self, save_file_path, force=False, symlink_path=None, pipelined=True, save_format=None,
+                 delta_from=None, **kw):
         """
         Get current PV values and save them in file. can also create symlink to the file. If additional metadata should
         be saved, it can be provided as keyword arguments.
@@ -141,6 +757,12 @@ class Snapshot(object):
         :param save_file_path: Path to save file.
         :param force: Save if not all PVs connected? Not connected PVs values will not be saved in such case.
         :param symlink_path: Path to symlink. If symlink exists it will be replaced.
+        :param pipelined: If True, get values and metadata of all PVs in one batch of requests (see
+                          get_pvs_with_metadata()) instead of one blocking get per PV.
+        :param save_format: 'text' or 'binary' (see parse_to_save_file()). If None, self.save_format is used.
+        :param delta_from: Path to a reference save file. If given, only PVs whose values differ from the reference
+                           (beyond the comparison tolerance) are saved, together with a pointer to the reference. If
+                           the reference cannot be used, a full snapshot is saved.
         :param kw: Will be appended to metadata.
 
         :return: (action_status, pvs_status)
@@ -166,30 +788,45 @@ class Snapshot(object):
         # Update metadata
         kw["save_time"] = time.time()
         kw["req_file_name"] = os.path.basename(self.req_file_path)
+        if self.restore_config:
+            kw["restore"] = self.restore_config
 
         background_workers.suspend()
         pvs_data = dict()
         logging.debug("Create snapshot for %d channels" % len(self.pvs.items()))
-        for pvname, pv_ref in self.pvs.items():
-            # Get current value, status of operation.
-            value, status = pv_ref.save_pv()
-
-            # Make data structure with data to be saved
-            pvs_status[pvname] = status
-            pvs_data[pvname] = OrderedDict()
-            pvs_data[pvname]['raw_name'] = pv_ref.pvname
-            if status == PvStatus.ok or pv_ref.initialized:
-                pvs_data[pvname]['egu'] = pv_ref.units
-                pvs_data[pvname]['prec'] = pv_ref.precision
-                pvs_data[pvname]['val'] = value
-            else:
-                pvs_data[pvname]['egu'] = None
-                pvs_data[pvname]['prec'] = None
-                pvs_data[pvname]['val'] = None
+        if pipelined:
+            pvs_data = self._save_pvs_pipelined(pvs_status)
+        else:
+            for pvname, pv_ref in self.pvs.items():
+                # Get current value, status of operation.
+                value, status = pv_ref.save_pv()
+
+                # Make data structure with data to be saved
+                pvs_status[pvname] = status
+                pvs_data[pvname] = OrderedDict()
+                pvs_data[pvname]['raw_name'] = pv_ref.pvname
+                if status == PvStatus.ok or pv_ref.initialized:
+                    pvs_data[pvname]['egu'] = pv_ref.units
+                    pvs_data[pvname]['prec'] = pv_ref.precision
+                    pvs_data[pvname]['val'] = value
+                else:
+                    pvs_data[pvname]['egu'] = None
+                    pvs_data[pvname]['prec'] = None
+                    pvs_data[pvname]['val'] = None
+
+        if delta_from:
+            pvs_data = self._delta_pvs_data(pvs_data, save_file_path, delta_from, kw)
+
+        blob_store = None
+        if self.blob_store_config is not None:
+            blob_store = BlobStore(os.path.dirname(os.path.abspath(save_file_path)),
+                                   self.blob_store_config.get('min_bytes'))
 
         logging.debug("Writing snapshot to file")
         try:
-            parse_to_save_file(pvs_data, save_file_path, self.macros, symlink_path, **kw)
+            parse_to_save_file(pvs_data, save_file_path, self.macros, symlink_path,
+                               save_format=save_format or self.save_format,
+                               compression=self.compression, blob_store=blob_store, **kw)
             status = ActionStatus.ok
         except OSError:
             status = ActionStatus.os_error
@@ -198,57 +835,87 @@ class Snapshot(object):
 
         return status, pvs_status
 
-    def restore_pvs(self, pvs_raw, force=False, callback=None, custom_macros=None):
+    def _delta_pvs_data(self, pvs_data, save_file_path, delta_from, kw):
+        # Returns data of PVs which differ from the reference and adds the
+        # pointer to the reference to metadata (kw). The real path is used
+        # because a symlink (e.g. "latest") will later point to another file.
+        delta_from = os.path.realpath(delta_from)
+        if delta_from == os.path.realpath(save_file_path):
+            logging.warning("Snapshot cannot reference itself, saving full snapshot.")
+            return pvs_data
+
+        reference_pvs, meta_data, err = parse_from_save_file(delta_from)
+        if err:
+            logging.warning(f"Reference snapshot {delta_from} cannot be used, saving full snapshot: "
+                            + "; ".join(err))
+            return pvs_data
+        if (meta_data.get('macros') or dict()) != (self.macros or dict()):
+            # Same names would mean different PVs
+            logging.warning(f"Reference snapshot {delta_from} was saved with different macros, saving full snapshot.")
+            return pvs_data
+
+        try:
+            kw['delta_from'] = os.path.relpath(delta_from, os.path.dirname(os.path.abspath(save_file_path)))
+        except ValueError:
+            # On Windows, if the files are on different drives.
+            kw['delta_from'] = delta_from
+        delta_pvs, kw['delta_removed'] = delta_save_data(
+            pvs_data, reference_pvs, lambda data: _compare_tolerance(data.get('prec')))
+        logging.debug(f"Delta snapshot: {len(delta_pvs)} of {len(pvs_data)} PVs changed")
+        return delta_pvs
+
+    def _save_pvs_pipelined(self, pvs_status):
+        # Same as the loop in save_pvs(), but values, units and precision of
+        # all PVs are fetched in one batch of requests.
+        pvs_data = dict()
+        pv_refs = list(self.pvs.values())
+        results = get_pvs_with_metadata(pv_refs, timeout=self.get_timeout)
+        for pv_ref, md in zip(pv_refs, results):
+            pvname = pv_ref.pvname
+            if not pv_ref.connected or not pv_ref.read_access:
+                status = PvStatus.access_err
+            elif md is None or md['value'] is None:
+                logging.debug('No value returned for channel ' + pvname)
+                status = PvStatus.no_value
+            else:
+                status = PvStatus.ok
+
+            pvs_status[pvname] = status
+            if status == PvStatus.ok:
+                pvs_data[pvname] = {'raw_name': pvname, 'egu': md.get('units'),
+                                    'prec': md.get('precision'), 'val': md['value']}
+            else:
+                pvs_data[pvname] = {'raw_name': pvname, 'egu': None, 'prec': None, 'val': None}
+        return pvs_data
+
+    def restore_pvs(self, pvs_raw, force=False, callback=None, custom_macros=None, selected=None, verify=None):
         """
         Restore PVs form snapshot file or dictionary. If restore is successfully started (ActionStatus.ok returned),
         then restore stressfulness will be returned in callback as: status={'pvname': PvStatus}, forced=was_restore?
+        Several restores can run at the same time, as long as they do not restore the same PVs.
 
         :param pvs_raw: Can be a dict of {'pvname': 'saved value'} or a path to a .snap file
         :param force: Force restore if not all needed PVs are connected?
         :param callback: Callback which will be called when all PVs are restored.
         :param custom_macros: This macros are used only if there is no self.macros and not a .snap file.
+        :param selected: Names of PVs (with macros replaced) to restore. If None, all PVs are restored. The cost of
+                         the restore is proportional to the number of restored PVs, not to the number of all PVs.
+        :param verify: After all puts complete, read back the written PVs (in one batch, retried according to
+                       verify_schedule) and report those that do not have the restored value as PvStatus.not_settled.
+                       If None, self.verify is used.
 
         :return: (action_status, pvs_status)
 
             action_status: Status of action as ActionStatus type.
 
             pvs_status: Dict of {'pvname': PvStatus}. Has meaningful content only in case of action_status == no_conn.
-                        In other cases, pvs_status is returned in callback.
+                        In other cases, pvs_status is returned in callback, for restored PVs only.
         """
-        # Check if busy
-        if self._restore_started:
-            # Cannot do a restore, previous not finished
-            return ActionStatus.busy
-
-        self._restore_started = True
-        self._current_restore_forced = force
-
-        # Prepare restore data
-        if custom_macros is None:
-            custom_macros = dict()
-
-        if isinstance(pvs_raw, str):
-            pvs_raw, meta_data, err = parse_from_save_file(pvs_raw)
-            custom_macros = meta_data.get('macros', dict())  # if no self.macros use ones from file
-
-        pvs = dict()
-
-        if self.macros:
-            macros = self.macros
-        else:
-            macros = custom_macros
-
-        if macros:
-            # Replace macros
-            for pvname_raw, pv_data in pvs_raw.items():
-                pvs[SnapshotPv.macros_substitution(pvname_raw, macros)] = pv_data
-        else:
-            pvs = pvs_raw
+        pvs = self._prepare_restore_data(pvs_raw, custom_macros, selected)
 
         # Do restore
         if not pvs:
             # Nothing to restore
-            self._restore_started = False
             return ActionStatus.no_data, dict()
 
         # Standard restore (restore all)
@@ -262,39 +929,200 @@ class Snapshot(object):
             pvs_status[pvname] = PvStatus.access_err
 
         if not force and disconn_pvs:
-            self._restore_started = False
             return ActionStatus.no_conn, pvs_status
 
+        # Each restore is a separate session. Sessions can run concurrently,
+        # as long as they do not restore the same PVs.
+        targets = self._restore_targets(pvs)
+        if verify is None:
+            verify = self.verify
+        session = RestoreSession(targets, callback=callback, forced=force,
+                                 on_done=self._restore_session_done,
+                                 verify=partial(self._verify_restore, pvs) if verify else None)
+        with self._restore_lock:
+            if any(not session.pvnames.isdisjoint(s.pvnames) for s in self._restore_sessions):
+                # Cannot do a restore, previous not finished
+                return ActionStatus.busy, dict()
+            self._restore_sessions.add(session)
+
         # Do a restore. It is started here, but is completed
-        # in _check_restore_complete()
+        # in RestoreSession.pv_done()
         background_workers.suspend()
-        self.restored_pvs_list = list()
-        self.restore_callback = callback
-        for pvname, pv_ref in self.pvs.items():
-            save_data = pvs.get(pvname)  # Check if this pv is to be restored
-            if save_data:
-                pv_ref.restore_pv(save_data.get('value', None),
-                                  callback=self._check_restore_complete)
-            else:
-                # pv is not in subset in the "selected only" mode checking
-                # algorithm should think this one was successfully restored
-                self._check_restore_complete(pvname, PvStatus.ok)
+        try:
+            plan = self._plan_restore(pvs, targets)
+            self._execute_restore_plan(plan, session)
+        except Exception:
+            # The session will never complete, so it must not block other
+            # restores.
+            self._restore_session_done(session)
+            raise
+        session.start()
 
         # PVs status will be returned in callback
         return ActionStatus.ok, dict()
 
-    def _check_restore_complete(self, pvname, status, **kw):
-        # Collect all results and proceed when everything is done
-        self.restored_pvs_list.append((pvname, status))
-        if len(self.restored_pvs_list) == len(self.pvs):
-            if self.restore_callback:
-                self.restore_callback(status=dict(self.restored_pvs_list),
-                                      forced=self._current_restore_forced)
-                self.restore_callback = None
-            self._restore_started = False
+    def plan_restore(self, pvs_raw, custom_macros=None, selected=None):
+        """
+        Find out what a restore would do, without writing anything. Current values of all PVs are fetched in one
+        batch and compared to the saved ones.
+
+        :param pvs_raw: Can be a dict of {'pvname': 'saved value'} or a path to a .snap file
+        :param custom_macros: This macros are used only if there is no self.macros and not a .snap file.
+        :param selected: Names of PVs (with macros replaced) to restore. If None, all PVs are restored.
+
+        :return: RestorePlan
+        """
+        pvs = self._prepare_restore_data(pvs_raw, custom_macros, selected)
+        background_workers.suspend()
+        try:
+            return self._plan_restore(pvs, self._restore_targets(pvs))
+        finally:
             background_workers.resume()
 
-    def restore_pvs_blocking(self, pvs_raw=None, force=False, timeout=10, custom_macros=None):
+    def _restore_targets(self, pvs):
+        # Only PVs of this snapshot can be restored.
+        targets = [pvname for pvname in pvs if pvname in self.pvs]
+        if len(targets) < len(pvs):
+            missing = [pvname for pvname in pvs if pvname not in self.pvs]
+            logging.warning(f"{len(missing)} saved PVs are not part of the snapshot and will not be restored: "
+                            + ", ".join(missing[:10]) + (", ..." if len(missing) > 10 else ""))
+        return targets
+
+    def _plan_restore(self, pvs, targets):
+        plan = RestorePlan()
+        to_compare = list()
+        for pvname in targets:
+            pv_ref = self.pvs[pvname]
+            value = pvs[pvname].get('value', None)
+            # Access must be checked after the connection. See SnapshotPv.restore_pv().
+            if not pv_ref.connected or not pv_ref.write_access:
+                plan.no_access[pvname] = value
+            elif value is None:
+                plan.no_value[pvname] = value
+            elif isinstance(value, str) and ca.field_type(pv_ref.chid) not in (dbr.STRING, dbr.ENUM, dbr.CHAR) \
+                    and not self._is_numeric_str(value):
+                # pyepics converts numeric strings when writing, others fail.
+                plan.type_err[pvname] = value
+            else:
+                to_compare.append(pvname)
+
+        pv_refs = [self.pvs[pvname] for pvname in to_compare]
+        results = get_pvs_with_metadata(pv_refs, timeout=self.get_timeout)
+        saved = [pvs[pvname]['value'] for pvname in to_compare]
+        current = [md['value'] if md is not None else None for md in results]
+        equal = SnapshotPv.compare_many(saved, current, 0.)
+        for pvname, value, curr_value, eq in zip(to_compare, saved, current, equal):
+            plan.current[pvname] = curr_value
+            if eq:
+                plan.equal[pvname] = value
+            else:
+                plan.to_put[pvname] = value
+        return plan
+
+    @staticmethod
+    def _is_numeric_str(value):
+        # Same conversions as pyepics uses for numeric fields
+        for convert in (float, partial(int, base=0)):
+            try:
+                convert(value)
+                return True
+            except ValueError:
+                pass
+        return False
+
+    def _execute_restore_plan(self, plan, session):
+        for group, status in ((plan.no_access, PvStatus.access_err),
+                              (plan.no_value, PvStatus.no_value),
+                              (plan.type_err, PvStatus.type_err),
+                              (plan.equal, PvStatus.equal)):
+            for pvname in group:
+                session.pv_done(pvname, status)
+
+        scheduler = PutScheduler(self.put_window, self.put_rate)
+        stages = self._split_restore_stages(plan.to_put)
+        if len(stages) > 1:
+            scheduler.put_stages(stages, session.pv_done)
+        elif stages:
+            scheduler.put(stages[0][1], session.pv_done)
+
+    def _split_restore_stages(self, to_put):
+        # Each PV belongs to the first stage whose regex matches its name.
+        # PVs that match no stage are restored last. Empty stages are
+        # skipped.
+        stages = OrderedDict((name, list()) for name, pattern in self.restore_stages)
+        unstaged = list()
+        for pvname, value in to_put.items():
+            for name, pattern in self.restore_stages:
+                if pattern.fullmatch(pvname):
+                    stages[name].append((self.pvs[pvname], value))
+                    break
+            else:
+                unstaged.append((self.pvs[pvname], value))
+        stages = [(name, puts) for name, puts in stages.items() if puts]
+        if unstaged:
+            stages.append(('unstaged', unstaged))
+        return stages
+
+    def _verify_restore(self, pvs, status):
+        # Only PVs that were actually written are checked.
+        pending = [pvname for pvname, sts in status.items() if sts == PvStatus.ok]
+        for delay in self.verify_schedule:
+            if not pending:
+                break
+            time.sleep(delay)
+            results = get_pvs_with_metadata([self.pvs[pvname] for pvname in pending], timeout=self.get_timeout)
+            current = [md['value'] if md is not None else None for md in results]
+            tolerance = [_compare_tolerance(md.get('precision')) if md is not None else 1e-6 for md in results]
+            equal = SnapshotPv.compare_many([pvs[pvname]['value'] for pvname in pending], current, tolerance)
+            pending = [pvname for pvname, eq in zip(pending, equal) if not eq]
+
+        if pending:
+            logging.warning(f"{len(pending)} PVs did not settle to the restored values.")
+        return {pvname: PvStatus.not_settled for pvname in pending}
+
+    def _prepare_restore_data(self, pvs_raw, custom_macros, selected):
+        if custom_macros is None:
+            custom_macros = dict()
+
+        if isinstance(pvs_raw, str):
+            pvs_raw, meta_data, err = parse_from_save_file(pvs_raw, lazy=True)
+            custom_macros = meta_data.get('macros', dict())  # if no self.macros use ones from file
+
+        if self.macros:
+            macros = self.macros
+        else:
+            macros = custom_macros
+
+        return self._select_restore_data(pvs_raw, macros, selected)
+
+    @staticmethod
+    def _select_restore_data(pvs_raw, macros, selected):
+        # Resolve macros of all names in one pass and keep only the selected
+        # PVs. Values are not touched here, except that values from a file
+        # (SaveFileData) are decoded in bulk for the selected PVs only.
+        if selected is not None and not isinstance(selected, (set, frozenset, dict)):
+            selected = set(selected)
+
+        if not macros:
+            names = [(pvname, pvname) for pvname in pvs_raw
+                     if selected is None or pvname in selected]
+        else:
+            pvnames_raw = list(pvs_raw)
+            names = [(pvname, pvname_raw) for pvname, pvname_raw
+                     in zip(MacroEngine.get(macros).substitute_many(pvnames_raw), pvnames_raw)
+                     if selected is None or pvname in selected]
+
+        if isinstance(pvs_raw, SaveFileData):
+            pvs_raw.decode([pvname_raw for pvname, pvname_raw in names])
+        return {pvname: pvs_raw[pvname_raw] for pvname, pvname_raw in names}
+
+    def _restore_session_done(self, session):
+        with self._restore_lock:
+            self._restore_sessions.discard(session)
+        background_workers.resume()
+
+    def restore_pvs_blocking(self, pvs_raw=None, force=False, timeout=10, custom_macros=None, selected=None,
+                             verify=None):
         """
         Similar as restore_pvs, but block until restore finished or timeout.
 
@@ -302,6 +1130,8 @@ class Snapshot(object):
         :param force: Force restore if not all needed PVs are connected?
         :param custom_macros: This macros are used only if there is no self.macros and not a .snap file.
         :param timeout: Timeout in seconds.
+        :param selected: Names of PVs to restore. If None, all PVs are restored.
+        :param verify: Verify restored values? See restore_pvs().
 
         :return: (action_status, pvs_status)
 
@@ -310,27 +1140,25 @@ class Snapshot(object):
             pvs_status: Dict of {'pvname': PvStatus}.
 
         """
-        self._restore_blocking_done = False
-        self._blocking_restore_pvs_status = dict()
+        # The callback sets the event, so we return as soon as the last PV
+        # is restored.
+        restore_done = Event()
+        restored_pvs_status = dict()
+
+        def set_restore_done(status, forced):
+            restored_pvs_status.update(status)
+            restore_done.set()
+
         status, pvs_status = self.restore_pvs(pvs_raw, force=force, custom_macros=custom_macros,
-                                              callback=self._set_restore_blocking_done)
+                                              callback=set_restore_done, selected=selected, verify=verify)
         if status == ActionStatus.ok:
-            end_time = time.time() + timeout
-            while not self._restore_blocking_done and time.time() < end_time:
-                time.sleep(0.2)
-
-            if self._restore_blocking_done:
-                return ActionStatus.ok, self._blocking_restore_pvs_status
+            if restore_done.wait(max(timeout, 0)):
+                return ActionStatus.ok, restored_pvs_status
             else:
                 return ActionStatus.timeout, pvs_status
         else:
             return status, pvs_status
 
-    def _set_restore_blocking_done(self, status, forced):
-        # If this was called, then restore is done
-        self._restore_blocking_done = True
-        self._blocking_restore_pvs_status = status
-
     def get_pvs_names(self):
         """
         Get list of SnapshotPvs
@@ -348,18 +1176,64 @@ class Snapshot(object):
 
         :return: List of not connected PV names.
         """
-        if selected is None:
-            selected = list()
+        with self._conn_cond:
+            if not selected:
+                return list(self._disconnected_pvs)
+
+            if not isinstance(selected, (set, frozenset, dict)):
+                selected = set(selected)
+            # Iterate over the smaller of the two
+            if len(selected) < len(self._disconnected_pvs):
+                return [pvname for pvname in selected
+                        if pvname in self._disconnected_pvs]
+            else:
+                return [pvname for pvname in self._disconnected_pvs
+                        if pvname in selected]
+
+    def get_disconnected_pvs_count(self):
+        """
+        Get number of currently disconnected PVs.
 
-        not_connected_list = list()
-        for pvname, pv_ref in self.pvs.items():
-            if not pv_ref.connected and ((pvname in selected) or not selected):
-                not_connected_list.append(pvname)  # Need to check only subset (selected) of pvs?
-        return not_connected_list
+        :return: Number of not connected PVs.
+        """
+        return len(self._disconnected_pvs)
+
+    def get_connected_pvs_count(self):
+        """
+        Get number of currently connected PVs.
+
+        :return: Number of connected PVs.
+        """
+        return len(self._connected_pvs)
+
+    def wait_for_connection(self, timeout=None, selected=None):
+        """
+        Block until all snapshot PVs (default) or all "selected" PVs are connected, or until timeout.
+
+        :param timeout: Timeout in seconds. None means no timeout.
+        :param selected: List of PVs to wait for. PVs which are not part of the snapshot are ignored.
+
+        :return: True if all PVs are connected, False on timeout.
+        """
+        with self._conn_cond:
+            if not selected:
+                return self._conn_cond.wait_for(
+                    lambda: not self._disconnected_pvs, timeout)
+
+            selected = set(selected)
+            pending = selected & self._disconnected_pvs
+            waiter = (selected, pending)
+            self._conn_waiters.append(waiter)
+            try:
+                return self._conn_cond.wait_for(lambda: not pending, timeout)
+            finally:
+                self._conn_waiters = [w for w in self._conn_waiters
+                                      if w is not waiter]
 
     def replace_metadata(self, save_file_path, metadata):
         """
-        Reopen save data and replace meta data.
+        Reopen save data and replace meta data. A compressed file is compressed again with the configured
+        compression, or with its own level if compression is not configured.
 
         :param save_file_path: Path to save file.
         :param metadata: Dict with new metadata.
@@ -367,13 +1241,4 @@ class Snapshot(object):
         :return:
         """
         # Will replace metadata in the save file with the provided one
-
-        with open(save_file_path, 'r') as save_file:
-            lines = save_file.readlines()
-            if lines[0].startswith('#'):
-                lines[0] = "#" + json.dumps(metadata) + "\n"
-            else:
-                lines.insert(0, "#" + json.dumps(metadata) + "\n")
-
-            with open(save_file_path, 'w') as save_file_write:
-                save_file_write.writelines(lines)
+        replace_save_file_metadata(save_file_path, metadata, compression=self.compression)
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import sqlite3
+from contextlib import closing
+
+from snapshot.core import global_thread_pool
+
+catalog_file_name = '.snapshot_catalog.sqlite'
+
+
+class SaveFileCatalog(object):
+    # Version of the table layout. An existing catalog with a different
+    # version is rebuilt.
+    version = 1
+
+    def __init__(self, save_dir):
+        """
+        Persistent catalog of metadata of save files in a directory. It is an
+        SQLite database in the same directory. Entries are keyed by file name,
+        size and modification time, so only new or modified files need to be
+        parsed. If the catalog cannot be used (e.g. the directory is read-only
+        or the database is locked), files are parsed as if there was no
+        catalog.
+
+        :param save_dir: Path to the directory with save files.
+
+        :return:
+        """
+        self.save_dir = save_dir
+        self.path = os.path.join(save_dir, catalog_file_name)
+
+    def sync(self, files, parse, prune_prefix=None):
+        """
+        Bring the catalog up to date for the given files and return their
+        metadata.
+
+        :param files: Dict {file_name: os.stat_result} of save files in the
+                      directory.
+        :param parse: Called as parse(file_path) for new or modified files.
+                      Must return (meta_data, err) as parse_from_save_file().
+        :param prune_prefix: Entries of files which are not in files are
+                             removed, but only if their name starts with this
+                             prefix. If None, all of them are removed.
+
+        :return: Dict {file_name: (meta_data, err)}
+        """
+        for retry in (True, False):
+            try:
+                return self._sync(files, parse, prune_prefix)
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Cannot use catalog {self.path}: {e}")
+                break
+            except sqlite3.DatabaseError as e:
+                # Damaged database file, start from scratch.
+                logging.warning(f"Rebuilding damaged catalog {self.path}: "
+                                f"{e}")
+                if not retry or not self.clear():
+                    break
+
+        results = global_thread_pool.map(
+            lambda name: parse(os.path.join(self.save_dir, name)), files)
+        return dict(zip(files, results))
+
+    def clear(self):
+        """
+        Remove the catalog.
+
+        :return: True if successful.
+        """
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return True
+        except OSError as e:
+            logging.warning(f"Cannot remove catalog {self.path}: {e}")
+            return False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.version:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS files')
+                conn.execute('CREATE TABLE files ('
+                             'name TEXT PRIMARY KEY, size INTEGER, '
+                             'mtime_ns INTEGER, req_file_name TEXT, '
+                             'comment TEXT, labels TEXT, '
+                             'machine_params TEXT, meta_data TEXT, '
+                             'errors TEXT)')
+                conn.execute(f'PRAGMA user_version = {self.version}')
+        return conn
+
+    def _sync(self, files, parse, prune_prefix):
+        with closing(self._connect()) as conn:
+            cached = {row[0]: row[1:] for row in conn.execute(
+                'SELECT name, size, mtime_ns, meta_data, errors FROM files')}
+
+            result = dict()
+            stale = list()
+            for name, stat in files.items():
+                entry = cached.get(name)
+                if entry is not None and entry[0] == stat.st_size \
+                        and entry[1] == stat.st_mtime_ns:
+                    result[name] = (json.loads(entry[2]), json.loads(entry[3]))
+                else:
+                    stale.append(name)
+
+            parsed = global_thread_pool.map(
+                lambda name: parse(os.path.join(self.save_dir, name)), stale)
+            rows = list()
+            for name, (meta_data, err) in zip(stale, parsed):
+                result[name] = (meta_data, err)
+                if err and not meta_data:
+                    # Could not be read, maybe the file is still being
+                    # written. Try again next time.
+                    continue
+                stat = files[name]
+                rows.append((name, stat.st_size, stat.st_mtime_ns,
+                             meta_data.get('req_file_name'),
+                             meta_data.get('comment'),
+                             json.dumps(meta_data.get('labels')),
+                             json.dumps(meta_data.get('machine_params')),
+                             json.dumps(meta_data), json.dumps(err)))
+
+            removed = [(name,) for name in cached if name not in files and
+                       (prune_prefix is None or name.startswith(prune_prefix))]
+
+            if rows or removed:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO files VALUES '
+                                     '(?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                    conn.executemany('DELETE FROM files WHERE name = ?',
+                                     removed)
+            if stale or removed:
+                logging.debug(f"Catalog {self.path}: {len(rows)} entries "
+                              f"updated, {len(removed)} removed.")
+        return result
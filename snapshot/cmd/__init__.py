@@ -1 +1 @@
-from .snapshot_cmd import save, restore
+from .snapshot_cmd import save, restore, index, compact
@@ -1,21 +1,18 @@
 import datetime
 import logging
 import os
+import re
 import sys
 import time
 
 from snapshot.ca_core import PvStatus, ActionStatus, Snapshot
-from snapshot.core import SnapshotError, get_machine_param_data
-from snapshot.parser import parse_from_save_file
+from snapshot.core import SnapshotError, MacroEngine, get_machine_param_data
+from snapshot.parser import parse_from_save_file, save_file_suffixes, compact_save_file, SaveFileData
+from snapshot.catalog import SaveFileCatalog
 
 
-def save(req_file_path, save_file_path='.', macros=None, force=False, timeout=10, labels_str=None, comment=None):
-    symlink_path = None
-    if os.path.isdir(save_file_path):
-        symlink_path = save_file_path + '/{}_latest.snap'.format(os.path.splitext(os.path.basename(req_file_path))[0])
-        save_file_path += '/{}_{}.snap'.format(os.path.splitext(os.path.basename(req_file_path))[0],
-                                               datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d_%H%M%S'))
-
+def save(req_file_path, save_file_path='.', macros=None, force=False, timeout=10, labels_str=None, comment=None,
+         save_format=None, delta_from=None):
     labels = list()
     if labels_str.strip():
         list_labels = labels_str.split(',')
@@ -35,11 +32,20 @@ def save(req_file_path, save_file_path='.', macros=None, force=False, timeout=10
     except (OSError, SnapshotError) as e:
         logging.error('Snapshot cannot be loaded due to a following error: {}'.format(e))
         sys.exit(1)
+    if save_format:
+        snapshot.save_format = save_format
+
+    symlink_path = None
+    if os.path.isdir(save_file_path):
+        # The link has the suffix of the file it points to.
+        symlink_path = save_file_path + '/{}_latest{}'.format(os.path.splitext(os.path.basename(req_file_path))[0],
+                                                              snapshot.save_file_suffix)
+        save_file_path += '/{}_{}{}'.format(os.path.splitext(os.path.basename(req_file_path))[0],
+                                            datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d_%H%M%S'),
+                                            snapshot.save_file_suffix)
 
     logging.info('Waiting for PVs connections (timeout: {} s) ...'.format(timeout))
-    end_time = time.time() + timeout
-    while snapshot.get_disconnected_pvs_names() and time.time() < end_time:
-        time.sleep(0.2)
+    snapshot.wait_for_connection(timeout)
 
     machine_params = snapshot.req_file_metadata.get('machine_params', {})
     params_data = get_machine_param_data(machine_params)
@@ -66,7 +72,9 @@ def save(req_file_path, save_file_path='.', macros=None, force=False, timeout=10
                                           labels=labels,
                                           comment=comment,
                                           machine_params=params_data,
-                                          symlink_path=symlink_path)
+                                          symlink_path=symlink_path,
+                                          save_format=save_format,
+                                          delta_from=delta_from)
 
     if status != ActionStatus.ok:
         for pv_name, status in pv_status.items():
@@ -81,40 +89,75 @@ def save(req_file_path, save_file_path='.', macros=None, force=False, timeout=10
         logging.info('Snapshot file was saved.')
 
 
-def restore(saved_file_path, force=False, timeout=10):
+def restore(saved_file_path, force=False, timeout=10, pvs=None, regex=None, dry_run=False, max_in_flight=None,
+            puts_per_second=None, verify=False):
     logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
     logging.info('Start restoring the snapshot.')
     if force:
         logging.info('Started in force mode. Unavailable PVs will be ignored.')
 
     try:
-        # Preparse file to check for any problems in the snapshot file.
-        saved_pvs, meta_data, err = parse_from_save_file(saved_file_path)
+        # Values are decoded only for the selected PVs, which are chosen by name.
+        saved_pvs, meta_data, err = parse_from_save_file(saved_file_path, lazy=True)
 
+        macros = meta_data.get('macros', dict())
+        snapshot, selected = snapshot_for_restore(saved_pvs, macros, pvs, regex)
+        if selected is not None:
+            logging.info('Restoring {} of {} PVs.'.format(len(selected), len(saved_pvs)))
+
+        # Decode now to check for any problems in the selected values.
+        if isinstance(saved_pvs, SaveFileData):
+            saved_pvs.decode(list(saved_pvs) if selected is None else select_pvs(saved_pvs, macros, pvs, regex))
         if err:
             logging.warning('While loading file following problems were detected:\n * ' + '\n * '.join(err))
-        # Use saved file as request file here
-        snapshot = Snapshot(saved_file_path, macros=meta_data.get('macros', dict()))
 
-    except (OSError, SnapshotError) as e:
+        # Limits and stages of restore from the request file are stored in
+        # the snapshot file.
+        snapshot.configure_restore(meta_data.get('restore', dict()))
+
+    except (OSError, SnapshotError, re.error) as e:
         logging.error('Snapshot cannot be loaded due to a following error: {}'.format(e))
         sys.exit(1)
 
+    if max_in_flight is not None:
+        snapshot.put_window = max_in_flight
+    if puts_per_second is not None:
+        snapshot.put_rate = puts_per_second
+
     logging.info('Waiting for PVs connections (timeout: {} s) ...'.format(timeout))
     end_time = time.time() + timeout
+    snapshot.wait_for_connection(timeout)
 
-    while snapshot.get_disconnected_pvs_names() and time.time() < end_time:
-        time.sleep(0.2)
+    if dry_run:
+        plan = snapshot.plan_restore(saved_pvs, selected=selected)
+        for pv_name, value in plan.to_put.items():
+            logging.info('\"{}\": Would be restored: {} -> {}'.format(pv_name, plan.current[pv_name], value))
+        for pv_name in plan.type_err:
+            logging.warning('\"{}\": Would not be restored (type problem).'.format(pv_name))
+        for pv_name in plan.no_access:
+            logging.warning('\"{}\": Would not be restored. No connection or no write access.'.format(pv_name))
+        logging.info('Dry run: {} PVs would be restored, {} are equal, {} have no saved value.'
+                     .format(len(plan.to_put), len(plan.equal), len(plan.no_value)))
+        return
 
     # Timeout should be used for complete command. Pass the remaining of the time.
-    status, pvs_status = snapshot.restore_pvs_blocking(saved_file_path, force, end_time - time.time())
+    # Verification is also enabled if configured in the snapshot file.
+    status, pvs_status = snapshot.restore_pvs_blocking(saved_pvs, force, end_time - time.time(), selected=selected,
+                                                       verify=True if verify else None)
 
     if status == ActionStatus.ok:
+        not_settled = False
         for pv_name, pv_status in pvs_status.items():
             if pv_status == PvStatus.access_err:
                 logging.warning('\"{}\": Not restored. No connection or no write access.'.format(pv_name))
+            elif pv_status == PvStatus.not_settled:
+                logging.warning('\"{}\": Restored, but the value read back differs.'.format(pv_name))
+                not_settled = True
 
-        logging.info('Snapshot file was restored.')
+        if not_settled:
+            logging.error('Snapshot file was restored, but some PVs did not settle.')
+        else:
+            logging.info('Snapshot file was restored.')
 
     elif status == ActionStatus.timeout:
         # In case when no response from some PVs after values were pushed.
@@ -131,3 +174,112 @@ def restore(saved_file_path, force=False, timeout=10):
                 logging.error('\"{}\": No connection or no write access.'.format(pv_name))
 
         logging.error('Snapshot file was not restored.')
+
+
+def index(save_dir, rebuild=False):
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+    catalog = SaveFileCatalog(save_dir)
+    if rebuild:
+        logging.info('Removing the existing catalog.')
+        if not catalog.clear():
+            sys.exit(1)
+
+    # Catalog all save files in the directory, regardless of the request file
+    # they belong to.
+    try:
+        files = {entry.name: entry.stat() for entry in os.scandir(save_dir)
+                 if entry.name.endswith(save_file_suffixes) and entry.is_file()}
+    except OSError as e:
+        logging.error('Cannot list the save directory: {}'.format(e))
+        sys.exit(1)
+
+    logging.info('Indexing {} save files in {} ...'.format(len(files), save_dir))
+    entries = catalog.sync(files, lambda path: parse_from_save_file(path, metadata_only=True)[1:])
+    for file_name, (meta_data, err) in entries.items():
+        if err:
+            logging.warning('{}: {}'.format(file_name, '; '.join(err)))
+    logging.info('Catalog {} is up to date.'.format(catalog.path))
+
+
+def compact(paths):
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+    # Directories are expanded to all save files in them. Symlinks are
+    # skipped, their targets are compacted anyway.
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            try:
+                files.extend(sorted(entry.path for entry in os.scandir(path)
+                                    if entry.name.endswith(save_file_suffixes) and
+                                    entry.is_file(follow_symlinks=False)))
+            except OSError as e:
+                logging.error('Cannot list the directory: {}'.format(e))
+                sys.exit(1)
+        else:
+            files.append(path)
+
+    failed = False
+    compacted = 0
+    for file_path in files:
+        meta_data, err = parse_from_save_file(file_path, metadata_only=True)[1:]
+        if 'delta_from' not in meta_data:
+            if err:
+                logging.warning('{}: {}'.format(file_path, '; '.join(err)))
+            continue
+        err = compact_save_file(file_path)
+        if err:
+            logging.error('{} cannot be compacted: {}'.format(file_path, '; '.join(err)))
+            failed = True
+        else:
+            compacted += 1
+
+    logging.info('{} delta snapshot files compacted.'.format(compacted))
+    if failed:
+        sys.exit(1)
+
+
+def snapshot_for_restore(saved_pvs, macros, pvs=None, regex=None):
+    """
+    Create a Snapshot with channels of the saved PVs which are to be restored. The PVs are taken from the parsed save
+    file, so that a delta snapshot includes the PVs of its reference files.
+
+    :param saved_pvs: Dict of saved PVs as returned by parse_from_save_file().
+    :param macros: Dict of macros.
+    :param pvs: List of PV names, see select_pvs().
+    :param regex: Regular expression, see select_pvs().
+
+    :return: (snapshot, selected), where selected is the set of PV names (with macros replaced) to be restored, or
+             None if all of them are restored.
+    """
+    snapshot = Snapshot(macros=macros)
+    if pvs is None and regex is None:
+        snapshot.add_pvs(list(saved_pvs))
+        return snapshot, None
+
+    # Only connect to the selected PVs
+    snapshot.add_pvs(select_pvs(saved_pvs, macros, pvs, regex))
+    selected = set(snapshot.pvs.keys())
+    if pvs is not None:
+        for pvname in pvs:
+            if pvname not in selected:
+                logging.warning('\"{}\": Not in the snapshot file, will not be restored.'.format(pvname))
+    return snapshot, selected
+
+
+def select_pvs(saved_pvs, macros, pvs=None, regex=None):
+    """
+    Select PVs from saved data by name or by regular expression. Names are matched after macros are replaced.
+
+    :param saved_pvs: Dict of saved PVs as returned by parse_from_save_file().
+    :param macros: Dict of macros.
+    :param pvs: List of PV names.
+    :param regex: Regular expression that must match the whole PV name.
+
+    :return: List of raw names (with macros) of selected PVs.
+    """
+    names = set(pvs) if pvs is not None else set()
+    rgx = re.compile(regex) if regex is not None else None
+
+    names_raw = list(saved_pvs)
+    return [pvname_raw for pvname, pvname_raw in zip(MacroEngine.get(macros).substitute_many(names_raw), names_raw)
+            if pvname in names or (rgx is not None and rgx.fullmatch(pvname))]
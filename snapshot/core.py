@@ -1,8 +1,9 @@
-from epics import PV, ca, caput, caget_many
+from epics import PV, ca, dbr, caput, caget_many
 import numpy
 from enum import Enum
 import json
 import logging
+from functools import lru_cache, partial
 from time import monotonic, sleep, time
 from threading import Thread, Lock
 from concurrent.futures import ThreadPoolExecutor
@@ -46,55 +47,65 @@ class _BackgroundWorkers:
 
     A task is registered by name. This name can be used to selectively suspend
     and resume a particular task.
+
+    suspend() and resume() may be called from any thread, e.g. by concurrent
+    restores which finish in CA callbacks.
     """
 
     def __init__(self):
         self._workers = {}
         self._explicitly_suspended = {}
         self._count = 0
+        self._lock = Lock()
 
     def is_suspended(self):
         return self._count > 0
 
     def suspend_one(self, worker_name):
-        if not self._explicitly_suspended[worker_name]:
-            self._explicitly_suspended[worker_name] = True
-            if not self.is_suspended():
-                self._workers[worker_name].suspend()
+        with self._lock:
+            if not self._explicitly_suspended[worker_name]:
+                self._explicitly_suspended[worker_name] = True
+                if not self.is_suspended():
+                    self._workers[worker_name].suspend()
 
     def resume_one(self, worker_name):
-        if self._explicitly_suspended[worker_name]:
-            self._explicitly_suspended[worker_name] = False
-            if not self.is_suspended():
-                self._workers[worker_name].resume()
+        with self._lock:
+            if self._explicitly_suspended[worker_name]:
+                self._explicitly_suspended[worker_name] = False
+                if not self.is_suspended():
+                    self._workers[worker_name].resume()
 
     def suspend(self):
-        if self._count == 0:
-            since_start("Pausing background threads")
-            for n, w in self._workers.items():
-                if not self._explicitly_suspended[n]:
-                    w.suspend()
-            since_start("Background threads suspended")
-        self._count += 1
-
-    def resume(self):
-        if self._count > 0:
-            self._count -= 1
+        with self._lock:
             if self._count == 0:
-                since_start("Resuming background threads")
+                since_start("Pausing background threads")
                 for n, w in self._workers.items():
                     if not self._explicitly_suspended[n]:
-                        w.resume()
+                        w.suspend()
+                since_start("Background threads suspended")
+            self._count += 1
+
+    def resume(self):
+        with self._lock:
+            if self._count > 0:
+                self._count -= 1
+                if self._count == 0:
+                    since_start("Resuming background threads")
+                    for n, w in self._workers.items():
+                        if not self._explicitly_suspended[n]:
+                            w.resume()
 
     def register(self, worker_name, worker):
-        assert(worker_name not in self._workers)
-        self._workers[worker_name] = worker
-        self._explicitly_suspended[worker_name] = False
+        with self._lock:
+            assert(worker_name not in self._workers)
+            self._workers[worker_name] = worker
+            self._explicitly_suspended[worker_name] = False
 
     def unregister(self, worker_name):
-        if worker_name in self._workers:
-            del self._workers[worker_name]
-            del self._explicitly_suspended[worker_name]
+        with self._lock:
+            if worker_name in self._workers:
+                del self._workers[worker_name]
+                del self._explicitly_suspended[worker_name]
 
 
 background_workers = _BackgroundWorkers()
@@ -182,6 +193,65 @@ def get_machine_param_data(machine_params):
             for p, v in zip(machine_params.keys(), results)}
 
 
+def get_pvs_with_metadata(pvs, timeout=5.0):
+    """
+    Pipelined get of values and control metadata (units, precision, ...) of
+    many PVs. All the requests are issued at once and flushed together, then
+    the completions are collected, so the whole operation takes about as long
+    as the round trip to the slowest IOC. This is the same pattern as in
+    PvUpdater._get_start() and _get_complete(), but the ctrl metadata are
+    fetched in the same request.
+
+    Fetched values and metadata are cached in the SnapshotPv objects, so that
+    subsequent access to value, units and precision will not block.
+
+    :param pvs: Iterable of SnapshotPv objects.
+    :param timeout: Time in seconds to wait for all responses.
+
+    :return: List of metadata dicts, ordered as pvs. An entry is None if the
+             PV is not connected, not readable, or did not respond in time.
+    """
+    pvs = list(pvs)
+    ftypes = list()
+    for pv in pvs:
+        ftype = None
+        try:
+            # Access must be checked after the connection. See
+            # SnapshotPv.save_pv().
+            if pv.connected and pv.read_access:
+                ftype = ca.promote_type(pv.chid, use_ctrl=True)
+                ca.get_with_metadata(pv.chid, ftype=ftype, wait=False,
+                                     as_numpy=True)
+        except ca.ChannelAccessException:
+            ftype = None
+        ftypes.append(ftype)
+
+    ca.flush_io()
+
+    results = list()
+    end_time = monotonic() + timeout
+    for pv, ftype in zip(pvs, ftypes):
+        md = None
+        if ftype is not None:
+            try:
+                md = ca.get_complete_with_metadata(
+                    pv.chid, ftype=ftype, as_numpy=True,
+                    timeout=max(end_time - monotonic(), 1e-3))
+            except (ca.ChannelAccessException, ca.ChannelAccessGetFailure):
+                # See PvUpdater._get_complete().
+                md = None
+
+        if md is not None:
+            md['value'] = pv._uniform_value(md['value'])
+            # Cache everything, as PV.get_ctrlvars() and PvUpdater would.
+            pv._args.update((k, v) for k, v in md.items() if k != 'value')
+            pv._last_value = md['value']
+            pv._initialized = True
+        results.append(md)
+
+    return results
+
+
 # Exceptions
 class SnapshotError(Exception):
     """
@@ -197,12 +267,110 @@ class PvStatus(Enum):
         no_value: Returned if value (save_pv) or desired value (restore_pv) for action is not defined.
         equal: Returned if restore value is equal to current PV value (no need to restore).
         type_err: Returned if type of restore value is wrong
+        not_settled: Returned if verification after restore found the PV value different from the restored value.
     """
     access_err = 0
     ok = 1
     no_value = 2
     equal = 3
     type_err = 4
+    not_settled = 5
+
+
+class MacroEngine(object):
+    # Max number of memoized results. Engines are shared and live as long
+    # as the program, so the memo is cleared when it grows larger.
+    memo_size = 1 << 18
+
+    def __init__(self, macros):
+        """
+        Substitutes macros (defined as {macro: value}) in strings. Macro
+        references are built once, results are memoized per string, and many
+        strings can be substituted at once (see substitute_many()). Use
+        MacroEngine.get() to share engines between users of the same macros.
+
+        :param macros: Dictionary with {macro: value} pairs.
+
+        :return:
+        """
+        self._tokens = [("$(" + key + ")", value)
+                        for key, value in macros.items()]
+        self._memo = dict()
+        # Bulk substitution joins strings with newlines, which is only the
+        # same as substituting each of them if no macro contains one.
+        self._joinable = not any('\n' in token or '\n' in value
+                                 for token, value in self._tokens)
+
+    @staticmethod
+    def get(macros):
+        """
+        :param macros: Dictionary with {macro: value} pairs.
+
+        :return: A shared MacroEngine for these macros.
+        """
+        return _macro_engine(tuple(macros.items()))
+
+    def substitute(self, txt: str):
+        """
+        :param txt: String with macros.
+
+        :return: txt with replaced macros.
+        """
+        result = self._memo.get(txt)
+        if result is None:
+            result = self._substitute(txt)
+            if len(self._memo) >= self.memo_size:
+                self._memo = dict()
+            self._memo[txt] = result
+        return result
+
+    def substitute_many(self, txts):
+        """
+        Substitute macros in many strings. Strings which were not substituted
+        before are joined into one, so each macro is replaced in a single
+        pass over all of them.
+
+        :param txts: Iterable of strings with macros.
+
+        :return: List of strings with replaced macros.
+        """
+        txts = txts if isinstance(txts, list) else list(txts)
+        if not self._tokens:
+            return txts
+
+        memo = self._memo
+        new = [txt for txt in dict.fromkeys(txts) if txt not in memo]
+        if not new:
+            return [memo[txt] for txt in txts]
+
+        results = None
+        if self._joinable and not any('\n' in txt for txt in new):
+            results = self._substitute('\n'.join(new)).split('\n')
+            if len(results) != len(new):
+                # Cannot happen unless a newline was introduced, but then
+                # results would be assigned to the wrong strings.
+                results = None
+        if results is None:
+            results = [self._substitute(txt) for txt in new]
+        results = dict(zip(new, results))
+        if len(memo) + len(results) <= self.memo_size:
+            memo.update(results)
+        else:
+            self._memo = results
+        return [results[txt] if txt in results else memo[txt]
+                for txt in txts]
+
+    def _substitute(self, txt):
+        if '$(' in txt:
+            for token, value in self._tokens:
+                txt = txt.replace(token, value)
+        return txt
+
+
+@lru_cache(maxsize=64)
+def _macro_engine(macros_items):
+    return MacroEngine(dict(macros_items))
+
 
 # Subclass PV to be to later add info if needed
 class SnapshotPv(PV):
@@ -273,25 +441,31 @@ class SnapshotPv(PV):
                         return None
 
                 val = PV.get(self, *args, **kwargs)
+                return self._uniform_value(val, kwargs.get('as_numpy', True))
 
-                # pyepics is inconsistent with regard to one-element arrays;
-                # see _internal_cnct_callback() for explanation. Moreover, it
-                # will return string arrays as lists. To keep everything
-                # uniform, we convert all lists to ndarrays.
-                if val is not None and self.is_array:
-                    if numpy.size(val) == 0:
-                        val = None
-                    elif (numpy.size(val) == 1 and
-                          kwargs.get('as_numpy', True) and
-                          not isinstance(val, numpy.ndarray)):
-                        val = numpy.asarray([val])
-                    elif (kwargs.get('as_numpy', True) and
-                          not isinstance(val, numpy.ndarray)):
-                        val = numpy.asarray(val)
+        return self.value
 
-                return val
+    def _uniform_value(self, val, as_numpy=True):
+        """
+        pyepics is inconsistent with regard to one-element arrays; see
+        _internal_cnct_callback() for explanation. Moreover, it will return
+        string arrays as lists. To keep everything uniform, we convert all
+        lists to ndarrays.
 
-        return self.value
+        :param val: Value as returned by pyepics.
+        :param as_numpy: If False, lists are not converted.
+
+        :return: Converted value.
+        """
+        if val is not None and self.is_array:
+            if numpy.size(val) == 0:
+                val = None
+            elif (numpy.size(val) == 1 and as_numpy and
+                  not isinstance(val, numpy.ndarray)):
+                val = numpy.asarray([val])
+            elif as_numpy and not isinstance(val, numpy.ndarray):
+                val = numpy.asarray(val)
+        return val
 
     def save_pv(self):
         """
@@ -412,7 +586,7 @@ class SnapshotPv(PV):
         :param value2: Value to be compared to value1.
         :param tolerance: Comparison is done as |v1 - v2| <= tolerance
 
-        :return: Result of comparison.
+        :return: Result of comparison. Arrays of different lengths are not equal.
         """
 
         if value1 is None or value2 is None:
@@ -426,9 +600,48 @@ class SnapshotPv(PV):
             except TypeError:
                 # Non-numeric array (i.e. strings)
                 return numpy.array_equal(value1, value2)
+            except ValueError:
+                # Shapes cannot be broadcast, e.g. a waveform whose number
+                # of elements changed.
+                return False
         else:
             return value1 == value2
 
+    @staticmethod
+    def compare_many(values1, values2, tolerance):
+        """
+        Vectorized version of compare() for many pairs of values. Pairs of
+        floats (the vast majority of PVs) are compared in one numpy operation,
+        other pairs are compared one by one with compare().
+
+        :param values1: Sequence of values.
+        :param values2: Sequence of values, same length as values1.
+        :param tolerance: A number or a sequence of numbers, one per pair.
+
+        :return: Numpy array of comparison results.
+        """
+        n = len(values1)
+        tolerance = numpy.broadcast_to(numpy.asarray(tolerance, dtype=float),
+                                       (n,))
+        result = numpy.zeros(n, dtype=bool)
+
+        floats = list()
+        for i, (v1, v2) in enumerate(zip(values1, values2)):
+            if isinstance(v1, float) and isinstance(v2, float):
+                floats.append(i)
+            else:
+                result[i] = SnapshotPv.compare(v1, v2, tolerance[i])
+
+        if floats:
+            idx = numpy.asarray(floats)
+            v1 = numpy.fromiter((values1[i] for i in floats), float,
+                                len(floats))
+            v2 = numpy.fromiter((values2[i] for i in floats), float,
+                                len(floats))
+            result[idx] = numpy.abs(v1 - v2) <= tolerance[idx]
+
+        return result
+
     def add_conn_callback(self, callback):
         """
         Set connection callback.
@@ -494,10 +707,9 @@ class SnapshotPv(PV):
 
         :return: txt with replaced macros.
         """
-        for key in macros:
-            macro = "$(" + key + ")"
-            txt = txt.replace(macro, macros[key])
-        return txt
+        if not macros or '$(' not in txt:
+            return txt
+        return MacroEngine.get(macros).substitute(txt)
 
 
 class PvUpdater(BackgroundThread):
@@ -506,18 +718,42 @@ class PvUpdater(BackgroundThread):
     cached in the PV objects (see SnapshotPv.value()) and passed to a callback.
     A normal python thread is used instead of a CAThread because a fresh CA
     context is needed.
+
+    By default, all PVs are polled every update_rate seconds and the callback
+    receives a list of values, ordered as the PVs given to set_pvs(). If
+    use_monitors is True, CA monitors are used instead. Incoming values are
+    cached as they arrive, but the callback is called at most once every
+    update_rate seconds, and only with the PVs that changed in the meantime,
+    as a dict {pvname: value}.
     """
     update_rate = 1.0  # seconds
     timeout = 1.0
+    monitor_mask = dbr.DBE_VALUE | dbr.DBE_ALARM
 
-    def __init__(self, callback=lambda: None, **kwargs):
+    def __init__(self, callback=lambda: None, use_monitors=False, **kwargs):
         super().__init__(name='pv_updater', **kwargs)
         self._callback = callback
         self._pvs = []
 
+        # Monitor mode internals. Subscriptions are only created and
+        # cleared in the updater thread, which has the proper CA context.
+        self._use_monitors = use_monitors
+        # {id(pv): (pv, subscription refs)}. Keyed by object, because a PV
+        # can be replaced by a new object with the same name.
+        self._subscriptions = dict()
+        self._unsubscribed = list()  # PVs waiting to be subscribed
+        self._changes = dict()  # {pvname: value} since the last callback
+        self._changes_lock = Lock()
+
     def set_pvs(self, pvs):
         with self._lock:
             self._pvs = list(pvs)
+            if self._use_monitors:
+                # Keep existing subscriptions of PVs that are still needed.
+                self._unsubscribed = [pv for pv in self._pvs
+                                      if id(pv) not in self._subscriptions]
+                with self._changes_lock:
+                    self._changes = dict()
 
     @staticmethod
     def _get_start(pv):
@@ -540,17 +776,8 @@ class PvUpdater(BackgroundThread):
                 if md is None:
                     return None
                 pv._pvget_completer = None
-                val = md['value']
-
-                # Handle arrays. See comment in SnapshotPv.get()
-                if val is not None and pv.is_array:
-                    if numpy.size(val) == 0:
-                        val = None
-                    elif (numpy.size(val) == 1 and
-                          not isinstance(val, numpy.ndarray)):
-                        val = numpy.asarray([val])
-                    elif not(isinstance(val, numpy.ndarray)):
-                        val = numpy.asarray(val)
+                # Handle arrays. See comment in SnapshotPv._uniform_value()
+                val = pv._uniform_value(md['value'])
 
                 pv._last_value = val
                 return val
@@ -568,7 +795,71 @@ class PvUpdater(BackgroundThread):
 
     def _run(self):
         ca.use_initial_context()
-        self._periodic_loop(self.update_rate, self._task)
+        if self._use_monitors:
+            self._periodic_loop(self.update_rate, self._monitor_task)
+        else:
+            self._periodic_loop(self.update_rate, self._task)
+        self._clear_subscriptions(list(self._subscriptions.keys()))
+
+    def _on_monitor(self, pv, value=None, **kw):
+        # Called from CA threads. Only cache the value and remember the
+        # change, delivery is done in _monitor_task().
+        if id(pv) not in self._subscriptions:
+            # Subscription is being cleared
+            return
+        value = pv._uniform_value(value)
+        pv._last_value = value
+        with self._changes_lock:
+            self._changes[pv.pvname] = value
+
+    def _clear_subscriptions(self, keys):
+        for key in keys:
+            _, sub = self._subscriptions.pop(key)
+            if sub is None:
+                continue
+            try:
+                ca.clear_subscription(sub[2])
+            except ca.ChannelAccessException:
+                pass
+
+    def _monitor_task(self):
+        current = set(id(pv) for pv in self._pvs)
+        self._clear_subscriptions([key for key in self._subscriptions
+                                   if key not in current])
+
+        # Subscribe to PVs that connected since the last time. Their ctrl
+        # metadata are fetched in one batch, as the GUI will need them.
+        connected = [pv for pv in self._unsubscribed if pv.connected]
+        if connected:
+            self._unsubscribed = [pv for pv in self._unsubscribed
+                                  if not pv.connected]
+            get_pvs_with_metadata([pv for pv in connected
+                                   if not pv._initialized],
+                                  timeout=self.timeout)
+            for pv in connected:
+                # Register before subscribing, the initial value can arrive
+                # before create_subscription() returns.
+                self._subscriptions[id(pv)] = (pv, None)
+                try:
+                    sub = ca.create_subscription(
+                        pv.chid, mask=self.monitor_mask,
+                        callback=partial(self._on_monitor, pv))
+                    self._subscriptions[id(pv)] = (pv, sub)
+                except ca.ChannelAccessException:
+                    del self._subscriptions[id(pv)]
+                    self._unsubscribed.append(pv)
+
+        with self._changes_lock:
+            changes = self._changes
+            self._changes = dict()
+        if not changes:
+            return
+
+        self._lock.release()
+        try:
+            self._callback(changes)
+        finally:
+            self._lock.acquire()
 
     def _task(self):
         since_start("Started getting PV values")
@@ -19,8 +19,8 @@ from PyQt5.QtWidgets import QApplication, QHeaderView, QAbstractItemView, \
     QComboBox, QLineEdit, QLabel, QSizePolicy, QWidget, QSpinBox
 
 from ..ca_core import Snapshot
-from ..core import SnapshotPv, PvUpdater, process_record
-from ..parser import parse_from_save_file, save_file_suffix
+from ..core import SnapshotPv, MacroEngine, PvUpdater, process_record
+from ..parser import parse_from_save_file, strip_save_file_suffix
 from .utils import show_snapshot_parse_errors, make_separator
 
 import time
@@ -373,11 +373,13 @@ class SnapshotPvTableView(QTableView):
 
 # Wrap PvUpdater into QObject for threadsafe signalling
 class ModelUpdater(QtCore.QObject, PvUpdater):
-    update_complete = QtCore.pyqtSignal(list)
-    _internal_update = QtCore.pyqtSignal(list)
+    # Carries a list of all values or a dict of changed values, see PvUpdater.
+    update_complete = QtCore.pyqtSignal(object)
+    _internal_update = QtCore.pyqtSignal(object)
 
-    def __init__(self, parent):
-        super().__init__(parent=parent, callback=self._callback)
+    def __init__(self, parent, use_monitors=False):
+        super().__init__(parent=parent, callback=self._callback,
+                         use_monitors=use_monitors)
 
         # Use a blocking connection to throttle the thread.
         self._internal_update.connect(self.update_complete,
@@ -414,7 +416,11 @@ class SnapshotPvTableModel(QtCore.QAbstractTableModel):
         self._headers[PvTableColumns.unit] = 'Unit'
         self._headers[PvTableColumns.value] = 'Current value'
 
-        self._updater = ModelUpdater(self)
+        self._pv_rows = dict()  # {pvname: row}
+
+        self._updater = ModelUpdater(
+            self, use_monitors=parent.common_settings.get('pv_monitoring',
+                                                          False))
         self._updater.update_complete.connect(self._handle_pv_update)
 
         # Tie starting and stopping the worker thread to starting and
@@ -445,6 +451,8 @@ class SnapshotPvTableModel(QtCore.QAbstractTableModel):
             line.disconnect_callbacks()
         self._data = [SnapshotPvTableLine(pv, self._tolerance_f, self)
                       for pv in pvs]
+        self._pv_rows = {line.pvname: row
+                         for row, line in enumerate(self._data)}
         self.endResetModel()
 
     def add_snap_files(self, files: dict):
@@ -462,22 +470,27 @@ class SnapshotPvTableModel(QtCore.QAbstractTableModel):
                                 len(files) + self.columnCount(parent_idx) - 1)
         errors = []
         for file_name, file_data in files.items():
-            pvs_list_full_names, err = \
+            pvs_list, raw_names, err = \
                 self._replace_macros_on_file_data(file_data)
-            if err:
-                errors.append((file_data['file_name'], err))
 
             # To get a proper update, need to go through all existing pvs.
             # Otherwise values of PVs listed in request but not in the saved
             # file are not cleared (value from previous file is seen on the
             # screen)
             prefix = self.parent().common_settings['save_file_prefix']
-            short_name = file_name.lstrip(prefix).rstrip(save_file_suffix)
+            short_name = strip_save_file_suffix(file_name.lstrip(prefix))
             self._headers.append(short_name)
             for pv_line in self._data:
-                pvname = pv_line.pvname
-                pv_data = pvs_list_full_names.get(pvname, {"value": None})
-                pv_line.append_snap_value(pv_data.get("value", None))
+                raw_name = raw_names.get(pv_line.pvname)
+                if raw_name is None:
+                    pv_line.append_snap_value(None)
+                else:
+                    pv_line.append_snap_value(
+                        pvs_list[raw_name].get("value", None))
+
+            # Values are decoded when accessed, so errors are only known now.
+            if err:
+                errors.append((file_data['file_name'], err))
         self.endInsertColumns()
         if errors:
             self.file_parse_errors.emit(errors)
@@ -499,13 +512,16 @@ class SnapshotPvTableModel(QtCore.QAbstractTableModel):
         else:
             macros = file_data["meta_data"].get("macros", dict())
 
-        pvs_list_full_names = dict()  # PVS data mapped to real pvs names (no macros)
-        pvs_list, _, errors = parse_from_save_file(file_data['file_path'])
+        # Only values of PVs that are displayed are decoded.
+        pvs_list, _, errors = parse_from_save_file(file_data['file_path'],
+                                                   lazy=True)
 
-        for pv_name_raw, pv_data in pvs_list.items():
-            pvs_list_full_names[SnapshotPv.macros_substitution(pv_name_raw, macros)] = pv_data
+        # Names in the file mapped to real pvs names (no macros)
+        names_raw = list(pvs_list)
+        raw_names = dict(zip(MacroEngine.get(macros).substitute_many(names_raw),
+                             names_raw))
 
-        return pvs_list_full_names, errors
+        return pvs_list, raw_names, errors
 
     # Reimplementation of parent methods needed for visualization
     def rowCount(self, parent):
@@ -521,6 +537,10 @@ class SnapshotPvTableModel(QtCore.QAbstractTableModel):
             return self._data[index.row()].data[index.column()].get('icon', None)
 
     def _handle_pv_update(self, new_values):
+        if isinstance(new_values, dict):
+            self._handle_pv_changes(new_values)
+            return
+
         for value, line in zip(new_values, self._data):
             # PvUpdater may reconnect faster, so if we are not connected yet,
             # ignore the update.
@@ -529,6 +549,22 @@ class SnapshotPvTableModel(QtCore.QAbstractTableModel):
 
         self._emit_dataChanged()
 
+    def _handle_pv_changes(self, changes):
+        # Monitor mode: only the PVs that changed are passed.
+        rows = list()
+        for pvname, value in changes.items():
+            row = self._pv_rows.get(pvname)
+            if row is None:
+                continue
+            line = self._data[row]
+            if line.conn and line.update_pv_value(value):
+                rows.append(row)
+
+        if rows:
+            self.dataChanged.emit(
+                self.createIndex(min(rows), PvTableColumns.value),
+                self.createIndex(max(rows), self.columnCount() - 1))
+
     def _emit_dataChanged(self):
         # No need to update PV names and units.
         self.dataChanged.emit(self.createIndex(0, PvTableColumns.value),
@@ -4,7 +4,6 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 
-import copy
 import datetime
 import os
 import time
@@ -21,7 +20,8 @@ from PyQt5.QtWidgets import QWidget, QVBoxLayout, QPushButton, QHBoxLayout, \
 from ..ca_core import PvStatus, ActionStatus, SnapshotPv
 from ..core import background_workers, BackgroundThread, since_start
 from ..parser import get_save_files, list_save_files, parse_from_save_file, \
-    save_file_suffix
+    save_file_suffix, update_save_file_catalog, compact_save_file, \
+    delete_save_file
 from .utils import SnapshotKeywordSelectorWidget, SnapshotEditMetadataDialog, \
     DetailedMsgBox, show_snapshot_parse_errors
 
@@ -96,6 +96,9 @@ class FileListScanner(QtCore.QObject, BackgroundThread):
         finally:
             since_start("Finished looking for changes in snapshot files")
             if change_detected:
+                # Parse new files here, in the background, so that
+                # get_save_files() only needs to read them from the catalog.
+                update_save_file_catalog(self._save_dir, self._req_file_name)
                 # This is emitted with lock held, do not use a blocking
                 # connection or it will deadlock.
                 self._internal_sig.emit()
@@ -223,16 +226,13 @@ class SnapshotRestoreWidget(QWidget):
             # Prepare pvs with values to restore
             if file_data:
                 # Ignore parsing errors: the user has already seen them when
-                # when opening the snapshot.
-                pvs_in_file, _, _ = \
-                    parse_from_save_file(file_data['file_path'])
-                pvs_to_restore = copy.copy(pvs_in_file)  # is actually a dict
-                macros = self.snapshot.macros
-
-                if pvs_list is not None:
-                    for pvname in pvs_in_file.keys():
-                        if SnapshotPv.macros_substitution(pvname, macros) not in pvs_list:
-                            pvs_to_restore.pop(pvname, None)  # remove unfiltered pvs
+                # when opening the snapshot. Values are only decoded for the
+                # restored PVs.
+                pvs_to_restore, _, _ = \
+                    parse_from_save_file(file_data['file_path'], lazy=True)
+                # Only the filtered PVs are restored, selection is done by
+                # restore_pvs().
+                selected = set(pvs_list) if pvs_list is not None else None
 
                 force = self.common_settings["force"]
 
@@ -248,7 +248,7 @@ class SnapshotRestoreWidget(QWidget):
                 self.sts_info.set_status("Restoring ...", 0, "orange")
 
                 status, pvs_status = self.snapshot.restore_pvs(pvs_to_restore, callback=self.restore_done_callback,
-                                                               force=force)
+                                                               force=force, selected=selected)
 
                 if status == ActionStatus.no_conn:
                     # Ask user if he wants to force restoring
@@ -259,7 +259,8 @@ class SnapshotRestoreWidget(QWidget):
                     if reply != QMessageBox.No:
                         # Force restore
                         status, pvs_status = self.snapshot.restore_pvs(pvs_to_restore,
-                                                                       callback=self.restore_done_callback, force=True)
+                                                                       callback=self.restore_done_callback, force=True,
+                                                                       selected=selected)
 
                         # If here restore started successfully. Waiting for callbacks.
 
@@ -328,6 +329,13 @@ class SnapshotRestoreWidget(QWidget):
                 status_txt = "Restore error"
                 status_background = "#F06464"
 
+            elif sts == PvStatus.not_settled:
+                error = True
+                msgs.append("WARNING: {}: Restored, but did not settle to the restored value.".format(pvname))
+                msg_times.append(time.time())
+                status_txt = "Restore error"
+                status_background = "#F06464"
+
         self.sts_log.log_msgs(msgs, msg_times)
 
         if not error:
@@ -693,9 +701,13 @@ class SnapshotRestoreFileSelector(QWidget):
                     files.append(symlink_file)
                     paths.append(symlink_path)
 
+                if not self._compact_dependent_files(files, paths):
+                    background_workers.resume()
+                    return
+
                 for selected_file, file_path in zip(files, paths):
                     try:
-                        os.remove(file_path)
+                        delete_save_file(file_path)
                         self.file_list.pop(selected_file)
                         self.pvs = dict()
                         items = self.file_selector.findItems(
@@ -712,6 +724,28 @@ class SnapshotRestoreFileSelector(QWidget):
                 self.files_updated.emit(self.file_list)
                 background_workers.resume()
 
+    def _compact_dependent_files(self, files, paths):
+        # Delta snapshots which reference a file that is about to be deleted
+        # are rewritten as full snapshots, so they stay readable.
+        deleted = {os.path.realpath(path) for path in paths}
+        for file_name, file_data in self.file_list.items():
+            delta_from = file_data['meta_data'].get('delta_from')
+            if not delta_from or file_name in files:
+                continue
+            base_path = os.path.realpath(os.path.join(
+                os.path.dirname(file_data['file_path']), delta_from))
+            if base_path not in deleted:
+                continue
+            err = compact_save_file(file_data['file_path'])
+            if err:
+                warn = f"Snapshot {file_name} references a file to be " \
+                    "deleted, but cannot be rewritten as a full snapshot. " \
+                    "Nothing was deleted.\n" + "\n".join(err)
+                QMessageBox.warning(self, "Warning", warn, QMessageBox.Ok,
+                                    QMessageBox.NoButton)
+                return False
+        return True
+
     def update_file_metadata(self):
         if self.selected_files:
             if len(self.selected_files) == 1:
@@ -230,7 +230,8 @@ class SnapshotSaveWidget(QWidget):
         self.saved.emit()
 
     def update_name(self):
-        name_extension_rb = "{TIMESTAMP}" + save_file_suffix
+        suffix = self.snapshot.save_file_suffix
+        name_extension_rb = "{TIMESTAMP}" + suffix
         self.name_extension = datetime.datetime.fromtimestamp(
             time.time()).strftime('%Y%m%d_%H%M%S')
 
@@ -239,7 +240,7 @@ class SnapshotSaveWidget(QWidget):
 
         self.file_path = os.path.join(self.common_settings["save_dir"],
                                       self.common_settings["save_file_prefix"]
-                                      + self.name_extension + save_file_suffix)
+                                      + self.name_extension + suffix)
         self.file_name_rb.setText(self.common_settings["save_file_prefix"]
                                   + name_extension_rb)
 
@@ -235,11 +235,13 @@ class SnapshotGui(QMainWindow):
             self.common_settings['save_dir'] = os.path.dirname(path)
 
     def init_snapshot(self, req_file_path, req_macros=None):
-        self.snapshot.clear_pvs()
         req_macros = req_macros or {}
         reopen_config = False
         try:
-            self.snapshot = Snapshot(req_file_path, req_macros)
+            # Channels of PVs which are in both request files are kept, the
+            # rest of the old snapshot is cleared.
+            self.snapshot = Snapshot(req_file_path, req_macros,
+                                     previous=self.snapshot)
             self.set_request_file(req_file_path, req_macros)
 
         except (ReqParseError, OSError) as e:
@@ -1,20 +1,44 @@
-from snapshot.core import SnapshotError, SnapshotPv, global_thread_pool, \
-    since_start
+from snapshot.core import SnapshotError, SnapshotPv, MacroEngine, \
+    global_thread_pool, since_start
+from snapshot.catalog import SaveFileCatalog
+from snapshot.blobs import BlobStore
+from snapshot.req_cache import ReqFileCache
+import collections.abc
+import gzip
 import os
 import re
 import json
-import glob
+import mmap
+import shutil
 import numpy
-import time
 import logging
 from itertools import chain
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import Lock, get_ident
 
 
 save_file_suffix = '.snap'
+compressed_save_file_suffix = save_file_suffix + '.gz'
+# All suffixes of save files, longest first
+save_file_suffixes = (compressed_save_file_suffix, save_file_suffix)
+# Size of the buffer when writing save files
+_WRITE_BUFFER_SIZE = 1 << 20
+
+
+_macro_rgx = re.compile(r'\$\(.*?\)')
 
 
 class SnapshotReqFile(object):
-    def __init__(self, path: str, parent=None, macros: dict = None, changeable_macros: list = None):
+    # Cache of parsed request files, None to always parse them.
+    cache = ReqFileCache()
+    # Number of processes among which included files are distributed, 0 or 1
+    # to read all of them in this process.
+    processes = 0
+
+    def __init__(self, path: str, parent=None, macros: dict = None, changeable_macros: list = None, cache=None):
         """
         Class providing parsing methods for request files.
 
@@ -24,6 +48,7 @@ class SnapshotReqFile(object):
         :param changeable_macros: List of "global" macros which can stay unreplaced and will be handled by
                                   Shanpshot object (enables user to change macros on the fly). This macros will be
                                   ignored in error handling.
+        :param cache: ReqFileCache used instead of the one in the class attribute cache.
 
         :return:
         """
@@ -31,6 +56,8 @@ class SnapshotReqFile(object):
             macros = dict()
         if changeable_macros is None:
             changeable_macros = list()
+        if cache is not None:
+            self.cache = cache
 
         self._path = os.path.abspath(path)
         self._parent = parent
@@ -38,51 +65,67 @@ class SnapshotReqFile(object):
         self._c_macros = changeable_macros
 
         if parent:
-            self._trace = '{} [line {}: {}] >> {}'.format(parent._trace, parent._curr_line_n, parent._curr_line,
-                                                          self._path)
-        else:
-            self._trace = self._path
+            # Line of the parent which includes this file, for errors
+            self._parent_line = (parent._curr_line_n, parent._curr_line)
 
         self._curr_line = None
         self._curr_line_n = 0
         self._curr_line_txt = ''
         self._err = list()
+        # (path, mtime_ns, size) of the file before it was read
+        self._stat = None
 
-    def read(self):
+    def read(self, on_batch=None):
         """
         Parse request file and return
           - a list of pv names where changeable_macros are not replaced. ("raw"
             pv names).
           - a dict with metadata from the file.
 
+        PV names can also be received in batches while the rest of the files
+        are still being parsed. The batches are the names from the top-level
+        file and then from each level of included files. If an exception is
+        raised, some batches may have been passed already.
+
         In case of problems raises exceptions.
                 OSError
                 ReqParseError
                     ReqFileFormatError
                     ReqFileInfLoopError
 
+        :param on_batch: If not None, called with each batch of raw pv names,
+                         in order. Together they are the returned list.
+
         :return: (pv_names, metadata).
         """
+        # Only complete trees are cached, i.e. when reading the top-level file.
+        cache = self.cache if self._parent is None else None
+        if cache is not None:
+            cached = cache.get(self._path, self._macros, self._c_macros)
+            if cached is not None:
+                logging.debug(f"Request file {self._path} loaded from cache.")
+                if on_batch is not None:
+                    on_batch(list(cached[0]))
+                return cached
+
         result = self._read_only_self()
         if not isinstance(result, tuple):
             raise result
 
         pvs, metadata, includes = result
-        while includes:
-            results = global_thread_pool.map(lambda f: f._read_only_self(),
-                                             includes)
-            old_includes = includes
-            includes = []
-            for result, inc in zip(results, old_includes):
-                if not isinstance(result, tuple):
-                    raise result
-                new_pvs, new_metadata, new_includes = result
-                if new_metadata:
-                    msg = f"Found metadata in included file {inc._path}; " \
-                        "metadata is only allowed in the top-level file."
-                    raise ReqParseError(msg)
-                pvs += new_pvs
-                includes += new_includes
+        files = [self._stat]
+        if on_batch is not None:
+            on_batch(list(pvs))
+        if self.processes > 1:
+            levels, inc_files, error = _resolve_includes_in_processes(
+                includes, self.processes, on_level=on_batch)
+        else:
+            levels, inc_files, error, _ = _resolve_includes(
+                includes, on_level=on_batch)
+        if error is not None:
+            raise error
+        pvs += chain.from_iterable(levels)
+        files += inc_files
 
         # In the file, machine_params are stored as an array of
         # key-value pairs to preserve order. Here, we can rely on
@@ -103,6 +146,65 @@ class SnapshotReqFile(object):
             raise ReqParseError('Invalid format of machine parameter list, '
                                 'names must not contain space or punctuation.')
 
+        restore_config = metadata.get('restore', dict())
+        if not isinstance(restore_config, dict) or \
+                any(not isinstance(restore_config.get(key, 1), (int, float))
+                    or isinstance(restore_config.get(key, 1), bool)
+                    or restore_config.get(key, 1) <= 0
+                    for key in ('max_in_flight', 'puts_per_second')):
+            raise ReqParseError('Invalid restore configuration, '
+                                '"max_in_flight" and "puts_per_second" must '
+                                'be positive numbers.')
+        if not isinstance(restore_config.get('verify', False), bool):
+            raise ReqParseError('Invalid restore configuration, "verify" must '
+                                'be boolean.')
+
+        if metadata.get('save_format', 'text') not in ('text', 'binary'):
+            raise ReqParseError('Invalid save format, must be "text" or '
+                                '"binary".')
+
+        blob_store = metadata.get('blob_store', None)
+        if blob_store is not None:
+            min_bytes = blob_store.get('min_bytes',
+                                       BlobStore.default_min_bytes) \
+                if isinstance(blob_store, dict) else None
+            if not isinstance(min_bytes, int) or isinstance(min_bytes, bool) \
+                    or min_bytes <= 0:
+                raise ReqParseError('Invalid blob store configuration, must '
+                                    'be a dict with optional positive '
+                                    'integer "min_bytes".')
+
+        compression = metadata.get('compression', None)
+        if compression is not None:
+            if not isinstance(compression, dict) or \
+                    compression.get('codec', 'gzip') != 'gzip':
+                raise ReqParseError('Invalid compression, must be a dict with '
+                                    'codec "gzip".')
+            level = compression.get('level', 6)
+            if not isinstance(level, int) or isinstance(level, bool) \
+                    or not 0 <= level <= 9:
+                raise ReqParseError('Invalid compression, "level" must be an '
+                                    'integer from 0 to 9.')
+
+        try:
+            stages = restore_config.get('stages', [])
+            if not isinstance(stages, list) or \
+                    not all(isinstance(stage, list) and len(stage) == 2 and
+                            all(isinstance(x, str) for x in stage)
+                            for stage in stages):
+                raise ReqParseError
+            for name, pattern in stages:
+                re.compile(pattern)
+            if len(set(name for name, pattern in stages)) != len(stages):
+                raise ReqParseError
+        except Exception:
+            raise ReqParseError('Invalid format of restore stages, must be a '
+                                'list of ["name", "regex"] pairs with unique '
+                                'names.')
+
+        if cache is not None:
+            cache.put(self._path, self._macros, self._c_macros,
+                      list(dict.fromkeys(files)), pvs, metadata)
         return pvs, metadata
 
     def _read_only_self(self):
@@ -117,117 +219,103 @@ class SnapshotReqFile(object):
 
         :return: A tuple (pv_list, metadata, includes_list)
         """
+        return self._expand(_ReqFileTemplate(self._path))
 
-        pvs = list()
-        includes = list()
-
-        try:
-            with open(self._path) as f:
-                file_data = f.read()
-        except OSError as e:
-            return e
+    def _expand(self, template):
+        """
+        Same as _read_only_self(), but from the already tokenized file.
 
-        if file_data.lstrip().startswith('{'):
-            try:
-                md = file_data.lstrip()
-                metadata, end_of_metadata = \
-                    json.JSONDecoder().raw_decode(md)
-            except json.JSONDecodeError:
-                msg = f"{self._path}: Could not parse JSON metadata header."
-                return ReqParseError(msg)
+        :param template: _ReqFileTemplate of this file.
 
-            # Ensure line counts make sense for error reporting.
-            actual_data = md[end_of_metadata:].lstrip()
-            actual_data_index = file_data.find(actual_data)
-            self._curr_line_n = len(file_data[:actual_data_index]
-                                    .splitlines())
-            file_data = file_data[actual_data_index:]
-        else:
-            metadata = {}
-            self._curr_line_n = 0
-
-        for self._curr_line in file_data.splitlines():
-            self._curr_line_n += 1
-            self._curr_line = self._curr_line.strip()
-
-            # skip comments, empty lines and "data{}" stuff
-            if not self._curr_line.startswith(('#', "data{", "}", "!")) \
-               and self._curr_line.strip():
-                # First replace macros, then check if any unreplaced macros
-                # which are not "global"
-                pvname = SnapshotPv.macros_substitution(
-                    (self._curr_line.rstrip().split(',', maxsplit=1)[0]),
-                    self._macros)
+        :return: A tuple (pv_list, metadata, includes_list) or an exception.
+        """
+        if template.error is not None:
+            return template.error
+        self._stat = template.stat
 
+        macro_engine = MacroEngine.get(self._macros)
+        includes = list()
+        error = None
+        with_macros = template.with_macros
+        for line_n, line in template.includes:
+            # Calling another req file
+            result = self._parse_include(line_n, line, macro_engine)
+            if isinstance(result, Exception):
+                # Lines after the error are not parsed.
+                error = result
+                with_macros = [entry for entry in with_macros
+                               if entry[1] < line_n]
+                break
+            includes.append(result)
+
+        pvs = list(template.names)
+        if with_macros:
+            # First replace macros, then check if any unreplaced macros
+            # which are not "global". All of these lines precede the line
+            # with an error in an include, so their errors take precedence.
+            pvnames = macro_engine.substitute_many(
+                [pvs[i] for i, _, _ in with_macros])
+            for (i, line_n, line), pvname in zip(with_macros, pvnames):
+                pvs[i] = pvname
                 try:
                     # Check if any unreplaced macros
                     self._validate_macros_in_txt(pvname)
                 except MacroError as e:
-                    return ReqParseError(self._format_err(
-                        (self._curr_line_n, self._curr_line), e))
-
-                pvs.append(pvname)
-
-            elif self._curr_line.startswith('!'):
-                # Calling another req file
-                split_line = self._curr_line[1:].split(',', maxsplit=1)
-
-                if len(split_line) > 1:
-                    macro_txt = split_line[1].strip()
-                    if not macro_txt.startswith(('\"', '\'')):
-                        return ReqFileFormatError(
-                            self._format_err(
-                                (self._curr_line_n, self._curr_line),
-                                'Syntax error. Macro argument must be quoted'))
-                    else:
-                        quote_type = macro_txt[0]
-
-                    if not macro_txt.endswith(quote_type):
-                        return ReqFileFormatError(
-                            self._format_err(
-                                (self._curr_line_n, self._curr_line),
-                                'Syntax error. Macro argument must be quoted'))
-
-                    macro_txt = SnapshotPv.macros_substitution(
-                        macro_txt[1:-1], self._macros)
-                    try:
-                        # Check for any unreplaced macros
-                        self._validate_macros_in_txt(macro_txt)
-                        macros = parse_macros(macro_txt)
-
-                    except MacroError as e:
-                        return ReqParseError(
-                            self._format_err(
-                                (self._curr_line_n, self._curr_line), e))
+                    return ReqParseError(self._format_err((line_n, line), e))
+
+        if error is not None:
+            return error
+        return (pvs, template.metadata, includes)
+
+    def _parse_include(self, line_n, line, macro_engine):
+        # Returns SnapshotReqFile of the included file or an exception.
+        split_line = line[1:].split(',', maxsplit=1)
+
+        if len(split_line) > 1:
+            macro_txt = split_line[1].strip()
+            if not macro_txt.startswith(('\"', '\'')) or \
+                    not macro_txt.endswith(macro_txt[0]):
+                return ReqFileFormatError(
+                    self._format_err(
+                        (line_n, line),
+                        'Syntax error. Macro argument must be quoted'))
+
+            macro_txt = macro_engine.substitute(macro_txt[1:-1])
+            try:
+                # Check for any unreplaced macros
+                self._validate_macros_in_txt(macro_txt)
+                macros = parse_macros(macro_txt)
 
-                else:
-                    macros = dict()
+            except MacroError as e:
+                return ReqParseError(self._format_err((line_n, line), e))
 
-                path = os.path.join(os.path.dirname(self._path), split_line[0])
-                msg = self._check_looping(path)
-                if msg:
-                    return ReqFileInfLoopError(
-                        self._format_err(
-                            (self._curr_line_n, self._curr_line), msg))
+        else:
+            macros = dict()
 
-                try:
-                    sub_f = SnapshotReqFile(path, parent=self, macros=macros)
-                    includes.append(sub_f)
+        path = os.path.join(os.path.dirname(self._path), split_line[0])
+        msg = self._check_looping(path)
+        if msg:
+            return ReqFileInfLoopError(self._format_err((line_n, line), msg))
 
-                except OSError as e:
-                    return OSError(
-                        self._format_err(
-                            (self._curr_line, self._curr_line_n), e))
+        # The line of the parent is part of the error trace of the included
+        # file.
+        self._curr_line_n = line_n
+        self._curr_line = line
+        return SnapshotReqFile(path, parent=self, macros=macros)
 
-        return (pvs, metadata, includes)
+    @property
+    def _trace(self):
+        # Built only when needed for an error message.
+        if self._parent is None:
+            return self._path
+        return '{} [line {}: {}] >> {}'.format(self._parent._trace, *self._parent_line, self._path)
 
     def _format_err(self, line: tuple, msg: str):
         return '{} [line {}: {}]: {}'.format(self._trace, line[0], line[1], msg)
 
     def _validate_macros_in_txt(self, txt: str):
         invalid_macros = list()
-        macro_rgx = re.compile('\$\(.*?\)')  # find all of type $()
-        raw_macros = macro_rgx.findall(txt)
+        raw_macros = _macro_rgx.findall(txt)  # find all of type $()
         for raw_macro in raw_macros:
             if raw_macro not in self._macros.values() and raw_macro[2:-1] not in self._c_macros:
                 # There are unknown macros which were not substituted
@@ -253,6 +341,202 @@ class SnapshotReqFile(object):
                 ancestor = ancestor._parent
 
 
+def _resolve_includes(includes, stop_at=None, on_level=None):
+    """
+    Read included files and the files they include, breadth first. Each
+    distinct file is read and tokenized once, even if it is included many
+    times with different macros.
+
+    :param includes: List of SnapshotReqFile of included files, in order.
+    :param stop_at: If not None, stop as soon as the next level has at least
+                    this many files.
+    :param on_level: If not None, called with the PV names of each level
+                     when it was read without errors.
+
+    :return: (levels, files, error, includes), where levels is a list of
+             lists of PV names, one per level of includes, files is a list
+             of (path, mtime_ns, size) of the read files, error is the first
+             exception (or None), and includes is the list of files of the
+             next level that were not read because of stop_at.
+    """
+    levels = list()
+    files = list()
+    templates = dict()
+    while includes and (stop_at is None or len(includes) < stop_at):
+        paths = list(dict.fromkeys(inc._path for inc in includes
+                                   if inc._path not in templates))
+        templates.update(zip(paths, global_thread_pool.map(
+            _ReqFileTemplate, paths)))
+        old_includes = includes
+        includes = []
+        pvs = []
+        for inc in old_includes:
+            result = inc._expand(templates[inc._path])
+            if not isinstance(result, tuple):
+                return levels, files, result, []
+            new_pvs, new_metadata, new_includes = result
+            if new_metadata:
+                msg = f"Found metadata in included file {inc._path}; " \
+                    "metadata is only allowed in the top-level file."
+                return levels, files, ReqParseError(msg), []
+            pvs += new_pvs
+            includes += new_includes
+            files.append(inc._stat)
+        levels.append(pvs)
+        if on_level is not None:
+            on_level(pvs)
+    return levels, files, None, includes
+
+
+_process_pool = (0, None)
+_process_pool_lock = Lock()
+
+
+def _resolve_includes_in_processes(includes, processes, on_level=None):
+    """
+    Same as _resolve_includes(), but with the include tree split among
+    processes. Includes are read in this process until there are enough
+    files on one level, then the level is split into consecutive chunks
+    whose subtrees are read in parallel. Merging the levels of subtrees in
+    the order of chunks gives the same order as reading the whole tree, and
+    the first error in that order is returned.
+
+    :param includes: List of SnapshotReqFile of included files, in order.
+    :param processes: Number of processes.
+    :param on_level: See _resolve_includes().
+
+    :return: (levels, files, error)
+    """
+    global _process_pool
+    n_chunks = processes * 4
+    levels, files, error, includes = _resolve_includes(includes, n_chunks,
+                                                       on_level)
+    if error is not None or not includes:
+        return levels, files, error
+
+    chunk_size = -(-len(includes) // n_chunks)
+    chunks = [includes[i:i + chunk_size]
+              for i in range(0, len(includes), chunk_size)]
+    with _process_pool_lock:
+        if _process_pool[0] != processes:
+            if _process_pool[1] is not None:
+                _process_pool[1].shutdown(wait=False)
+            # Not forked, because this process has threads (e.g. of CA).
+            _process_pool = (processes, ProcessPoolExecutor(
+                processes, mp_context=get_context('spawn')))
+        pool = _process_pool[1]
+    try:
+        results = list(pool.map(_resolve_includes, chunks))
+    except BrokenProcessPool as e:
+        logging.warning(f"Cannot read request files in processes: {e}")
+        with _process_pool_lock:
+            if _process_pool[1] is pool:
+                _process_pool = (0, None)
+        sub_levels, sub_files, error, _ = _resolve_includes(
+            includes, on_level=on_level)
+        return levels + sub_levels, files + sub_files, error
+
+    # Errors on an earlier level are encountered first.
+    errors = [(len(sub_levels), error) for sub_levels, _, error, _ in results
+              if error is not None]
+    if errors:
+        error_level, error = min(errors, key=lambda x: x[0])
+    else:
+        error_level = None
+
+    sub_levels = list()
+    for chunk_levels, chunk_files, _, _ in results:
+        for i, pvs in enumerate(chunk_levels):
+            if i == len(sub_levels):
+                sub_levels.append(list())
+            sub_levels[i] += pvs
+        files += chunk_files
+    if error_level is not None:
+        sub_levels = sub_levels[:error_level]
+    if on_level is not None:
+        for pvs in sub_levels:
+            on_level(pvs)
+    return levels + sub_levels, files, error
+
+
+class _ReqFileTemplate(object):
+    def __init__(self, path):
+        """
+        A request file read and split into lines of each kind, before macros
+        are substituted, so that it can be expanded with different macros.
+        If the file cannot be read or its metadata cannot be decoded, error is
+        the exception to be returned by SnapshotReqFile._read_only_self().
+
+        :param path: Absolute path of the request file.
+
+        :return:
+        """
+        self.error = None
+        self.stat = None
+        self.metadata = dict()
+        # PV names as in the file
+        self.names = list()
+        # (index in names, line number, line) of names with macros
+        self.with_macros = list()
+        # (line number, line) of lines which include other files
+        self.includes = list()
+
+        try:
+            with open(path) as f:
+                # Stat before reading, so that a concurrent modification
+                # invalidates the cached result.
+                stat = os.fstat(f.fileno())
+                self.stat = (path, stat.st_mtime_ns, stat.st_size)
+                file_data = f.read()
+        except OSError as e:
+            self.error = e
+            return
+        except UnicodeDecodeError:
+            # E.g. a compressed or binary save file
+            self.error = ReqParseError(f"{path}: Not a text file.")
+            return
+
+        if file_data.lstrip().startswith('{'):
+            try:
+                md = file_data.lstrip()
+                self.metadata, end_of_metadata = \
+                    json.JSONDecoder().raw_decode(md)
+            except json.JSONDecodeError:
+                msg = f"{path}: Could not parse JSON metadata header."
+                self.error = ReqParseError(msg)
+                return
+
+            # Ensure line counts make sense for error reporting.
+            actual_data = md[end_of_metadata:].lstrip()
+            actual_data_index = file_data.find(actual_data)
+            first_line_n = len(file_data[:actual_data_index].splitlines())
+            file_data = file_data[actual_data_index:]
+        else:
+            first_line_n = 0
+
+        # Each line is classified by its first character. Lines are only
+        # formatted for errors.
+        names = self.names
+        for line_n, line in enumerate(file_data.splitlines(),
+                                      start=first_line_n + 1):
+            line = line.strip()
+            if not line:
+                continue
+            first = line[0]
+            if first == '#' or first == '}' or line.startswith('data{'):
+                # skip comments, empty lines and "data{}" stuff
+                continue
+
+            if first == '!':
+                self.includes.append((line_n, line))
+                continue
+
+            pvname = line.partition(',')[0]
+            if '$(' in pvname:
+                self.with_macros.append((len(names), line_n, line))
+            names.append(pvname)
+
+
 # Helper functions functions to support macros parsing for users of this lib
 def parse_macros(macros_str):
     """
@@ -309,7 +593,7 @@ class ReqFileInfLoopError(ReqParseError):
 def initialize_config(config_path=None, save_dir=None, force=False,
                       default_labels=None, force_default_labels=None,
                       req_file_path=None, req_file_macros=None,
-                      init_path=None, **kwargs):
+                      init_path=None, pv_monitoring=False, **kwargs):
     """
     Settings are a dictionary which holds common configuration of
     the application (such as directory with save files, request file
@@ -324,6 +608,8 @@ def initialize_config(config_path=None, save_dir=None, force=False,
     :param req_file_macros: macros can be as dict (key, value pairs)
                             or a string in format A=B,C=D
     :param init_path: default path to be shown on the file selector
+    :param pv_monitoring: use CA monitors instead of periodic polling to
+                          update PV values
     """
     config = {'config_ok': True, 'macros_ok': True}
     if config_path:
@@ -347,6 +633,7 @@ def initialize_config(config_path=None, save_dir=None, force=False,
     config['req_file_macros'] = dict()
     config['existing_labels'] = list()  # labels that are already in snap files
     config['force'] = force
+    config['pv_monitoring'] = pv_monitoring
     config['init_path'] = init_path if init_path else ''
 
     if isinstance(default_labels, str):
@@ -397,11 +684,19 @@ def initialize_config(config_path=None, save_dir=None, force=False,
     return config
 
 
-def parse_from_save_file(save_file_path, metadata_only=False):
+def parse_from_save_file(save_file_path, metadata_only=False, names=None,
+                         lazy=False):
     """
     Parses save file to dict {'pvname': {'data': {'value': <value>, 'raw_name': <name_with_macros>}}}
 
     :param save_file_path: Path to save file.
+    :param metadata_only: Only parse metadata, saved_pvs will be empty.
+    :param names: If given, only PVs with these names (as in the file, i.e.
+                  with macros) are decoded and returned.
+    :param lazy: If True, saved_pvs is a SaveFileData, which decodes each
+                 value when it is first accessed. Errors in values are
+                 appended to err when the values are decoded. Arrays of
+                 binary files are only read when they are accessed.
 
     :return: (saved_pvs, meta_data, err)
 
@@ -410,20 +705,61 @@ def parse_from_save_file(save_file_path, metadata_only=False):
         meta_data: as dictionary
 
         err: list of strings (each entry one error)
+
+    If the file is a delta snapshot (see delta_save_data()), saved_pvs is the
+    full snapshot, reconstructed through the chain of reference files. In
+    that case saved_pvs is always a dict, even if lazy is True.
     """
+    saved_pvs, meta_data, err = _parse_single_save_file(
+        save_file_path, metadata_only, names, lazy)
+    if metadata_only or 'delta_from' not in meta_data:
+        return saved_pvs, meta_data, err
+
+    if isinstance(saved_pvs, SaveFileData):
+        # Delta files are small, just decode everything.
+        saved_pvs.decode(list(saved_pvs))
+    base_pvs, base_err = _load_full_save_file(
+        _delta_base_path(save_file_path, meta_data))
+    err.extend(base_err)
+    saved_pvs = _apply_delta(base_pvs, saved_pvs, meta_data)
+    if names is not None:
+        saved_pvs = {pvname: saved_pvs[pvname] for pvname in names
+                     if pvname in saved_pvs}
+    return saved_pvs, meta_data, err
+
 
-    saved_pvs = dict()
+def _parse_single_save_file(save_file_path, metadata_only=False, names=None,
+                            lazy=False):
+    # Parses one file as it is, without following the delta reference.
+    if is_binary_save_file(save_file_path):
+        saved_pvs, meta_data, err = _parse_from_binary_save_file(
+            save_file_path, metadata_only, names, lazy)
+        _upgrade_machine_params(meta_data)
+        return saved_pvs, meta_data, err
+
+    payloads = dict()
     meta_data = dict()  # If macros were used they will be saved in meta_data
     err = list()
     meta_loaded = False
 
     try:
-        saved_file = open(save_file_path)
+        saved_file = _open_text_save_file(save_file_path)
     except OSError:
         err.append("File cannot be opened for reading.")
-        return saved_pvs, meta_data, err
+        return dict(), meta_data, err
 
-    for line in saved_file:
+    # Only split names from values here. Values are decoded by SaveFileData.
+    # When reading metadata only, a compressed file is only decompressed up
+    # to the metadata line.
+    try:
+        lines = list(_read_save_file_lines(saved_file, metadata_only))
+    except (OSError, EOFError, UnicodeDecodeError):
+        # Corrupted compressed file
+        saved_file.close()
+        err.append("File cannot be opened for reading.")
+        return dict(), meta_data, err
+
+    for line in lines:
         # first line with # is metadata (as json dump of dict)
         if line.startswith('#') and not meta_loaded:
             line = line[1:]
@@ -437,65 +773,721 @@ def parse_from_save_file(save_file_path, metadata_only=False):
             if metadata_only:
                 break
         # skip empty lines and all rest with #
-        elif (not metadata_only
-                and line.strip()
-                and not line.startswith('#')):
+        elif not metadata_only and not line.startswith('#'):
+            line = line.strip()
+            if line:
+                pvname, sep, payload = line.partition(',')
+                payloads[pvname] = payload if sep else None
+
+    if not meta_loaded:
+        err.insert(0, 'No meta data in the file.')
+    else:
+        _upgrade_machine_params(meta_data)
+
+    saved_file.close()
+
+    saved_pvs = SaveFileData(payloads, err, BlobStore(
+        os.path.dirname(os.path.abspath(save_file_path))))
+    if lazy:
+        return saved_pvs, meta_data, err
+    if names is None:
+        names = list(payloads)
+    else:
+        names = [pvname for pvname in names if pvname in payloads]
+    saved_pvs.decode(names)
+    return saved_pvs.decoded(names), meta_data, err
+
+
+# Full snapshots reconstructed from delta files, keyed by (path, mtime_ns,
+# size) of the file. Consecutive delta files usually share a reference, so a
+# few entries are enough.
+_delta_base_cache = OrderedDict()
+_delta_base_cache_size = 8
+_delta_base_cache_lock = Lock()
+
+
+def delta_save_data(pvs, reference_pvs, tolerance):
+    """
+    Select PVs to be stored in a delta snapshot.
+
+    :param pvs: Dict with pvs data to be saved, as for parse_to_save_file().
+    :param reference_pvs: Saved PVs of the reference snapshot, as returned by
+                          parse_from_save_file().
+    :param tolerance: Called as tolerance(data) with the data of a PV from
+                      pvs. Values closer than that to the reference value are
+                      not stored.
+
+    :return: (delta_pvs, removed)
+
+        delta_pvs: The subset of pvs which differs from the reference.
+
+        removed: Names (with macros) of PVs which are in the reference, but
+        not in pvs.
+    """
+    common = [pvname for pvname, data in pvs.items()
+              if data.get('raw_name') in reference_pvs]
+    equal = SnapshotPv.compare_many(
+        [pvs[pvname].get('val') for pvname in common],
+        [reference_pvs[pvs[pvname]['raw_name']]['value']
+         for pvname in common],
+        [tolerance(pvs[pvname]) for pvname in common])
+    unchanged = {pvname for pvname, eq in zip(common, equal) if eq}
+
+    delta_pvs = {pvname: data for pvname, data in pvs.items()
+                 if pvname not in unchanged}
+    raw_names = {data.get('raw_name') for data in pvs.values()}
+    removed = [pvname for pvname in reference_pvs
+               if pvname not in raw_names]
+    return delta_pvs, removed
+
+
+def _delta_base_path(save_file_path, meta_data):
+    # The reference is stored relative to the directory of the delta file.
+    return os.path.realpath(
+        os.path.join(os.path.dirname(os.path.abspath(save_file_path)),
+                     meta_data['delta_from']))
+
+
+def _apply_delta(base_pvs, delta_pvs, meta_data):
+    removed = set(meta_data.get('delta_removed', ()))
+    saved_pvs = {pvname: data for pvname, data in base_pvs.items()
+                 if pvname not in removed}
+    saved_pvs.update(delta_pvs)
+    return saved_pvs
+
+
+def _load_full_save_file(save_file_path):
+    # Returns (saved_pvs, err) of the full snapshot. The chain of delta files
+    # is followed back to a full file or to a cached snapshot, and then
+    # applied forward, so long chains do not need recursion.
+    deltas = list()
+    visited = set()
+    path = os.path.realpath(save_file_path)
+    while True:
+        if path in visited:
+            base = (dict(), ["Delta snapshot files reference each other in "
+                             "a loop."])
+            break
+        visited.add(path)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            base = (dict(), [f"Reference snapshot file "
+                             f"{os.path.basename(path)} cannot be opened "
+                             "for reading."])
+            break
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with _delta_base_cache_lock:
+            base = _delta_base_cache.get(key)
+            if base is not None:
+                _delta_base_cache.move_to_end(key)
+                break
+
+        saved_pvs, meta_data, err = _parse_single_save_file(path)
+        if 'delta_from' not in meta_data:
+            base = (saved_pvs, err)
+            _cache_full_save_file(key, base)
+            break
+        deltas.append((key, saved_pvs, meta_data, err))
+        path = _delta_base_path(path, meta_data)
+
+    saved_pvs, err = base
+    for key, delta_pvs, meta_data, delta_err in reversed(deltas):
+        saved_pvs = _apply_delta(saved_pvs, delta_pvs, meta_data)
+        err = err + delta_err
+        _cache_full_save_file(key, (saved_pvs, err))
+    return saved_pvs, list(err)
+
+
+def _cache_full_save_file(key, full):
+    with _delta_base_cache_lock:
+        _delta_base_cache[key] = full
+        while len(_delta_base_cache) > _delta_base_cache_size:
+            _delta_base_cache.popitem(last=False)
+
+
+def compact_save_file(save_file_path):
+    """
+    Rewrite a delta snapshot file as a full snapshot file, in the same
+    format. Files which reference it are not affected. Units and precision of
+    PVs, which are only stored for information, are not kept.
+
+    :param save_file_path: Path to save file.
+
+    :return: List of errors. If not empty, the file was not changed.
+    """
+    saved_pvs, meta_data, err = parse_from_save_file(save_file_path)
+    if err or 'delta_from' not in meta_data:
+        return err
+
+    meta_data = {key: value for key, value in meta_data.items()
+                 if key not in ('delta_from', 'delta_removed')}
+    pvs = {pvname: {'raw_name': pvname, 'val': data['value']}
+           for pvname, data in saved_pvs.items()}
+    compresslevel = _save_file_compresslevel(save_file_path)
+    compression = None if compresslevel is None \
+        else {'codec': 'gzip', 'level': compresslevel}
+    blobs = BlobStore(os.path.dirname(os.path.abspath(save_file_path)))
+    parse_to_save_file(pvs, save_file_path,
+                       save_format='binary'
+                       if is_binary_save_file(save_file_path) else 'text',
+                       compression=compression,
+                       blob_store=blobs if blobs.exists() else None,
+                       **meta_data)
+    return list()
+
+
+class SaveFileData(collections.abc.Mapping):
+    def __init__(self, payloads, errors, blobs=None):
+        """
+        Read-only mapping {'pvname': {'value': <value>}} of PVs in a text save
+        file, as returned by parse_from_save_file(lazy=True). Values are
+        decoded when first accessed, so the cost is proportional to the number
+        of accessed PVs.
+
+        :param payloads: Dict {'pvname': undecoded value from the file or
+                         None}.
+        :param errors: List to which decoding errors are appended.
+        :param blobs: BlobStore from which values stored as blobs are loaded.
+
+        :return:
+        """
+        self._payloads = payloads
+        self._decoded = dict()
+        self.errors = errors
+        self.blobs = blobs
+
+    def __getitem__(self, pvname):
+        data = self._decoded.get(pvname)
+        if data is None:
+            data = {'value': _decode_save_file_value(
+                pvname, self._payloads[pvname], self.errors, self.blobs)}
+            self._decoded[pvname] = data
+        return data
+
+    def __contains__(self, pvname):
+        return pvname in self._payloads
+
+    def __iter__(self):
+        return iter(self._payloads)
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def decoded(self, names):
+        """
+        :param names: Names of PVs, which must already be decoded (see
+                      decode()).
+
+        :return: Dict {'pvname': {'value': <value>}} of these PVs.
+        """
+        return {pvname: self._decoded[pvname] for pvname in names}
+
+    def decode(self, names):
+        """
+        Decode values of many PVs at once. Plain scalars of the legacy
+        "name,value" format are decoded with one json.loads() call, other
+        values one by one.
 
-            split_line = line.strip().split(',', 1)
-            pvname = split_line[0]
+        :param names: Names of PVs to decode.
 
+        :return:
+        """
+        decoded = self._decoded
+        payloads = self._payloads
+        scalars = list()
+        for pvname in names:
+            if pvname in decoded:
+                continue
+            payload = payloads[pvname]
+            if payload and payload[0] in '-0123456789NI':
+                scalars.append(pvname)
+            else:
+                decoded[pvname] = {'value': _decode_save_file_value(
+                    pvname, payload, self.errors, self.blobs)}
+
+        if not scalars:
+            return
+
+        # Decode all scalars as one JSON list. This is only safe if no
+        # payload can contain more than one element of the list.
+        joined = ','.join(payloads[pvname] for pvname in scalars)
+        values = None
+        if joined.count(',') == len(scalars) - 1 \
+                and not any(c in joined for c in '"[]{}'):
             try:
-                if len(split_line) < 2:
-                    pv_value = None
-                elif split_line[1].startswith('{'):
-                    # The new JSON value format
-                    data = json.loads(split_line[1])
-                    pv_value = data['val']
-                    # EGU and PREC are ignored, only stored for information.
-                else:
-                    # The legacy "name,value" format
-                    pv_value_str = split_line[1]
-                    pv_value = json.loads(pv_value_str)
+                values = json.loads('[' + joined + ']')
+            except json.JSONDecodeError:
+                # Some are not valid, they are found below.
+                pass
+
+        if values is None:
+            for pvname in scalars:
+                decoded[pvname] = {'value': _decode_save_file_value(
+                    pvname, payloads[pvname], self.errors,
+                    self.blobs)}
+        else:
+            for pvname, value in zip(scalars, values):
+                decoded[pvname] = {'value': value}
+
+
+class _BinarySaveFileData(SaveFileData):
+    def __init__(self, indices, errors, blobs, data, data_start, header):
+        """
+        SaveFileData of a binary save file. Values are decoded from the mapped
+        file when first accessed, the scalar columns in bulk (see decode()).
+        Arrays are copied or mapped (see _MAPPED_ARRAY_MIN_BYTES) only when
+        their PV is accessed.
+
+        :param indices: Dict {'pvname': index of the PV in the file}.
+        :param errors: List to which decoding errors are appended.
+        :param blobs: BlobStore from which values stored as blobs are loaded.
+        :param data: The mapped file.
+        :param data_start: Offset of the data section in the file.
+        :param header: Header of the file.
+
+        :return:
+        """
+        super().__init__(indices, errors, blobs)
+        self._data = data
+        self._data_start = data_start
+        self._n = len(header['names'])
+        self._layout = header['layout']
+        self._arrays = header.get('arrays', {})
+        self._json_values = header.get('values', {})
+        self._blob_refs = header.get('blobs', {})
+        self._mapped = False
+
+    def __getitem__(self, pvname):
+        data = self._decoded.get(pvname)
+        if data is None:
+            self.decode([pvname])
+            data = self._decoded[pvname]
+        return data
+
+    def decode(self, names):
+        """
+        Decode values of many PVs at once. Their elements of the scalar
+        columns are converted in one step.
+
+        :param names: Names of PVs to decode.
 
+        :return:
+        """
+        names = [pvname for pvname in dict.fromkeys(names)
+                 if pvname not in self._decoded]
+        if not names:
+            return
+
+        indices = numpy.fromiter((self._payloads[pvname] for pvname in names),
+                                 numpy.intp, len(names))
+        kinds, floats, ints = (
+            numpy.frombuffer(self._data, dtype, self._n,
+                             self._data_start + self._layout[column])[indices]
+            .tolist() for column, dtype in _binary_columns)
+
+        for pvname, i, kind, float_value, int_value in \
+                zip(names, indices.tolist(), kinds, floats, ints):
+            if kind == _KIND_FLOAT:
+                pv_value = float_value
+            elif kind == _KIND_INT:
+                pv_value = int_value
+            elif kind == _KIND_ARRAY:
+                pv_value = self._array(pvname, i)
+            elif kind == _KIND_JSON:
+                pv_value = self._json_values[str(i)]
                 if isinstance(pv_value, list):
-                    if any(isinstance(x, list) for x in pv_value):
-                        # A version of this tool incorrectly wrote
-                        # one-element arrays, and we shouldn't crash if we
-                        # read such a snapshot.
-                        pv_value = None
-                        err.append(f"Value of '{pvname}' contains nested "
-                                   "lists; only one-dimensional arrays "
-                                   "are supported.")
-                    else:
-                        # arrays as numpy array, because pyepics returns
-                        # as numpy array
-                        pv_value = numpy.asarray(pv_value)
+                    pv_value = numpy.asarray(pv_value)
+            elif kind == _KIND_BLOB:
+                pv_value = _load_blob(pvname, self._blob_refs[str(i)],
+                                      self.blobs, self.errors)
+            else:
+                pv_value = None
+            self._decoded[pvname] = {'value': pv_value}
 
-            except json.JSONDecodeError:
+    def _array(self, pvname, i):
+        dtype, length, offset = self._arrays[str(i)]
+        try:
+            pv_value = numpy.frombuffer(self._data, dtype, length,
+                                        self._data_start + offset)
+        except (TypeError, ValueError):
+            self.errors.append(f"Value of '{pvname}' cannot be decoded, "
+                               "ignored.")
+            return None
+        if _MAPPED_ARRAY_MIN_BYTES is None or \
+                pv_value.nbytes < _MAPPED_ARRAY_MIN_BYTES:
+            return pv_value.copy()
+        self._mapped = True
+        return pv_value
+
+    def close(self):
+        """
+        Close the mapped file. Must only be called when all values are
+        decoded. If some arrays are views into the file, it stays mapped
+        until they are gone.
+
+        :return:
+        """
+        if not self._mapped:
+            self._data.close()
+        self._data = None
+
+
+def _decode_save_file_value(pvname, payload, err, blobs=None):
+    if payload is None:
+        return None
+
+    try:
+        if payload.startswith('{'):
+            # The new JSON value format
+            data = json.loads(payload)
+            pv_value = data['val']
+            # EGU and PREC are ignored, only stored for information.
+            if isinstance(pv_value, dict):
+                return _load_blob(pvname, pv_value.get('$blob'), blobs, err)
+        else:
+            # The legacy "name,value" format
+            pv_value = json.loads(payload)
+
+        if isinstance(pv_value, list):
+            if any(isinstance(x, list) for x in pv_value):
+                # A version of this tool incorrectly wrote
+                # one-element arrays, and we shouldn't crash if we
+                # read such a snapshot.
                 pv_value = None
-                err.append(f"Value of '{pvname}' cannot be decoded, ignored.")
+                err.append(f"Value of '{pvname}' contains nested "
+                           "lists; only one-dimensional arrays "
+                           "are supported.")
+            else:
+                # arrays as numpy array, because pyepics returns
+                # as numpy array
+                pv_value = numpy.asarray(pv_value)
 
-            saved_pvs[pvname] = {'value': pv_value}
+    except json.JSONDecodeError:
+        pv_value = None
+        err.append(f"Value of '{pvname}' cannot be decoded, ignored.")
 
-    if not meta_loaded:
-        err.insert(0, 'No meta data in the file.')
+    return pv_value
+
+
+def _load_blob(pvname, digest, blobs, err):
+    pv_value = blobs.load(digest) \
+        if blobs is not None and isinstance(digest, str) else None
+    if pv_value is None:
+        err.append(f"Value of '{pvname}' is stored in a missing blob, "
+                   "ignored.")
+    return pv_value
+
+
+def _read_save_file_lines(saved_file, metadata_only):
+    for line in saved_file:
+        yield line
+        if metadata_only and line.startswith('#'):
+            break
+
+
+gzip_magic = b'\x1f\x8b'
+
+
+def is_compressed_save_file(save_file_path):
+    """
+    Check if the save file is compressed (gzip).
+
+    :param save_file_path: Path to save file.
+
+    :return: True if compressed, False if not or if the file cannot be read.
+    """
+    try:
+        with open(save_file_path, 'rb') as f:
+            return f.read(len(gzip_magic)) == gzip_magic
+    except OSError:
+        return False
+
+
+def _open_text_save_file(save_file_path, mode='r', compresslevel=None):
+    # For reading, compression is detected from the content. For writing,
+    # compresslevel must be given to compress the file.
+    if mode.startswith('r') and is_compressed_save_file(save_file_path) \
+            or not mode.startswith('r') and compresslevel is not None:
+        return gzip.open(save_file_path, mode + 't',
+                         compresslevel=9 if compresslevel is None
+                         else compresslevel)
+    return open(save_file_path, mode, buffering=_WRITE_BUFFER_SIZE)
+
+
+def _save_file_compresslevel(save_file_path, compression=None):
+    # Level at which a rewritten file is compressed, None if the file is not
+    # compressed. Without configured compression, the level of the file is
+    # kept, as far as it is recorded in the gzip header (the XFL byte only
+    # tells apart the fastest and the best compression).
+    try:
+        with open(save_file_path, 'rb') as f:
+            header = f.read(10)
+    except OSError:
+        return None
+    if header[:len(gzip_magic)] != gzip_magic:
+        return None
+    if compression is not None:
+        return _compresslevel(compression)
+    if len(header) == 10 and header[8] == 2:
+        return 9
+    if len(header) == 10 and header[8] == 4:
+        return 1
+    return 6
+
+
+def strip_save_file_suffix(file_name):
+    """
+    :return: File name without the save file suffix.
+    """
+    for suffix in save_file_suffixes:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return file_name
+
+
+def _upgrade_machine_params(meta_data):
+    # Check that the snapshot has machine parameters with metadata; at some
+    # point, only values were being saved.
+    for p, v in meta_data.get('machine_params', {}).items():
+        if not isinstance(v, dict):
+            meta_data['machine_params'][p] = {
+                'value': v,
+                'units': None,
+                'precision': None
+            }
+
+
+# Binary snapshot format. The file starts with the magic bytes and the length
+# of the JSON header (uint64, little endian), followed by the header and the
+# data section, which starts at an aligned offset. The header contains
+# metadata, the table of PV names (with units and precision) and the layout of
+# the data section: a column of value kinds, a column of float values and a
+# column of integer values (one element per PV), followed by array values in
+# their native dtype. Values that fit nowhere else (strings, ...) are in the
+# header as JSON, and hashes of values stored in a BlobStore are in the header
+# as well. All offsets in the header are relative to the start of the data
+# section.
+binary_save_file_magic = b'SNAPBIN1'
+_BINARY_ALIGNMENT = 16
+_KIND_NONE = 0
+_KIND_FLOAT = 1
+_KIND_INT = 2
+_KIND_ARRAY = 3
+_KIND_JSON = 4
+_KIND_BLOB = 5
+# Values of binary files are decoded when they are accessed (see
+# _BinarySaveFileData). Arrays of at least this size (in bytes) are views into
+# the mapped file and are only read from disk when used. Smaller ones are
+# copied when accessed, so they do not keep the file mapped. On Windows, a
+# mapped file cannot be deleted or replaced, so all values are decoded when
+# the file is parsed and the mapping is closed.
+_MAPPED_ARRAY_MIN_BYTES = None if os.name == 'nt' else 1 << 20
+
+
+# Columns of the data section of binary files, one element per PV
+_binary_columns = (('kinds', numpy.uint8), ('floats', '<f8'), ('ints', '<i8'))
+
+
+def _align(offset):
+    return -(-offset // _BINARY_ALIGNMENT) * _BINARY_ALIGNMENT
+
+
+def is_binary_save_file(save_file_path):
+    """
+    Check if the save file is in the binary format.
+
+    :param save_file_path: Path to save file.
+
+    :return: True if binary, False if not or if the file cannot be read.
+    """
+    try:
+        with open(save_file_path, 'rb') as f:
+            return f.read(len(binary_save_file_magic)) == \
+                binary_save_file_magic
+    except OSError:
+        return False
+
+
+def _read_binary_header(f):
+    # Returns (header, data_start)
+    prefix_len = len(binary_save_file_magic) + 8
+    prefix = f.read(prefix_len)
+    if len(prefix) != prefix_len:
+        raise ValueError('Truncated header')
+    header_len = int.from_bytes(prefix[len(binary_save_file_magic):],
+                                'little')
+    header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, _align(prefix_len + header_len)
+
+
+def _parse_from_binary_save_file(save_file_path, metadata_only, names=None,
+                                 lazy=False):
+    err = list()
+    try:
+        with open(save_file_path, 'rb') as f:
+            header, data_start = _read_binary_header(f)
+            meta_data = header['metadata']
+            if metadata_only:
+                return dict(), meta_data, err
+
+            file_names = header['names']
+            n = len(file_names)
+            if n == 0:
+                return dict(), meta_data, err
+
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Check that the columns are in the file.
+            layout = header['layout']
+            for column, dtype in _binary_columns:
+                numpy.frombuffer(data, dtype, n, data_start + layout[column])
+    except (OSError, ValueError, KeyError, TypeError):
+        # JSONDecodeError and UnicodeDecodeError are ValueErrors
+        err.append("File cannot be opened for reading.")
+        return dict(), dict(), err
+
+    # Only the selected PVs are ever decoded.
+    indices = {pvname: i for i, pvname in enumerate(file_names)}
+    if names is not None:
+        indices = {pvname: indices[pvname] for pvname in names
+                   if pvname in indices}
+    saved_pvs = _BinarySaveFileData(
+        indices, err, BlobStore(os.path.dirname(os.path.abspath(
+            save_file_path))), data, data_start, header)
+
+    if _MAPPED_ARRAY_MIN_BYTES is None:
+        saved_pvs.decode(list(indices))
+        saved_pvs.close()
+    if lazy:
+        return saved_pvs, meta_data, err
+    saved_pvs.decode(list(indices))
+    return saved_pvs.decoded(list(indices)), meta_data, err
+
+
+def _write_binary_save_file(pvs, save_file, metadata, blobs=None,
+                            blob_refs=None):
+    n = len(pvs)
+    names = list()
+    egu = list()
+    prec = list()
+    kinds = numpy.zeros(n, numpy.uint8)
+    floats = numpy.zeros(n, '<f8')
+    ints = numpy.zeros(n, '<i8')
+    json_values = dict()
+    arrays = dict()
+    array_data = list()
+    stored_blobs = dict()
+
+    layout = {'kinds': 0}
+    layout['floats'] = _align(n)
+    layout['ints'] = layout['floats'] + floats.nbytes
+    offset = _align(layout['ints'] + ints.nbytes)
+
+    for i, data in enumerate(pvs.values()):
+        names.append(data.get('raw_name'))
+        egu.append(data.get('egu'))
+        prec.append(data.get('prec'))
+        value = data.get('val')
+        if value is None:
+            kinds[i] = _KIND_NONE
+        elif isinstance(value, (float, numpy.floating)):
+            kinds[i] = _KIND_FLOAT
+            floats[i] = value
+        elif isinstance(value, (int, numpy.integer)) \
+                and not isinstance(value, bool) \
+                and -2**63 <= value < 2**63:
+            kinds[i] = _KIND_INT
+            ints[i] = value
+        elif blobs is not None and blobs.accepts(value):
+            kinds[i] = _KIND_BLOB
+            stored_blobs[str(i)] = blobs.store(value, blob_refs)
+        elif isinstance(value, numpy.ndarray) and value.ndim == 1 \
+                and value.dtype.kind in 'biufU':
+            value = numpy.ascontiguousarray(value)
+            kinds[i] = _KIND_ARRAY
+            arrays[str(i)] = [value.dtype.str, len(value), offset]
+            array_data.append((offset, value))
+            offset = _align(offset + value.nbytes)
+        else:
+            kinds[i] = _KIND_JSON
+            if isinstance(value, numpy.ndarray):
+                value = value.tolist()
+            json_values[str(i)] = value
+
+    header = json.dumps({'metadata': metadata, 'names': names, 'egu': egu,
+                         'prec': prec, 'layout': layout, 'arrays': arrays,
+                         'values': json_values,
+                         'blobs': stored_blobs}).encode('utf-8')
+    save_file.write(binary_save_file_magic)
+    save_file.write(len(header).to_bytes(8, 'little'))
+    save_file.write(header)
+    data_start = _align(save_file.tell())
+    _write_at(save_file, data_start + layout['kinds'], kinds)
+    _write_at(save_file, data_start + layout['floats'], floats)
+    _write_at(save_file, data_start + layout['ints'], ints)
+    for offset, value in array_data:
+        _write_at(save_file, data_start + offset, value)
+
+
+def _write_at(f, position, array):
+    # Data is written sequentially, so only padding is needed to reach the
+    # position.
+    f.write(bytes(position - f.tell()))
+    f.write(array.tobytes())
+
+
+def replace_save_file_metadata(save_file_path, metadata, compression=None):
+    """
+    Replace metadata of a save file of any format. The file is replaced with
+    a new one, so values of a binary file that are already mapped into memory
+    stay valid.
+
+    :param save_file_path: Path to save file.
+    :param metadata: Dict with new metadata.
+    :param compression: Compression of a compressed text file, as for
+                        parse_to_save_file(). If None, the file keeps its
+                        compression level. Uncompressed files stay
+                        uncompressed.
+
+    :return:
+    """
+    if is_binary_save_file(save_file_path):
+        _replace_binary_metadata(save_file_path, metadata)
+        return
+
+    compresslevel = _save_file_compresslevel(save_file_path, compression)
+    with _open_text_save_file(save_file_path) as save_file:
+        lines = save_file.readlines()
+    if lines and lines[0].startswith('#'):
+        lines[0] = "#" + json.dumps(metadata) + "\n"
     else:
-        # Check that the snapshot has machine parameters with metadata; at some
-        # point, only values were being saved.
-        for p, v in meta_data.get('machine_params', {}).items():
-            if not isinstance(v, dict):
-                meta_data['machine_params'][p] = {
-                    'value': v,
-                    'units': None,
-                    'precision': None
-                }
+        lines.insert(0, "#" + json.dumps(metadata) + "\n")
 
-    saved_file.close()
-    return saved_pvs, meta_data, err
+    _write_atomically(save_file_path, lambda f: f.writelines(lines),
+                      compresslevel=compresslevel)
+
+
+def _replace_binary_metadata(save_file_path, metadata):
+    with open(save_file_path, 'rb') as f:
+        header, data_start = _read_binary_header(f)
+        header['metadata'] = metadata
+        new_header = json.dumps(header).encode('utf-8')
+
+        def write(new_f):
+            new_f.write(binary_save_file_magic)
+            new_f.write(len(new_header).to_bytes(8, 'little'))
+            new_f.write(new_header)
+            new_f.write(bytes(_align(new_f.tell()) - new_f.tell()))
+            f.seek(data_start)
+            shutil.copyfileobj(f, new_f)
+
+        _write_atomically(save_file_path, write, binary=True)
 
 
 def parse_to_save_file(pvs, save_file_path, macros=None,
-                       symlink_path=None, **kw):
+                       symlink_path=None, save_format='text',
+                       compression=None, blob_store=None, **kw):
     """
     This function is called at each save of PV values. This is a parser
     which generates save file from pvs. All parameters in **kw are packed
@@ -505,6 +1497,13 @@ def parse_to_save_file(pvs, save_file_path, macros=None,
     :param save_file_path: Path of the saved file.
     :param macros: Macros
     :param symlink_path: Optional path to the symlink to be created.
+    :param save_format: 'text' for one JSON line per PV or 'binary' for the
+                        columnar binary format (see is_binary_save_file()).
+    :param compression: If not None, a text file is compressed. It is a dict
+                        {'codec': 'gzip', 'level': <0-9>}, the level is
+                        optional. Binary files are never compressed.
+    :param blob_store: If not None, a BlobStore in which large arrays are
+                       stored instead of in the file.
     :param kw: Additional meta data.
 
     :return:
@@ -514,105 +1513,256 @@ def parse_to_save_file(pvs, save_file_path, macros=None,
     # All parameters in **kw are packed as meta data
 
     save_file_path = os.path.abspath(save_file_path)
-    with open(save_file_path, 'w') as save_file:
-        # Save meta data
-        if macros:
-            kw['macros'] = macros
-        save_file.write("#" + json.dumps(kw) + "\n")
-
-        for pvname, data in pvs.items():
-            save_file.write(data.get('raw_name'))
-            value = data.get('val')
-            if value is not None:
-                save_file.write(',')
-                if isinstance(value, numpy.ndarray):
-                    data['val'] = value.tolist()
-                del data['raw_name']  # do not duplicate
-                json.dump(data, save_file)
-            save_file.write('\n')
-
-    # Create symlink _latest.snap
+    if save_format not in ('text', 'binary'):
+        raise ValueError(f"Unknown save file format '{save_format}'.")
+    # An overwritten file no longer references its blobs.
+    old_blob_refs = _save_file_blob_refs(save_file_path)
+    # Blobs referenced by the new file. The references are added while the
+    # file is written.
+    blob_refs = set()
+    try:
+        if save_format == 'binary':
+            if macros:
+                kw['macros'] = macros
+            _write_atomically(save_file_path,
+                              lambda f: _write_binary_save_file(
+                                  pvs, f, kw, blob_store, blob_refs),
+                              binary=True)
+        else:
+            _write_atomically(save_file_path,
+                              lambda f: _write_text_save_file(
+                                  pvs, f, macros, kw, blob_store, blob_refs),
+                              compresslevel=_compresslevel(compression))
+    except BaseException:
+        if blob_refs:
+            blob_store.release(blob_refs)
+        raise
+
+    if old_blob_refs:
+        BlobStore(os.path.dirname(save_file_path)).release(old_blob_refs)
+
+    _create_symlink(save_file_path, symlink_path)
+
+
+_blob_ref_regex = re.compile(r'"\$blob": "([0-9a-f]+)"')
+
+
+def _save_file_blob_refs(save_file_path):
+    # Returns the set of blobs referenced by the file.
+    if os.path.islink(save_file_path) or not os.path.isfile(save_file_path) \
+            or not BlobStore(os.path.dirname(save_file_path)).exists():
+        return set()
+    try:
+        if is_binary_save_file(save_file_path):
+            with open(save_file_path, 'rb') as f:
+                header = _read_binary_header(f)[0]
+            return set(header.get('blobs', {}).values())
+        with _open_text_save_file(save_file_path) as f:
+            return set(_blob_ref_regex.findall(f.read()))
+    except (OSError, EOFError, ValueError):
+        return set()
+
+
+def delete_save_file(save_file_path):
+    """
+    Delete a save file and release the blobs it references (see BlobStore).
+
+    :param save_file_path: Path to save file.
+
+    :return:
+    """
+    blob_refs = _save_file_blob_refs(save_file_path)
+    os.remove(save_file_path)
+    if blob_refs:
+        BlobStore(os.path.dirname(os.path.abspath(save_file_path))) \
+            .release(blob_refs)
+
+
+def _write_text_save_file(pvs, save_file, macros, kw, blobs=None,
+                          blob_refs=None):
+    # Produces the same bytes as writing each PV with json.dump(), but values
+    # are formatted directly, without intermediate lists and dicts.
+    # Save meta data
+    if macros:
+        kw['macros'] = macros
+    save_file.write("#" + json.dumps(kw) + "\n")
+
+    encode_str = json.encoder.encode_basestring_ascii
+    for data in pvs.values():
+        value = data.get('val')
+        if value is None:
+            save_file.write(data.get('raw_name') + '\n')
+            continue
+        if blobs is not None and blobs.accepts(value):
+            digest = blobs.store(value, blob_refs)
+            data = dict(data, val={'$blob': digest})
+        fields = ', '.join(encode_str(key) + ': ' + _encode_json_value(val)
+                           for key, val in data.items() if key != 'raw_name')
+        save_file.write(data.get('raw_name') + ',{' + fields + '}\n')
+
+
+def _encode_float(value):
+    # Same as the json module
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return 'Infinity'
+    elif value == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+def _encode_json_value(value):
+    if isinstance(value, numpy.ndarray):
+        # Formatting of the list by the C encoder is faster than any way of
+        # formatting the array in numpy, and produces the same text.
+        return json.dumps(value.tolist())
+    elif isinstance(value, (float, numpy.floating)):
+        return _encode_float(float(value))
+    elif isinstance(value, (int, numpy.integer)) \
+            and not isinstance(value, (bool, numpy.bool_)):
+        return int.__repr__(int(value))
+    elif isinstance(value, str):
+        return json.encoder.encode_basestring_ascii(value)
+    return json.dumps(value)
+
+
+def _create_symlink(save_file_path, symlink_path):
+    # Create symlink _latest.snap. A new link is created under a temporary
+    # name and renamed over the old one, so the link always exists.
     if symlink_path:
-        if os.path.isfile(symlink_path):
-            os.remove(symlink_path)
+        tmp_path = _temp_path(symlink_path)
+        try:
+            os.symlink(save_file_path, tmp_path)
+            os.replace(tmp_path, symlink_path)
+        except OSError:
+            logging.warning("unable to create link")
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
 
-        counter = 5
-        while counter > 0:
-            no_error = True
-            try:
-                os.symlink(save_file_path, symlink_path)
-            except:
-                logging.warning("unable to create link")
-                no_error = False
 
-            if no_error:
-                break
+def _temp_path(path):
+    # Temporary files do not have the save file suffix, so they are never
+    # listed as save files. The name is unique per thread, as several
+    # threads may write the same file (e.g. a save and a compaction).
+    return f"{path}.{os.getpid()}.{get_ident()}.tmp"
+
+
+def _compresslevel(compression):
+    if compression is None:
+        return None
+    return compression.get('level', 6)
 
-            time.sleep(0.5)
 
-            counter -= 1
+def _write_atomically(path, write, binary=False, compresslevel=None):
+    # The file is written under a temporary name and renamed when complete,
+    # so readers never see a partially written file.
+    tmp_path = _temp_path(path)
+    try:
+        if binary:
+            f = open(tmp_path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+        else:
+            f = _open_text_save_file(tmp_path, 'w', compresslevel)
+        with f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 def list_save_files(save_dir, req_file_path):
     "Returns a list of save files and a list of their modification times."
 
-    req_file_name = os.path.basename(req_file_path)
-    file_dir = os.path.join(save_dir, os.path.splitext(req_file_name)[0])
-    file_paths = [path for path in glob.glob(file_dir + '*' + save_file_suffix)
-                  if os.path.isfile(path)]
-    modif_times = [os.path.getmtime(path) for path in file_paths]
+    stats = _stat_save_files(save_dir, req_file_path)
+    file_paths = list(stats.keys())
+    modif_times = [stat.st_mtime for stat in stats.values()]
     return file_paths, modif_times
 
 
+def _stat_save_files(save_dir, req_file_path):
+    # Returns {path: os.stat_result} of save files of the request file.
+    req_file_name = os.path.basename(req_file_path)
+    prefix = os.path.splitext(req_file_name)[0]
+    stats = dict()
+    try:
+        entries = list(os.scandir(save_dir))
+    except OSError:
+        return stats
+    for entry in entries:
+        if entry.name.startswith(prefix) \
+                and entry.name.endswith(save_file_suffixes):
+            try:
+                if entry.is_file():
+                    stats[entry.path] = entry.stat()
+            except OSError:
+                # Removed in the meantime
+                pass
+    return stats
+
+
+def _parse_save_file_metadata(file_path):
+    _, meta_data, err = parse_from_save_file(file_path, metadata_only=True)
+    return meta_data, err
+
+
+def update_save_file_catalog(save_dir, req_file_path):
+    """
+    Update the catalog of save files (see SaveFileCatalog) of the request
+    file and return the metadata of all of them.
+
+    :return: Dict {file_path: (meta_data, err, modif_time)}
+    """
+    stats = _stat_save_files(save_dir, req_file_path)
+    prefix = os.path.splitext(os.path.basename(req_file_path))[0]
+    catalog = SaveFileCatalog(save_dir)
+    entries = catalog.sync({os.path.basename(path): stat
+                            for path, stat in stats.items()},
+                           _parse_save_file_metadata, prune_prefix=prefix)
+    return {path: entries[os.path.basename(path)] + (stat.st_mtime,)
+            for path, stat in stats.items()}
+
+
 def get_save_files(save_dir, req_file_path):
     """
-    Parses all new or modified files. Parsed files are returned as a
-    dictionary.
+    Returns metadata of all save files of the request file as a dictionary.
+    Only new or modified files are parsed, metadata of others comes from the
+    catalog.
     """
 
     since_start("Started parsing snaps")
-    file_paths, modif_times = list_save_files(save_dir, req_file_path)
+    entries = update_save_file_catalog(save_dir, req_file_path)
     req_file_name = os.path.basename(req_file_path)
 
-    def process_file(file_path, modif_time):
-        file_name = os.path.basename(file_path)
-        if os.path.isfile(file_path):
-            _, meta_data, err = parse_from_save_file(file_path,
-                                                     metadata_only=True)
-
-            # Check if we have req_file metadata. This is used to determine
-            # which request file the save file belongs to. If there is no
-            # metadata (or no req_file specified in the metadata) we search
-            # using a prefix of the request file. The latter is less
-            # robust, but is backwards compatible.
-            have_metadata = "req_file_name" in meta_data \
-                and meta_data["req_file_name"] == req_file_name
-            prefix_matches = \
-                file_name.startswith(req_file_name.split(".")[0] + "_")
-            if have_metadata or prefix_matches:
-                # we really should have basic meta data
-                # (or filters and some other stuff will silently fail)
-                if "comment" not in meta_data:
-                    meta_data["comment"] = ""
-                if "labels" not in meta_data:
-                    meta_data["labels"] = []
-                if "machine_params" not in meta_data:
-                    meta_data["machine_params"] = {}
-
-                return (file_name,
-                        {'file_name': file_name,
-                            'file_path': file_path,
-                            'meta_data': meta_data,
-                            'modif_time': modif_time},
-                        err)
-
-    results = global_thread_pool.map(process_file, file_paths, modif_times)
     err_to_report = list()
     parsed_save_files = dict()
-    for r in results:
-        if r is not None:
-            file_name, info, err = r
-            parsed_save_files[file_name] = info
+    for file_path, (meta_data, err, modif_time) in entries.items():
+        file_name = os.path.basename(file_path)
+
+        # Check if we have req_file metadata. This is used to determine
+        # which request file the save file belongs to. If there is no
+        # metadata (or no req_file specified in the metadata) we search
+        # using a prefix of the request file. The latter is less
+        # robust, but is backwards compatible.
+        have_metadata = "req_file_name" in meta_data \
+            and meta_data["req_file_name"] == req_file_name
+        prefix_matches = \
+            file_name.startswith(req_file_name.split(".")[0] + "_")
+        if have_metadata or prefix_matches:
+            # we really should have basic meta data
+            # (or filters and some other stuff will silently fail)
+            if "comment" not in meta_data:
+                meta_data["comment"] = ""
+            if "labels" not in meta_data:
+                meta_data["labels"] = []
+            if "machine_params" not in meta_data:
+                meta_data["machine_params"] = {}
+
+            parsed_save_files[file_name] = {'file_name': file_name,
+                                            'file_path': file_path,
+                                            'meta_data': meta_data,
+                                            'modif_time': modif_time}
             if err:
                 err_to_report.append((file_name, err))
 
@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+
+def default_cache_dir():
+    """
+    :return: Directory for cached data of this application, following the
+             XDG base directory specification.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'snapshot')
+
+
+class ReqFileCache(object):
+    # Version of the table layout and of the cached data. Must be increased
+    # whenever parsing of request files changes, so that stale results are
+    # discarded.
+    version = 4
+    # Names of connected PVs are forgotten if they were not connected for
+    # this many seconds, and the oldest are forgotten if there are more than
+    # connected_pvs_max_count of them.
+    connected_pvs_max_age = 30 * 24 * 3600
+    connected_pvs_max_count = 1 << 18
+
+    def __init__(self, cache_dir=None):
+        """
+        Persistent cache of parsed request files. An entry holds the PV list
+        and metadata of a top-level request file, and the path, modification
+        time and size of every file in its include tree. It is only valid
+        while none of these files changed. The cache also holds names of PVs
+        which were connected recently (see add_connected_pvs()). If the cache
+        cannot be used (e.g. the cache directory is not writable), it behaves
+        as if it was empty.
+
+        :param cache_dir: Directory of the cache database. If None,
+                          default_cache_dir() is used.
+
+        :return:
+        """
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.path = os.path.join(cache_dir, 'req_files.sqlite')
+
+    def get(self, req_file_path, macros, changeable_macros):
+        """
+        :param req_file_path: Absolute path of the top-level request file.
+        :param macros: Dict of macros the file is read with.
+        :param changeable_macros: List of macros which are not replaced.
+
+        :return: (pv_names, metadata) as SnapshotReqFile.read(), or None if
+                 there is no valid entry.
+        """
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    'SELECT files, pvs, metadata FROM req_files '
+                    'WHERE path = ? AND macros = ?',
+                    (req_file_path,
+                     self._macros_key(macros, changeable_macros))).fetchone()
+        except sqlite3.Error as e:
+            logging.debug(f"Cannot use request file cache {self.path}: {e}")
+            return None
+
+        if row is None:
+            return None
+        for path, mtime_ns, size in json.loads(row[0]):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            if stat.st_mtime_ns != mtime_ns or stat.st_size != size:
+                return None
+        return json.loads(row[1]), json.loads(row[2])
+
+    def put(self, req_file_path, macros, changeable_macros, files, pvs,
+            metadata):
+        """
+        Store the result of parsing a request file.
+
+        :param req_file_path: Absolute path of the top-level request file.
+        :param macros: Dict of macros the file was read with.
+        :param changeable_macros: List of macros which were not replaced.
+        :param files: List of (path, mtime_ns, size) of all files in the
+                      include tree, as they were before they were read.
+        :param pvs: List of PV names.
+        :param metadata: Dict with metadata.
+
+        :return:
+        """
+        try:
+            entry = (req_file_path,
+                     self._macros_key(macros, changeable_macros),
+                     json.dumps(files), json.dumps(pvs), json.dumps(metadata))
+        except (TypeError, ValueError):
+            # Not serializable, don't cache.
+            return
+        try:
+            with closing(self._connect()) as conn:
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO req_files VALUES '
+                                 '(?, ?, ?, ?, ?)', entry)
+        except sqlite3.Error as e:
+            logging.debug(f"Cannot use request file cache {self.path}: {e}")
+
+    def get_connected_pvs(self):
+        """
+        :return: Set of names of PVs which were connected within
+                 connected_pvs_max_age.
+        """
+        try:
+            with closing(self._connect()) as conn:
+                return {row[0] for row in conn.execute(
+                    'SELECT name FROM connected_pvs WHERE last_seen >= ?',
+                    (time.time() - self.connected_pvs_max_age,))}
+        except sqlite3.Error as e:
+            logging.debug(f"Cannot use request file cache {self.path}: {e}")
+            return set()
+
+    def add_connected_pvs(self, pv_names, seen=None):
+        """
+        Store names of PVs which were connected, so that their channels can
+        be created first the next time. Names which are too old or too many
+        (see connected_pvs_max_age) are removed.
+
+        :param pv_names: Iterable of PV names.
+        :param seen: Time (as time.time()) when they were connected. If None,
+                     the current time is used.
+
+        :return:
+        """
+        now = time.time()
+        seen = now if seen is None else seen
+        try:
+            with closing(self._connect()) as conn:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO connected_pvs '
+                                     'VALUES (?, ?)',
+                                     ((name, seen) for name in pv_names))
+                    conn.execute('DELETE FROM connected_pvs '
+                                 'WHERE last_seen < ?',
+                                 (now - self.connected_pvs_max_age,))
+                    conn.execute('DELETE FROM connected_pvs WHERE name IN '
+                                 '(SELECT name FROM connected_pvs '
+                                 'ORDER BY last_seen DESC LIMIT -1 OFFSET ?)',
+                                 (self.connected_pvs_max_count,))
+        except sqlite3.Error as e:
+            logging.debug(f"Cannot use request file cache {self.path}: {e}")
+
+    def clear(self):
+        """
+        Remove the cache.
+
+        :return: True if successful.
+        """
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return True
+        except OSError as e:
+            logging.warning(f"Cannot remove request file cache {self.path}: "
+                            f"{e}")
+            return False
+
+    @staticmethod
+    def _macros_key(macros, changeable_macros):
+        return json.dumps([sorted(macros.items()), sorted(changeable_macros)])
+
+    def _connect(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        except OSError as e:
+            raise sqlite3.OperationalError(str(e))
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.version:
+                with conn:
+                    conn.execute('DROP TABLE IF EXISTS req_files')
+                    conn.execute('DROP TABLE IF EXISTS connected_pvs')
+                    conn.execute('CREATE TABLE req_files ('
+                                 'path TEXT, macros TEXT, files TEXT, '
+                                 'pvs TEXT, metadata TEXT, '
+                                 'PRIMARY KEY (path, macros))')
+                    conn.execute('CREATE TABLE connected_pvs ('
+                                 'name TEXT PRIMARY KEY, last_seen REAL)')
+                    conn.execute(f'PRAGMA user_version = {self.version}')
+        except sqlite3.OperationalError:
+            conn.close()
+            raise
+        except sqlite3.DatabaseError:
+            conn.close()
+            # Damaged database file, start from scratch next time.
+            self.clear()
+            raise
+        return conn
@@ -27,22 +27,52 @@ def _support_old_args(args_replacements):
             sys.argv[idx + 1] = arg_replacement
 
 
+def _set_parse_processes(args):
+    from .parser import SnapshotReqFile
+    SnapshotReqFile.processes = args.parse_processes
+
+
+def _set_search_timeout(args):
+    from .ca_core import Snapshot
+    if args.search_timeout is not None:
+        Snapshot.search_timeout = args.search_timeout
+
+
 def save(args):
     from .cmd import save
-    save(args.FILE, args.out, args.macro, args.force, args.timeout, args.labels, args.comment)
+    _set_parse_processes(args)
+    _set_search_timeout(args)
+    save(args.FILE, args.out, args.macro, args.force, args.timeout, args.labels, args.comment, args.format,
+         args.delta_from)
 
 
 def restore(args):
     from .cmd import restore
-    restore(args.FILE, args.force, args.timeout)
+    _set_search_timeout(args)
+    pvs = args.pvs.split(',') if args.pvs is not None else None
+    restore(args.FILE, args.force, args.timeout, pvs, args.regex, args.dry_run, args.max_in_flight,
+            args.puts_per_second, args.verify)
+
+
+def index(args):
+    from .cmd import index
+    index(args.DIR, args.rebuild)
+
+
+def compact(args):
+    from .cmd import compact
+    compact(args.PATH)
 
 
 def gui(args):
     from .gui import start_gui
+    _set_parse_processes(args)
+    _set_search_timeout(args)
     start_gui(req_file_path=args.FILE, req_file_macros=args.macro,
               save_dir=args.dir, force=args.force, default_labels=args.labels,
               force_default_labels=args.force_labels, init_path=args.base,
-              config_path=args.config, trace_execution=args.trace_execution)
+              config_path=args.config, trace_execution=args.trace_execution,
+              pv_monitoring=args.monitor)
 
 
 def main():
@@ -77,6 +107,12 @@ def main():
     gui_pars.add_argument('--force_labels', help="force predefined labels", action='store_true')
     gui_pars.add_argument('--config', help="path to configuration file")
     gui_pars.add_argument('--trace-execution', help="print info during long-running tasks", action='store_true')
+    gui_pars.add_argument('--monitor', help="update PV values with CA monitors instead of periodic polling",
+                          action='store_true')
+    gui_pars.add_argument('--parse-processes', default=0, type=int, metavar='N',
+                          help="read included request files in N processes")
+    gui_pars.add_argument('--search-timeout', type=float, metavar='SECONDS',
+                          help="PVs not found in this time (default 0.1) slow down the creation of further channels")
 
     # Save
     save_pars = subparsers.add_parser('save', help='save current state of PVs to file without using GUI')
@@ -91,6 +127,14 @@ def main():
                             help="list of comma separated labels e.g.: \"label_1,label_2\"")
     save_pars.add_argument('--comment', default='', help="Comment")
     save_pars.add_argument('--timeout', default=10, type=int, help='max time waiting for PVs to be connected')
+    save_pars.add_argument('--format', choices=('text', 'binary'),
+                           help='format of the saved file (default: as configured in the request file, or text)')
+    save_pars.add_argument('--delta-from', metavar='REFERENCE',
+                           help='only save PVs which differ from the reference snapshot file')
+    save_pars.add_argument('--parse-processes', default=0, type=int, metavar='N',
+                           help="read included request files in N processes")
+    save_pars.add_argument('--search-timeout', type=float, metavar='SECONDS',
+                           help="PVs not found in this time (default 0.1) slow down the creation of further channels")
 
     # Restore
     rest_pars = subparsers.add_parser('restore', help='restore saved state of PVs from file without using GUI')
@@ -100,9 +144,33 @@ def main():
                            help="force restore in case of disconnected PVs after timeout", action='store_true')
     rest_pars.add_argument('--timeout', default=10, type=int,
                            help='max time waiting for PVs to be connected and restored')
+    rest_pars.add_argument('--pvs', help="restore only PVs from a comma separated list e.g.: \"PV1,PV2\"")
+    rest_pars.add_argument('--regex', help="restore only PVs which fully match a regular expression")
+    rest_pars.add_argument('--dry-run', help="only print what would be restored, do not write anything",
+                           action='store_true')
+    rest_pars.add_argument('--max-in-flight', type=int,
+                           help="max number of unfinished puts per IOC host")
+    rest_pars.add_argument('--puts-per-second', type=float,
+                           help="max number of puts per second per IOC host")
+    rest_pars.add_argument('--verify', help="read back restored PVs and report those which did not settle",
+                           action='store_true')
+    rest_pars.add_argument('--search-timeout', type=float, metavar='SECONDS',
+                           help="PVs not found in this time (default 0.1) slow down the creation of further channels")
+
+    # Index
+    index_pars = subparsers.add_parser('index', help='build or update the catalog of save files in a directory')
+    index_pars.set_defaults(func=index)
+    index_pars.add_argument('DIR', help='directory with save files')
+    index_pars.add_argument('--rebuild', help="discard the existing catalog and build it from scratch",
+                            action='store_true')
+
+    # Compact
+    compact_pars = subparsers.add_parser('compact', help='rewrite delta snapshot files as full snapshot files')
+    compact_pars.set_defaults(func=compact)
+    compact_pars.add_argument('PATH', nargs='+', help='delta snapshot file or directory with save files')
 
     # Following two functions modify sys.argv
-    _set_default_subparser('gui', ['gui', 'save', 'restore'])
+    _set_default_subparser('gui', ['gui', 'save', 'restore', 'index', 'compact'])
     # From version 1.3.1 handling of options have changed to be more consistent. However following function replaces
     # old style options with new style equivalents (backward compatibility).Old style options are no more shown in the
     # help, so users are encouraged to use new style.
@@ -118,11 +186,17 @@ usage: {}       {}
 -------- Command line save mode --------
 {}
 -------- Command line restore mode --------
+{}
+-------- Save file catalog --------
+{}
+-------- Delta snapshot compaction --------
 {}'''.format(
         re.sub('(?:\sgui|usage:\s)', '', gui_pars.format_usage()),
         re.sub('usage:\s', '', gui_pars.format_help()),
         save_pars.format_help(),
-        rest_pars.format_help()
+        rest_pars.format_help(),
+        index_pars.format_help(),
+        compact_pars.format_help()
     )
 
     args_pars.description = '''Tool for saving and restoring snapshots of EPICS process variables (PVs).
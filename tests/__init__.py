@@ -0,0 +1,5 @@
+from snapshot.parser import SnapshotReqFile
+
+# Tests must not use the cache of parsed request files in the home directory.
+# Tests of the cache give a ReqFileCache in a temporary directory explicitly.
+SnapshotReqFile.cache = None
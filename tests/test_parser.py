@@ -1,9 +1,26 @@
 import unittest
+from unittest import mock
 import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from threading import Thread
+
+import numpy
 
 logging.basicConfig(level=logging.DEBUG)
 
-from snapshot.parser import SnapshotReqFile
+from snapshot import parser
+from snapshot.req_cache import ReqFileCache
+from snapshot.blobs import BlobStore
+from snapshot.catalog import SaveFileCatalog
+from snapshot.core import MacroEngine
+from snapshot.parser import SnapshotReqFile, ReqParseError, \
+    ReqFileFormatError, ReqFileInfLoopError, SaveFileData, \
+    parse_from_save_file, parse_to_save_file, delete_save_file
 
 
 class TestSnapshotReqFile(unittest.TestCase):
@@ -28,3 +45,689 @@ class TestSnapshotReqFile(unittest.TestCase):
         print()
 
         logging.info(len(pvs))
+
+
+class TestReqFileParsing(unittest.TestCase):
+    """
+    Results and error messages of SnapshotReqFile.read() for corner cases
+    of the request file format.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = SnapshotReqFile.cache
+        SnapshotReqFile.cache = None
+
+    def tearDown(self):
+        SnapshotReqFile.cache = self.cache
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def read(self, name, on_batch=None, **kw):
+        return SnapshotReqFile(os.path.join(self.dir, name), **kw) \
+            .read(on_batch)
+
+    def test_lines(self):
+        self.write('a.req', '  pv:a  \n# comment\n\ndata{\npv:b, extra, x\n'
+                            '}\n\t pv:c ,x\r\npv:d\x0cpv:e')
+        pvs, metadata = self.read('a.req')
+        self.assertEqual(pvs, ['pv:a', 'pv:b', 'pv:c ', 'pv:d', 'pv:e'])
+        self.assertEqual(metadata, {'machine_params': {}})
+
+    def test_metadata(self):
+        self.write('a.req', '\n {"labels": {"labels": ["x"]},\n'
+                            ' "machine_params": [["b", "B"], ["a", "A"]]}'
+                            '  pv:a\npv:b\n')
+        pvs, metadata = self.read('a.req')
+        self.assertEqual(pvs, ['pv:a', 'pv:b'])
+        self.assertEqual(list(metadata['machine_params']), ['b', 'a'])
+
+    def test_metadata_only(self):
+        # The whole file is parsed again if there is nothing after metadata.
+        self.write('a.req', '{"a": 1}\n')
+        self.assertEqual(self.read('a.req')[0], ['{"a": 1}'])
+
+    def test_invalid_metadata(self):
+        path = self.write('a.req', '{"a": 1\npv:a\n')
+        with self.assertRaisesRegex(ReqParseError, 'Could not parse JSON') \
+                as e:
+            self.read('a.req')
+        self.assertEqual(str(e.exception),
+                         f"{path}: Could not parse JSON metadata header.")
+
+    def test_macros(self):
+        self.write('a.req', '$(A):pv\n$(A)$(B):pv\n$(G):pv\n!b.tpl, "X=$(A)"\n'
+                            "!b.tpl,'X=$(G)'\n!c.tpl\n")
+        self.write('b.tpl', '$(X):b\n$(X)$(X):c\n')
+        self.write('c.tpl', 'c\n')
+        pvs, _ = self.read('a.req', macros={'A': '1', 'B': '2'},
+                           changeable_macros=['G'])
+        self.assertEqual(pvs, ['1:pv', '12:pv', '$(G):pv', '1:b', '11:c',
+                               '$(G):b', '$(G)$(G):c', 'c'])
+
+    def test_undefined_macro(self):
+        path = self.write('a.req', 'pv:a\n$(A):pv, x\n$(B)$(C$(D):pv\n')
+        with self.assertRaises(ReqParseError) as e:
+            self.read('a.req', macros={'A': '1'})
+        self.assertEqual(
+            str(e.exception),
+            f"{path} [line 3: $(B)$(C$(D):pv]: Following macros were not "
+            "defined: $(B), $(C$(D)")
+
+    def test_undefined_macro_in_include(self):
+        path = self.write('a.req', 'pv\n!b.tpl, "X=1"\n')
+        path_b = self.write('b.tpl', '# c\n$(X)\n$(Y)\n')
+        with self.assertRaises(ReqParseError) as e:
+            self.read('a.req', changeable_macros=['Y'])
+        self.assertEqual(
+            str(e.exception),
+            f"{path} [line 2: !b.tpl, \"X=1\"] >> {path_b} [line 3: $(Y)]: "
+            "Following macros were not defined: $(Y)")
+
+    def test_first_error(self):
+        path = self.write('a.req', '$(A)\n!b.tpl, X=1\n')
+        with self.assertRaises(ReqParseError) as e:
+            self.read('a.req')
+        self.assertEqual(str(e.exception),
+                         f"{path} [line 1: $(A)]: Following macros were not "
+                         "defined: $(A)")
+
+    def test_include_syntax(self):
+        path = self.write('a.req', 'pv\n!b.tpl, X=1\n')
+        with self.assertRaises(ReqFileFormatError) as e:
+            self.read('a.req')
+        self.assertEqual(str(e.exception),
+                         f"{path} [line 2: !b.tpl, X=1]: Syntax error. Macro "
+                         "argument must be quoted")
+
+        self.write('a.req', '!b.tpl, "X=1\'\n')
+        with self.assertRaises(ReqFileFormatError):
+            self.read('a.req')
+
+        path = self.write('a.req', '!b.tpl, "X=1,Y"\n')
+        with self.assertRaises(ReqParseError) as e:
+            self.read('a.req')
+        self.assertEqual(str(e.exception),
+                         f"{path} [line 1: !b.tpl, \"X=1,Y\"]: Following "
+                         "string cannot be parsed to macros: X=1,Y")
+
+    def test_include_loop(self):
+        path = self.write('a.req', 'pv\n!b.tpl\n')
+        path_b = self.write('b.tpl', '!a.req\n')
+        with self.assertRaises(ReqFileInfLoopError) as e:
+            self.read('a.req')
+        self.assertEqual(
+            str(e.exception),
+            f"{path} [line 2: !b.tpl] >> {path_b} [line 1: !a.req]: Infinity "
+            f"loop detected. File {path} was already loaded as root request "
+            "file.")
+
+    def test_not_text(self):
+        path = os.path.join(self.dir, 'a.req')
+        with open(path, 'wb') as f:
+            f.write(b'\x1f\x8b\x08\x00\xff')
+        with self.assertRaises(ReqParseError) as e:
+            self.read('a.req')
+        self.assertEqual(str(e.exception), f"{path}: Not a text file.")
+
+    def test_missing_include(self):
+        self.write('a.req', 'pv\n!b.tpl\n')
+        with self.assertRaises(OSError):
+            self.read('a.req')
+
+    def test_metadata_in_include(self):
+        self.write('a.req', 'pv\n!b.tpl\n')
+        path_b = self.write('b.tpl', '{"a": 1}\npv:b\n')
+        with self.assertRaises(ReqParseError) as e:
+            self.read('a.req')
+        self.assertEqual(str(e.exception),
+                         f"Found metadata in included file {path_b}; "
+                         "metadata is only allowed in the top-level file.")
+
+    def test_include_order(self):
+        # Included files are read breadth first.
+        self.write('a.req', 'a1\n!b.tpl\na2\n!c.tpl\n')
+        self.write('b.tpl', 'b1\n!d.tpl\n')
+        self.write('c.tpl', 'c1\n')
+        self.write('d.tpl', 'd1\n')
+        self.assertEqual(self.read('a.req')[0],
+                         ['a1', 'a2', 'b1', 'c1', 'd1'])
+
+    def test_batches(self):
+        self.write('a.req', 'a1\n!b.tpl\na2\n!c.tpl\n')
+        self.write('b.tpl', 'b1\n!c.tpl\n')
+        self.write('c.tpl', 'c1\n')
+        batches = list()
+        pvs, _ = self.read('a.req', on_batch=batches.append)
+        self.assertEqual(batches, [['a1', 'a2'], ['b1', 'c1'], ['c1']])
+        self.assertEqual(pvs, ['a1', 'a2', 'b1', 'c1', 'c1'])
+
+    def test_templates(self):
+        # Files included many times with different macros, also on different
+        # levels, are read once per read(), but expanded with the macros of
+        # each include.
+        self.write('a.req', '!b.tpl, "X=1"\n!b.tpl, "X=2"\n!c.tpl, "Y=0"\n'
+                            '!b.tpl, "X=3"\n')
+        self.write('b.tpl', '$(X):b\n!c.tpl, "Y=$(X)"\n')
+        self.write('c.tpl', 'c:$(Y)\n')
+        opened = list()
+
+        class Template(parser._ReqFileTemplate):
+            def __init__(self, path):
+                opened.append(os.path.basename(path))
+                super().__init__(path)
+
+        with mock.patch.object(parser, '_ReqFileTemplate', Template):
+            pvs, _ = self.read('a.req')
+            self.assertEqual(pvs, ['1:b', '2:b', 'c:0', '3:b',
+                                   'c:1', 'c:2', 'c:3'])
+            self.assertEqual(sorted(opened), ['a.req', 'b.tpl', 'c.tpl'])
+
+            # Templates are not kept between reads.
+            self.write('c.tpl', 'c:$(Y):new\n')
+            self.assertEqual(self.read('a.req')[0][-1], 'c:3:new')
+            self.assertEqual(len(opened), 6)
+
+    def test_processes(self):
+        # Reading included files in processes gives the same PVs, batches
+        # and errors as reading them in one process. There are more includes
+        # on a level than chunks, so that the tree is split.
+        self.write('a.req', 'a\n' + ''.join(f'!f{i}.tpl, "N={i}"\n'
+                                            for i in range(20)))
+        self.write('g.tpl', 'g:$(M)\n')
+        for i in range(20):
+            self.write(f'f{i}.tpl', f'$(N):f\n!g.tpl, "M=$(N)"\n!h{i}.tpl, "K=$(N)"\n')
+            self.write(f'h{i}.tpl', 'h:$(K)\n' + '!g.tpl, "M=h$(K)"\n' * (i % 3))
+
+        def read(processes):
+            req_file = SnapshotReqFile(os.path.join(self.dir, 'a.req'))
+            req_file.processes = processes
+            batches = list()
+            try:
+                return req_file.read(batches.append), batches
+            except (ReqParseError, OSError) as e:
+                return repr(e), batches
+
+        serial = read(0)
+        self.assertEqual(len(serial[0][0]), 1 + 20 * 3 + 19)
+        self.assertEqual(read(2), serial)
+
+        # The first error in the order of reading the whole tree is raised.
+        self.write('h15.tpl', '$(X)\n')
+        self.write('h7.tpl', '!missing.tpl\n')
+        self.write('g.tpl', 'g:$(M)\n!h15.tpl\n')
+        serial = read(0)
+        self.assertIn('h15.tpl', serial[0])
+        self.assertEqual(read(2), serial)
+
+
+
+class TestMacroEngine(unittest.TestCase):
+
+    def test_substitute_many(self):
+        engine = MacroEngine({'A': 'a', 'B': 'b'})
+        txts = ['$(A):x', 'y:$(B)', '$(A):x', '$(C)']
+        self.assertEqual(engine.substitute_many(txts),
+                         ['a:x', 'y:b', 'a:x', '$(C)'])
+        self.assertEqual(engine.substitute_many(txts),
+                         [engine.substitute(txt) for txt in txts])
+
+    def test_newlines(self):
+        engine = MacroEngine({'A': 'a\nb'})
+        self.assertEqual(engine.substitute_many(['$(A)', 'x', '$(A)2']),
+                         ['a\nb', 'x', 'a\nb2'])
+        engine = MacroEngine({'A': 'a'})
+        self.assertEqual(engine.substitute_many(['$(A)\n', 'x']),
+                         ['a\n', 'x'])
+
+    def test_memo_bounded(self):
+        engine = MacroEngine({'A': 'a'})
+        engine.memo_size = 10
+        for i in range(5):
+            txts = ['$(A):{}:{}'.format(i, j) for j in range(7)]
+            self.assertEqual(engine.substitute_many(txts),
+                             ['a:{}:{}'.format(i, j) for j in range(7)])
+            self.assertLessEqual(len(engine._memo), 10)
+        for i in range(30):
+            self.assertEqual(engine.substitute('$(A){}'.format(i)),
+                             'a{}'.format(i))
+            self.assertLessEqual(len(engine._memo), 10)
+
+
+class TestReqFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ReqFileCache(os.path.join(self.dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def read(self, path, **kw):
+        return SnapshotReqFile(path, cache=self.cache, **kw).read()
+
+    def test_hit_and_miss(self):
+        path = self.write('a.req', '{"labels": {"labels": ["x"]}}\n$(A)\n'
+                                   '!b.tpl\n')
+        self.write('b.tpl', 'b\n')
+        self.assertIsNone(self.cache.get(path, {}, ['A']))
+
+        result = self.read(path, changeable_macros=['A'])
+        self.assertEqual(result[0], ['$(A)', 'b'])
+        self.assertEqual(self.cache.get(path, {}, ['A']), result)
+        self.assertEqual(self.read(path, changeable_macros=['A']), result)
+
+        # Entries are separate for different macros.
+        self.assertIsNone(self.cache.get(path, {'A': '1'}, []))
+        self.assertEqual(self.read(path, macros={'A': '1'})[0], ['1', 'b'])
+        self.assertEqual(self.cache.get(path, {}, ['A']), result)
+
+    def test_modified_file(self):
+        path = self.write('a.req', 'a\n')
+        self.assertEqual(self.read(path)[0], ['a'])
+        self.write('a.req', 'a\nb\n')
+        self.assertIsNone(self.cache.get(path, {}, []))
+        self.assertEqual(self.read(path)[0], ['a', 'b'])
+
+    def test_modified_include(self):
+        path = self.write('a.req', 'a\n!b.tpl\n')
+        self.write('b.tpl', '!c.tpl\n')
+        self.write('c.tpl', 'c\n')
+        self.assertEqual(self.read(path)[0], ['a', 'c'])
+        self.write('c.tpl', 'c1\nc2\n')
+        self.assertIsNone(self.cache.get(path, {}, []))
+        self.assertEqual(self.read(path)[0], ['a', 'c1', 'c2'])
+
+        os.remove(os.path.join(self.dir, 'c.tpl'))
+        self.assertIsNone(self.cache.get(path, {}, []))
+        with self.assertRaises(OSError):
+            self.read(path)
+
+    def test_damaged(self):
+        path = self.write('a.req', 'a\n')
+        self.read(path)
+        with open(self.cache.path, 'wb') as f:
+            f.write(b'not a database' * 100)
+        self.assertIsNone(self.cache.get(path, {}, []))
+        self.assertEqual(self.read(path)[0], ['a'])
+        self.assertEqual(self.cache.get(path, {}, []), (['a'], self.read(path)[1]))
+
+    def test_connected_pvs(self):
+        self.assertEqual(self.cache.get_connected_pvs(), set())
+        self.cache.add_connected_pvs(['a', 'b'])
+        self.cache.add_connected_pvs({'b', 'c'})
+        self.assertEqual(self.cache.get_connected_pvs(), {'a', 'b', 'c'})
+        self.assertEqual(ReqFileCache(os.path.dirname(self.cache.path))
+                         .get_connected_pvs(), {'a', 'b', 'c'})
+
+    def test_connected_pvs_bounded(self):
+        # Names which were not connected recently are forgotten, and so are
+        # the oldest if there are too many.
+        now = time.time()
+        self.cache.connected_pvs_max_count = 3
+        self.cache.add_connected_pvs(['a', 'b'], seen=now - 10)
+        self.cache.add_connected_pvs(
+            ['old'], seen=now - 2 * self.cache.connected_pvs_max_age)
+        self.assertEqual(self.cache.get_connected_pvs(), {'a', 'b'})
+        self.cache.add_connected_pvs(['c', 'd'])
+        self.assertEqual(len(self.cache.get_connected_pvs()), 3)
+        self.assertTrue({'c', 'd'} < self.cache.get_connected_pvs())
+        with closing(sqlite3.connect(self.cache.path)) as conn:
+            self.assertEqual(conn.execute(
+                'SELECT COUNT(*) FROM connected_pvs').fetchone()[0], 3)
+
+
+class TestSaveFiles(unittest.TestCase):
+    """
+    Writing and reading of save files in text and binary format.
+    """
+
+    values = {'float': 1.5, 'int': -3, 'str': 'a, "b"', 'none': None,
+              'list': [1, 2], 'floats': numpy.linspace(0, 1, 5),
+              'ints': numpy.arange(4, dtype=numpy.int16),
+              'strs': numpy.array(['a', 'bc'])}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, **kw):
+        path = os.path.join(self.dir, name)
+        pvs = {pvname: {'raw_name': pvname, 'val': value, 'egu': 'mm',
+                        'prec': 2}
+               for pvname, value in self.values.items()}
+        parse_to_save_file(pvs, path, comment='c', **kw)
+        return path
+
+    def assertValues(self, saved_pvs, names):
+        self.assertEqual(list(saved_pvs), names)
+        for pvname in names:
+            value = saved_pvs[pvname]['value']
+            expected = self.values[pvname]
+            if isinstance(expected, numpy.ndarray):
+                self.assertIsInstance(value, numpy.ndarray)
+                self.assertEqual(value.dtype.kind, expected.dtype.kind)
+                numpy.testing.assert_array_equal(value, expected)
+            elif isinstance(expected, list):
+                self.assertEqual(list(value), expected)
+            else:
+                self.assertEqual(value, expected)
+
+    def test_text_format(self):
+        # Text files are the same as written by earlier versions.
+        pvs = {'A': {'raw_name': '$(S):A', 'val': 1.5, 'egu': 'mm', 'prec': 3},
+               'B': {'raw_name': 'B', 'val': -2, 'egu': '', 'prec': None},
+               'C': {'raw_name': 'C', 'val': 'a "q", \u00e9\n', 'egu': '', 'prec': 0},
+               'D': {'raw_name': 'D', 'val': numpy.arange(3.), 'egu': 'V', 'prec': 2},
+               'E': {'raw_name': 'E', 'val': None},
+               'F': {'raw_name': 'F', 'val': [1, 2], 'egu': '', 'prec': 1},
+               'G': {'raw_name': 'G', 'val': float('nan'), 'egu': '', 'prec': 1},
+               'H': {'raw_name': 'H', 'val': numpy.array(['x', 'y']), 'egu': '', 'prec': 1},
+               'I': {'raw_name': 'I', 'val': True, 'egu': '', 'prec': 1},
+               'J': {'raw_name': 'J', 'val': numpy.float64(0.1), 'egu': '', 'prec': 1},
+               'K': {'raw_name': 'K', 'val': numpy.arange(4).reshape(2, 2), 'egu': '', 'prec': 0}}
+        path = os.path.join(self.dir, 'a.snap')
+        parse_to_save_file(pvs, path, macros={'S': 'X'}, save_time=1.0,
+                           labels={'labels': ['l']}, comment={'comment': 'c'})
+        with open(path, newline='') as f:
+            text = f.read()
+        self.assertEqual(text, (
+            '#{"save_time": 1.0, "labels": {"labels": ["l"]}, "comment": {"comment": "c"}, "macros": {"S": "X"}}\n'
+            '$(S):A,{"val": 1.5, "egu": "mm", "prec": 3}\n'
+            'B,{"val": -2, "egu": "", "prec": null}\n'
+            'C,{"val": "a \\"q\\", \\u00e9\\n", "egu": "", "prec": 0}\n'
+            'D,{"val": [0.0, 1.0, 2.0], "egu": "V", "prec": 2}\n'
+            'E\n'
+            'F,{"val": [1, 2], "egu": "", "prec": 1}\n'
+            'G,{"val": NaN, "egu": "", "prec": 1}\n'
+            'H,{"val": ["x", "y"], "egu": "", "prec": 1}\n'
+            'I,{"val": true, "egu": "", "prec": 1}\n'
+            'J,{"val": 0.1, "egu": "", "prec": 1}\n'
+            'K,{"val": [[0, 1], [2, 3]], "egu": "", "prec": 0}\n'))
+
+    def test_round_trip(self):
+        for save_format in ('text', 'binary'):
+            path = self.write(f'{save_format}.snap', save_format=save_format)
+            saved_pvs, meta_data, err = parse_from_save_file(path)
+            self.assertEqual(err, [])
+            self.assertEqual(meta_data['comment'], 'c')
+            self.assertValues(saved_pvs, list(self.values))
+
+    def test_replace_metadata_compression(self):
+        # Replacing metadata keeps the compression level of the file, unless
+        # another one is configured.
+        def level_flag(path):
+            with open(path, 'rb') as f:
+                return f.read(10)[8]
+
+        path = self.write('a.snap.gz', compression={'codec': 'gzip',
+                                                    'level': 1})
+        self.assertEqual(level_flag(path), 4)
+        parser.replace_save_file_metadata(path, {'comment': 'd'})
+        self.assertEqual(level_flag(path), 4)
+        parser.replace_save_file_metadata(path, {'comment': 'e'},
+                                          compression={'codec': 'gzip',
+                                                       'level': 9})
+        self.assertEqual(level_flag(path), 2)
+        saved_pvs, meta_data, err = parse_from_save_file(path)
+        self.assertEqual((meta_data, err), ({'comment': 'e'}, []))
+        self.assertValues(saved_pvs, list(self.values))
+
+        # Uncompressed files stay uncompressed.
+        path = self.write('b.snap')
+        parser.replace_save_file_metadata(path, {'comment': 'd'},
+                                          compression={'codec': 'gzip'})
+        self.assertFalse(parser.is_compressed_save_file(path))
+
+    def test_temp_path_per_thread(self):
+        # Threads writing the same file use different temporary files.
+        path = os.path.join(self.dir, 'a.snap')
+        paths = list()
+        thread = Thread(target=lambda: paths.append(parser._temp_path(path)))
+        thread.start()
+        thread.join()
+        self.assertNotEqual(paths[0], parser._temp_path(path))
+
+    def test_binary_arrays_not_mapped(self):
+        # Small arrays are copied, so the file can be replaced or deleted
+        # while they are in use.
+        path = self.write('a.snap', save_format='binary')
+        saved_pvs, _, _ = parse_from_save_file(path)
+        self.assertTrue(saved_pvs['floats']['value'].flags.owndata)
+        os.remove(path)
+        self.assertEqual(saved_pvs['floats']['value'][-1], 1.)
+
+    def test_binary_lazy(self):
+        # Arrays of binary files are only read when their PV is accessed,
+        # and never if the PV is not selected.
+        path = self.write('a.snap', save_format='binary')
+        array = parser._BinarySaveFileData._array
+        with mock.patch.object(parser._BinarySaveFileData, '_array',
+                               autospec=True, side_effect=array) as read:
+            saved_pvs, _, err = parse_from_save_file(path, lazy=True)
+            self.assertIsInstance(saved_pvs, SaveFileData)
+            self.assertEqual(list(saved_pvs), list(self.values))
+            self.assertEqual(read.call_count, 0)
+            self.assertValues(saved_pvs.decoded([]), [])
+            self.assertEqual(saved_pvs['float']['value'], 1.5)
+            self.assertEqual(read.call_count, 0)
+
+            saved_pvs.decode(['ints', 'int'])
+            self.assertValues(saved_pvs.decoded(['ints', 'int']),
+                              ['ints', 'int'])
+            self.assertEqual([c.args[1] for c in read.call_args_list],
+                             ['ints'])
+            self.assertTrue(saved_pvs['ints']['value'].flags.owndata)
+
+            read.reset_mock()
+            saved_pvs, _, err = parse_from_save_file(
+                path, names=['floats', 'str'])
+            self.assertValues(saved_pvs, ['floats', 'str'])
+            self.assertEqual([c.args[1] for c in read.call_args_list],
+                             ['floats'])
+        self.assertEqual(err, [])
+
+    def test_names(self):
+        names = ['strs', 'int', 'missing']
+        for save_format in ('text', 'binary'):
+            path = self.write(f'{save_format}.snap', save_format=save_format)
+            saved_pvs, _, err = parse_from_save_file(path, names=names)
+            self.assertEqual(err, [])
+            self.assertValues(saved_pvs, ['strs', 'int'])
+
+    def test_lazy(self):
+        path = self.write('a.snap')
+        with open(path, 'a') as f:
+            f.write('bad,[1,\n')
+        saved_pvs, _, err = parse_from_save_file(path, lazy=True)
+        self.assertIsInstance(saved_pvs, SaveFileData)
+        self.assertEqual(len(saved_pvs), len(self.values) + 1)
+        # Values are only decoded, and errors reported, when accessed.
+        self.assertEqual(err, [])
+        self.assertValues(saved_pvs.decoded([]), [])
+        saved_pvs.decode(['float', 'strs'])
+        self.assertValues(saved_pvs.decoded(['float', 'strs']),
+                          ['float', 'strs'])
+        self.assertEqual(err, [])
+        self.assertIsNone(saved_pvs['bad']['value'])
+        self.assertEqual(len(err), 1)
+
+
+    def test_bulk_decode(self):
+        # Decoding many values at once gives the same values and errors as
+        # decoding them one by one, also for values of the legacy format.
+        valid = {'a': '1.5', 'b': '-2', 'c': 'NaN', 'd': 'Infinity',
+                 'e': '-Infinity', 'f': '1e3'}
+        other = {'g': '1,2', 'h': '[1, 2]', 'i': '"x"', 'j': '{"val": 3}',
+                 'k': None, 'l': '01', 'm': '5abc', 'n': 'abc', 'o': 'Inf'}
+        for payloads in (valid, dict(valid, **other)):
+            bulk_err = list()
+            bulk = SaveFileData(dict(payloads), bulk_err)
+            bulk.decode(list(payloads)[1:])
+            self.assertNotIn('a', bulk._decoded)
+            err = list()
+            single = SaveFileData(dict(payloads), err)
+            for pvname in payloads:
+                numpy.testing.assert_equal(bulk[pvname], single[pvname])
+            self.assertEqual(sorted(bulk_err), sorted(err))
+        self.assertEqual(len(err), 5)
+
+    def test_delta_save_data(self):
+        # PVs whose values differ from the reference, also in the number of
+        # elements, are stored in a delta snapshot.
+        reference_pvs, meta_data, err = parse_from_save_file(
+            self.write('base.snap'))
+        pvs = {pvname: {'raw_name': pvname, 'val': value}
+               for pvname, value in self.values.items()
+               if pvname != 'none'}
+        pvs['float']['val'] = 1.6
+        pvs['floats']['val'] = numpy.linspace(0, 1, 10)
+        pvs['strs']['val'] = numpy.array(['a'])
+        delta_pvs, removed = parser.delta_save_data(pvs, reference_pvs,
+                                                    lambda data: 0.01)
+        self.assertEqual(sorted(delta_pvs), ['float', 'floats', 'strs'])
+        self.assertEqual(removed, ['none'])
+
+
+class TestSaveFileCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.catalog = SaveFileCatalog(self.dir)
+        self.parsed = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, comment, mtime=1e9):
+        path = os.path.join(self.dir, name)
+        parse_to_save_file({'A': {'raw_name': 'A', 'val': 1}}, path,
+                           comment=comment)
+        os.utime(path, (mtime, mtime))
+
+    def parse(self, path):
+        self.parsed.append(os.path.basename(path))
+        _, meta_data, err = parse_from_save_file(path, metadata_only=True)
+        return meta_data, err
+
+    def sync(self, **kw):
+        self.parsed = list()
+        files = {name: os.stat(os.path.join(self.dir, name))
+                 for name in os.listdir(self.dir) if name.endswith('.snap')}
+        result = self.catalog.sync(files, self.parse, **kw)
+        return {name: meta_data.get('comment')
+                for name, (meta_data, err) in result.items()}
+
+    def entries(self):
+        with closing(sqlite3.connect(self.catalog.path)) as conn:
+            return sorted(row[0] for row in
+                          conn.execute('SELECT name FROM files'))
+
+    def test_rescan(self):
+        self.write('a.snap', 'a')
+        self.write('b.snap', 'b')
+        self.assertEqual(self.sync(), {'a.snap': 'a', 'b.snap': 'b'})
+        self.assertEqual(sorted(self.parsed), ['a.snap', 'b.snap'])
+        self.assertEqual(self.sync(), {'a.snap': 'a', 'b.snap': 'b'})
+        self.assertEqual(self.parsed, [])
+
+        # Only changed files are parsed again, changes are detected by size
+        # and modification time.
+        self.write('a.snap', 'aa')
+        self.assertEqual(self.sync(), {'a.snap': 'aa', 'b.snap': 'b'})
+        self.assertEqual(self.parsed, ['a.snap'])
+        self.write('b.snap', 'c', mtime=2e9)
+        self.assertEqual(self.sync(), {'a.snap': 'aa', 'b.snap': 'c'})
+        self.assertEqual(self.parsed, ['b.snap'])
+
+    def test_prune(self):
+        self.write('x_a.snap', 'a')
+        self.write('y_b.snap', 'b')
+        self.sync()
+        os.remove(os.path.join(self.dir, 'x_a.snap'))
+        os.remove(os.path.join(self.dir, 'y_b.snap'))
+        self.assertEqual(self.sync(prune_prefix='x_'), {})
+        self.assertEqual(self.entries(), ['y_b.snap'])
+        self.sync()
+        self.assertEqual(self.entries(), [])
+
+    def test_unreadable(self):
+        # Files which cannot be read are not added, they are parsed again.
+        with open(os.path.join(self.dir, 'a.snap'), 'wb') as f:
+            f.write(b'\x1f\x8b not gzip')
+        for _ in range(2):
+            self.sync()
+            self.assertEqual(self.parsed, ['a.snap'])
+        self.assertEqual(self.entries(), [])
+
+    def test_damaged(self):
+        self.write('a.snap', 'a')
+        self.sync()
+        with open(self.catalog.path, 'wb') as f:
+            f.write(b'not a database' * 100)
+        self.assertEqual(self.sync(), {'a.snap': 'a'})
+        self.assertEqual(self.entries(), ['a.snap'])
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.blobs = BlobStore(self.dir, min_bytes=64)
+        self.value = numpy.arange(100.)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, save_format='text'):
+        path = os.path.join(self.dir, name)
+        pvs = {pvname: {'raw_name': pvname, 'val': self.value}
+               for pvname in ('A', 'B')}
+        parse_to_save_file(pvs, path, save_format=save_format,
+                           blob_store=self.blobs)
+        return path
+
+    def blob_files(self):
+        return [name for name in os.listdir(self.blobs.path)
+                if name.endswith('.npy')]
+
+    def test_refs(self):
+        a = self.write('a.snap')
+        b = self.write('b.snap', 'binary')
+        self.assertEqual(len(self.blob_files()), 1)
+        for path in (a, b):
+            saved_pvs, _, err = parse_from_save_file(path)
+            self.assertEqual(err, [])
+            numpy.testing.assert_array_equal(saved_pvs['B']['value'],
+                                             self.value)
+
+        # Each file references the blob once, although two PVs use it.
+        delete_save_file(a)
+        self.assertEqual(len(self.blob_files()), 1)
+        delete_save_file(b)
+        self.assertEqual(self.blob_files(), [])
+
+    def test_store_references(self):
+        # A blob which is being stored for a new file is referenced at once,
+        # so deleting the last other file which uses it keeps it.
+        a = self.write('a.snap')
+        refs = set()
+        digest = self.blobs.store(self.value, refs)
+        self.assertEqual(refs, {digest})
+        delete_save_file(a)
+        self.assertEqual(self.blob_files(), [digest + '.npy'])
+        self.blobs.release(refs)
+        self.assertEqual(self.blob_files(), [])
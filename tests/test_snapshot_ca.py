@@ -1,9 +1,25 @@
 import unittest
+from unittest import mock
 import logging
+import os
+import shutil
+import tempfile
+import time
+from threading import Event, Lock, Thread, Timer
+
+import numpy
 
 logging.basicConfig(level=logging.DEBUG)
 
-from snapshot.ca_core.snapshot_ca import Snapshot
+from snapshot.ca_core import snapshot_ca
+from snapshot.ca_core.snapshot_ca import Snapshot, ActionStatus, PutScheduler
+from snapshot import core
+from snapshot.core import background_workers, _BackgroundWorkers, PvUpdater, PvStatus, SnapshotPv, \
+    get_pvs_with_metadata
+from snapshot.cmd import snapshot_cmd
+from snapshot.cmd.snapshot_cmd import snapshot_for_restore
+from snapshot.parser import parse_from_save_file, parse_to_save_file, SaveFileData, ReqParseError, SnapshotReqFile
+from snapshot.req_cache import ReqFileCache
 
 
 class TestSnapshotReqFile(unittest.TestCase):
@@ -27,3 +43,854 @@ class TestSnapshotReqFile(unittest.TestCase):
 
         snapshot.clear_pvs()
         # logging.info(len(pvs))
+
+
+def _pvs_data(values):
+    # Data of PVs as passed to parse_to_save_file()
+    return {pvname: {'raw_name': pvname, 'val': value, 'egu': '', 'prec': 3}
+            for pvname, value in values.items()}
+
+
+class TestRestoreFromFile(unittest.TestCase):
+    """
+    PVs which are restored from save files by the command line tool.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_delta(self):
+        values = {f'PV{i}': float(i) for i in range(1, 6)}
+        base = os.path.join(self.dir, 'base.snap')
+        parse_to_save_file(_pvs_data(values), base)
+        delta = os.path.join(self.dir, 'delta.snap')
+        parse_to_save_file(_pvs_data({'PV1': 10.}), delta,
+                           delta_from='base.snap', delta_removed=['PV5'])
+
+        saved_pvs, meta_data, err = parse_from_save_file(delta)
+        self.assertEqual(err, [])
+        self.assertEqual(list(saved_pvs), ['PV1', 'PV2', 'PV3', 'PV4'])
+        self.assertEqual(saved_pvs['PV1']['value'], 10.)
+
+        snapshot, selected = snapshot_for_restore(saved_pvs, {})
+        try:
+            self.assertIsNone(selected)
+            self.assertEqual(list(snapshot.pvs), ['PV1', 'PV2', 'PV3', 'PV4'])
+        finally:
+            snapshot.clear_pvs()
+
+        snapshot, selected = snapshot_for_restore(saved_pvs, {}, ['PV2', 'PV5'])
+        try:
+            self.assertEqual(selected, {'PV2'})
+            self.assertEqual(list(snapshot.pvs), ['PV2'])
+        finally:
+            snapshot.clear_pvs()
+
+    def test_decode_selected(self):
+        # Only values of the selected PVs are decoded.
+        path = os.path.join(self.dir, 'a.snap')
+        parse_to_save_file(_pvs_data({f'PV{i}': [i, i] for i in range(10)}), path)
+        results = list()
+
+        def parse(*args, **kw):
+            results.append(parse_from_save_file(*args, **kw))
+            return results[-1]
+
+        with mock.patch.object(snapshot_cmd, 'parse_from_save_file', parse):
+            snapshot_cmd.restore(path, timeout=0, pvs=['PV3', 'PV5'], dry_run=True)
+        saved_pvs = results[0][0]
+        self.assertIsInstance(saved_pvs, SaveFileData)
+        self.assertEqual(set(saved_pvs._decoded), {'PV3', 'PV5'})
+
+    def test_compressed(self):
+        values = {'PV1': 1.5, 'PV2': 'text', 'PV3': [1, 2, 3]}
+        path = os.path.join(self.dir, 'a.snap.gz')
+        parse_to_save_file(_pvs_data(values), path,
+                           compression={'codec': 'gzip', 'level': 1})
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(2), b'\x1f\x8b')
+
+        saved_pvs, meta_data, err = parse_from_save_file(path)
+        self.assertEqual(err, [])
+        self.assertEqual(saved_pvs['PV1']['value'], 1.5)
+        self.assertEqual(saved_pvs['PV2']['value'], 'text')
+        self.assertEqual(list(saved_pvs['PV3']['value']), [1, 2, 3])
+
+        snapshot, _ = snapshot_for_restore(saved_pvs, {})
+        try:
+            self.assertEqual(list(snapshot.pvs), ['PV1', 'PV2', 'PV3'])
+        finally:
+            snapshot.clear_pvs()
+
+
+class TestRestoreSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = Snapshot()
+        self.snapshot.add_pvs(['TEST:A', 'TEST:B'])
+
+    def tearDown(self):
+        self.snapshot.clear_pvs()
+
+    def test_failed_restore(self):
+        # A restore which fails to start must not leave its session behind.
+        def fail(*args):
+            raise ValueError('cannot plan')
+
+        self.snapshot._plan_restore = fail
+        values = {'TEST:A': {'value': 1.}, 'TEST:B': {'value': 2.}}
+        with self.assertRaises(ValueError):
+            self.snapshot.restore_pvs(values, force=True)
+        self.assertEqual(self.snapshot._restore_sessions, set())
+        self.assertFalse(background_workers.is_suspended())
+
+        del self.snapshot._plan_restore
+        status, _ = self.snapshot.restore_pvs(values, force=True)
+        self.assertEqual(status, ActionStatus.ok)
+
+    def test_numeric_strings(self):
+        # Strings which pyepics can write to numeric PVs are not type errors.
+        self.assertTrue(all(Snapshot._is_numeric_str(v) for v in ('1.5', ' 2', '0x10', '-1e3')))
+        self.assertFalse(any(Snapshot._is_numeric_str(v) for v in ('', 'abc', '1,5')))
+
+
+class _CountingWorker(object):
+    def __init__(self):
+        self.suspended = False
+        self.changes = 0
+
+    def suspend(self):
+        self.suspended = True
+        self.changes += 1
+
+    def resume(self):
+        self.suspended = False
+        self.changes += 1
+
+
+class TestBackgroundWorkers(unittest.TestCase):
+
+    def test_concurrent(self):
+        # Restores suspend and resume workers from different threads.
+        workers = _BackgroundWorkers()
+        worker = _CountingWorker()
+        workers.register('worker', worker)
+        workers.suspend()
+
+        def suspend_resume():
+            for _ in range(1000):
+                workers.suspend()
+                workers.resume()
+
+        threads = [Thread(target=suspend_resume) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(workers.is_suspended())
+        self.assertEqual((worker.suspended, worker.changes), (True, 1))
+
+        workers.resume()
+        self.assertFalse(workers.is_suspended())
+        self.assertEqual((worker.suspended, worker.changes), (False, 2))
+
+
+class TestRestorePlan(unittest.TestCase):
+
+    def test_compare_many(self):
+        # Bulk comparison gives the same results as comparing each pair.
+        pairs = [(1.5, 1.5), (1.5, 1.5 + 1e-9), (1.5, 1.6), (float('nan'), 1.),
+                 # Arrays
+                 (numpy.arange(3.), numpy.arange(3.)), (numpy.arange(3.), numpy.arange(1., 4.)),
+                 (numpy.arange(3), numpy.arange(3) + 1), (numpy.arange(10.), numpy.arange(5.)),
+                 (numpy.array(['a', 'b']), numpy.array(['a', 'b'])), (numpy.array(['a', 'b']), numpy.array(['a'])),
+                 (numpy.array(['a', 'b']), numpy.array(['a', 'c'])), ([1, 2], numpy.array([1, 2])),
+                 # Enums, as index or as string
+                 (2, 2), (2, 3), (1, 1.), ('On', 'On'), ('On', 'Off'),
+                 # Strings
+                 ('text', 'text'), ('text', 'other'), ('', ''), ('1.5', 1.5),
+                 # Disconnected PVs have no current value.
+                 (1.5, None), (numpy.arange(3.), None), ('text', None), (None, None)]
+        values1 = [v1 for v1, v2 in pairs]
+        values2 = [v2 for v1, v2 in pairs]
+        for tolerance in (0., 1e-6, [0.2] * len(pairs)):
+            tolerances = numpy.broadcast_to(tolerance, (len(pairs),))
+            expected = [bool(SnapshotPv.compare(v1, v2, tol)) for (v1, v2), tol in zip(pairs, tolerances)]
+            self.assertEqual(SnapshotPv.compare_many(values1, values2, tolerance).tolist(), expected)
+        self.assertEqual(SnapshotPv.compare_many([], [], 0.).tolist(), [])
+
+
+class _PutLog(object):
+    # Records puts of _FakePutPv objects
+    def __init__(self):
+        self.lock = Lock()
+        self.started = list()  # [(time, pvname)]
+        self.finished = list()  # [(time, pvname)]
+        self.in_flight = dict()  # {host: number of puts}
+        self.max_in_flight = dict()  # {host: max number of puts}
+
+    def put_started(self, pv):
+        with self.lock:
+            self.started.append((time.monotonic(), pv.pvname))
+            self.in_flight[pv.chid] = self.in_flight.get(pv.chid, 0) + 1
+            self.max_in_flight[pv.chid] = max(self.max_in_flight.get(pv.chid, 0), self.in_flight[pv.chid])
+
+    def put_finished(self, pv):
+        with self.lock:
+            self.finished.append((time.monotonic(), pv.pvname))
+            self.in_flight[pv.chid] -= 1
+
+
+class _FakePutPv(object):
+    # Enough of SnapshotPv for PutScheduler. The chid is the name of the
+    # host. The put callback arrives after delay seconds, or never if delay
+    # is None. Writing 'bad' fails.
+    def __init__(self, pvname, log, host='ioc', delay=0.01):
+        self.pvname = pvname
+        self.chid = host
+        self.connected = True
+        self.read_access = True
+        self.write_access = True
+        self.value = None
+        self.log = log
+        self.delay = delay
+
+    def put(self, value, wait=False, callback=None, callback_data=None):
+        if isinstance(value, str) and value == 'bad':
+            raise TypeError('bad value')
+        self.log.put_started(self)
+        self.value = value
+        if self.delay is not None:
+            Timer(self.delay, self._put_done, (callback, callback_data)).start()
+
+    def _put_done(self, callback, callback_data):
+        self.log.put_finished(self)
+        callback(pvname=self.pvname, **callback_data)
+
+
+class _PutResults(object):
+    # Collects statuses of puts, as RestoreSession would.
+    def __init__(self, n):
+        self.status = dict()
+        self.done = Event()
+        self._lock = Lock()
+        self._n = n
+
+    def __call__(self, pvname, status, **kw):
+        with self._lock:
+            self.status[pvname] = status
+            if len(self.status) == self._n:
+                self.done.set()
+
+
+class _FakeCaTest(unittest.TestCase):
+    # Puts go to _FakePutPv objects instead of CA.
+
+    def setUp(self):
+        patcher = mock.patch.multiple(snapshot_ca.ca, host_name=lambda chid: chid, flush_io=lambda: None,
+                                      use_initial_context=lambda: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.log = _PutLog()
+
+    def pvs(self, n, host='ioc', prefix=None, **kw):
+        prefix = prefix or host
+        return [_FakePutPv(f'{prefix}:{i}', self.log, host, **kw) for i in range(n)]
+
+
+class TestPutScheduler(_FakeCaTest):
+
+    def put(self, scheduler, pvs, values=None):
+        results = _PutResults(len(pvs))
+        values = values or [1.] * len(pvs)
+        scheduler.put(list(zip(pvs, values)), results)
+        self.assertTrue(results.done.wait(10))
+        return results.status
+
+    def test_unlimited(self):
+        pvs = self.pvs(20)
+        status = self.put(PutScheduler(), pvs)
+        self.assertEqual(status, {pv.pvname: PvStatus.ok for pv in pvs})
+        self.assertEqual(self.log.max_in_flight, {'ioc': 20})
+
+    def test_in_flight(self):
+        # At most max_in_flight puts per host wait for their callbacks.
+        pvs = self.pvs(20, 'ioc1') + self.pvs(20, 'ioc2') + self.pvs(2, 'ioc3')
+        status = self.put(PutScheduler(max_in_flight=3), pvs)
+        self.assertEqual(status, {pv.pvname: PvStatus.ok for pv in pvs})
+        self.assertEqual(self.log.max_in_flight, {'ioc1': 3, 'ioc2': 3, 'ioc3': 2})
+        # Puts to each host are issued in order.
+        started = [pvname for t, pvname in self.log.started if pvname.startswith('ioc1:')]
+        self.assertEqual(started, [pv.pvname for pv in pvs[:20]])
+
+    def test_rate(self):
+        # Puts to one host are spaced by 1 / puts_per_second, independently
+        # of other hosts.
+        rate = 50.
+        pvs = self.pvs(10, 'ioc1') + self.pvs(10, 'ioc2')
+        start = time.monotonic()
+        self.put(PutScheduler(puts_per_second=rate), pvs)
+        elapsed = time.monotonic() - start
+        for host in ('ioc1', 'ioc2'):
+            times = [t for t, pvname in self.log.started if pvname.startswith(host + ':')]
+            self.assertEqual(len(times), 10)
+            for t1, t2 in zip(times, times[1:]):
+                self.assertGreater(t2 - t1, 1. / rate - 0.005)
+        self.assertLess(elapsed, 15 / rate)
+
+    def test_lost_callback(self):
+        # A put whose callback never arrives frees its slot after put_timeout.
+        lost = self.pvs(1, delay=None, prefix='lost')
+        pvs = self.pvs(3)
+        scheduler = PutScheduler(max_in_flight=1)
+        scheduler.put_timeout = 0.2
+        results = _PutResults(len(pvs))
+        start = time.monotonic()
+        scheduler.put(list(zip(lost + pvs, [1.] * 4)), results)
+        self.assertTrue(results.done.wait(10))
+        self.assertGreater(time.monotonic() - start, scheduler.put_timeout)
+        self.assertEqual(results.status, {pv.pvname: PvStatus.ok for pv in pvs})
+        self.assertEqual([pvname for t, pvname in self.log.started], ['lost:0', 'ioc:0', 'ioc:1', 'ioc:2'])
+
+    def test_type_error(self):
+        # A put which fails to start does not occupy a slot.
+        pvs = self.pvs(3)
+        status = self.put(PutScheduler(max_in_flight=1), pvs, [1., 'bad', 2.])
+        self.assertEqual(status, {'ioc:0': PvStatus.ok, 'ioc:1': PvStatus.type_err, 'ioc:2': PvStatus.ok})
+
+
+class TestRestoreStages(_FakeCaTest):
+
+    def setUp(self):
+        super().setUp()
+        self.snapshot = Snapshot()
+        self.snapshot.configure_restore({'stages': [['first', 'A:.*'], ['second', 'B:.*'], ['empty', 'E:.*']]})
+
+    def stages(self, pvs):
+        self.snapshot.pvs = {pv.pvname: pv for pv in pvs}
+        return self.snapshot._split_restore_stages({pv.pvname: 1. for pv in pvs})
+
+    def times(self, events, prefix):
+        return [t for t, pvname in events if pvname.startswith(prefix)]
+
+    def test_split(self):
+        # PVs which match no stage are restored last, empty stages are
+        # skipped.
+        stages = self.stages(self.pvs(2, 'C') + self.pvs(2, 'B') + self.pvs(2, 'A'))
+        self.assertEqual([(name, [pv.pvname for pv, value in puts]) for name, puts in stages],
+                         [('first', ['A:0', 'A:1']), ('second', ['B:0', 'B:1']), ('unstaged', ['C:0', 'C:1'])])
+        self.assertEqual(self.stages(self.pvs(2, 'C'))[0][0], 'unstaged')
+
+    def test_order(self):
+        # Puts of a stage start after all puts of the previous stage
+        # completed.
+        pvs = self.pvs(5, 'A', delay=0.05) + self.pvs(5, 'B') + self.pvs(5, 'C')
+        results = _PutResults(len(pvs))
+        PutScheduler(max_in_flight=2).put_stages(self.stages(pvs), results)
+        self.assertTrue(results.done.wait(10))
+        self.assertEqual(results.status, {pv.pvname: PvStatus.ok for pv in pvs})
+        for previous, stage in (('A:', 'B:'), ('B:', 'C:')):
+            self.assertLess(max(self.times(self.log.finished, previous)), min(self.times(self.log.started, stage)))
+
+    def test_timeout(self):
+        # A stage whose put callbacks do not arrive does not block the
+        # following stages forever.
+        pvs = self.pvs(1, 'A', delay=None) + self.pvs(1, 'A', prefix='A:ok', delay=0.01) + self.pvs(2, 'B')
+        scheduler = PutScheduler()
+        scheduler.put_timeout = 0.2
+        results = _PutResults(len(pvs) - 1)
+        scheduler.put_stages(self.stages(pvs), results)
+        self.assertTrue(results.done.wait(10))
+        self.assertNotIn('A:0', results.status)
+        start, = self.times(self.log.started, 'A:0')
+        self.assertGreater(min(self.times(self.log.started, 'B:')) - start, scheduler.put_timeout)
+
+
+class TestRestoreVerify(_FakeCaTest):
+    """
+    Restored PVs are read back until they reach the restored values. Reads
+    return the values in read_values of a PV, and then its current value.
+    """
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(snapshot_ca, 'get_pvs_with_metadata', self.read)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.snapshot = Snapshot()
+        self.snapshot.verify_schedule = (0., 0.01, 0.01)
+
+    @staticmethod
+    def read(pvs, timeout):
+        results = list()
+        for pv in pvs:
+            value = pv.read_values.pop(0) if pv.read_values else pv.value
+            results.append({'value': value, 'precision': 3})
+        return results
+
+    def restore(self, read_values):
+        pvs = self.pvs(len(read_values))
+        for pv, values in zip(pvs, read_values):
+            pv.value = 0.
+            pv.read_values = list(values)
+        self.snapshot.pvs = {pv.pvname: pv for pv in pvs}
+        return self.snapshot.restore_pvs_blocking({pv.pvname: {'value': 1.} for pv in pvs}, verify=True)
+
+    def test_settled(self):
+        # The first read is for planning the restore. ioc:0 is already equal.
+        status, pvs_status = self.restore([[1.], [0.], [0., 0.], [0., 0., 0., 1.0001]])
+        self.assertEqual(status, ActionStatus.ok)
+        self.assertEqual(pvs_status, {'ioc:0': PvStatus.equal, 'ioc:1': PvStatus.ok, 'ioc:2': PvStatus.ok,
+                                      'ioc:3': PvStatus.ok})
+
+    def test_not_settled(self):
+        status, pvs_status = self.restore([[0.], [0.] * 10, [0., 0., 0., 0.9]])
+        self.assertEqual(status, ActionStatus.ok)
+        self.assertEqual(pvs_status, {'ioc:0': PvStatus.ok, 'ioc:1': PvStatus.not_settled,
+                                      'ioc:2': PvStatus.not_settled})
+
+    def test_resized(self):
+        # Waveforms whose number of elements changed are restored and verified.
+        pvs = self.pvs(2)
+        pvs[0].value = numpy.arange(5.)
+        pvs[1].value = 1.
+        for pv in pvs:
+            pv.read_values = list()
+        self.snapshot.pvs = {pv.pvname: pv for pv in pvs}
+        status, pvs_status = self.snapshot.restore_pvs_blocking({'ioc:0': {'value': numpy.arange(10.)},
+                                                                 'ioc:1': {'value': 1.}}, verify=True)
+        self.assertEqual((status, pvs_status), (ActionStatus.ok, {'ioc:0': PvStatus.ok, 'ioc:1': PvStatus.equal}))
+        numpy.testing.assert_array_equal(pvs[0].value, numpy.arange(10.))
+
+    def test_resized_read(self):
+        # Read-back of a different length is not the restored value.
+        pvs = self.pvs(1)
+        pvs[0].value = numpy.arange(5.)
+        pvs[0].read_values = [numpy.arange(5.)] * (len(self.snapshot.verify_schedule) + 1)
+        self.snapshot.pvs = {pv.pvname: pv for pv in pvs}
+        status, pvs_status = self.snapshot.restore_pvs_blocking({'ioc:0': {'value': numpy.arange(10.)}}, verify=True)
+        self.assertEqual((status, pvs_status), (ActionStatus.ok, {'ioc:0': PvStatus.not_settled}))
+
+    def test_verify_error(self):
+        # A failed verification still completes the restore.
+        def fail(*args, **kw):
+            raise RuntimeError('cannot read')
+
+        self.snapshot._verify_restore = fail
+        status, pvs_status = self.restore([[0.]])
+        self.assertEqual((status, pvs_status), (ActionStatus.ok, {'ioc:0': PvStatus.ok}))
+        self.assertEqual(self.snapshot._restore_sessions, set())
+        self.assertFalse(background_workers.is_suspended())
+
+    def test_not_verified(self):
+        # Without verification, values are not read back.
+        self.snapshot.verify = False
+        pvs = self.pvs(1)
+        pvs[0].value = 0.
+        pvs[0].read_values = [0., 0.]
+        self.snapshot.pvs = {pv.pvname: pv for pv in pvs}
+        status, pvs_status = self.snapshot.restore_pvs_blocking({'ioc:0': {'value': 1.}})
+        self.assertEqual((status, pvs_status), (ActionStatus.ok, {'ioc:0': PvStatus.ok}))
+        self.assertEqual(pvs[0].read_values, [0.])
+
+
+class TestSubsetRestore(unittest.TestCase):
+    """
+    Only selected PVs of restore data are resolved and decoded.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_select(self):
+        pvs_raw = {'$(S):A': {'value': 1}, '$(S):B': {'value': 2}, 'C': {'value': 3}}
+        select = Snapshot._select_restore_data
+        self.assertEqual(select(pvs_raw, {'S': 'X'}, None),
+                         {'X:A': {'value': 1}, 'X:B': {'value': 2}, 'C': {'value': 3}})
+        # Selection is by names with macros replaced.
+        self.assertEqual(select(pvs_raw, {'S': 'X'}, ['X:B', 'C', 'D']),
+                         {'X:B': {'value': 2}, 'C': {'value': 3}})
+        self.assertEqual(select(pvs_raw, {'S': 'X'}, ['$(S):A']), {})
+        self.assertEqual(select(pvs_raw, {}, {'$(S):A'}), {'$(S):A': {'value': 1}})
+
+    def test_decode_selected(self):
+        path = os.path.join(self.dir, 'a.snap')
+        parse_to_save_file(_pvs_data({f'PV{i}': float(i) for i in range(10)}), path)
+        snapshot = Snapshot()
+        pvs = snapshot._prepare_restore_data(path, None, ['PV3', 'PV5'])
+        self.assertEqual(pvs, {'PV3': {'value': 3.}, 'PV5': {'value': 5.}})
+
+        saved_pvs, _, _ = parse_from_save_file(path, lazy=True)
+        self.assertIsInstance(saved_pvs, SaveFileData)
+        snapshot._select_restore_data(saved_pvs, {}, ['PV3', 'PV5'])
+        self.assertEqual(set(saved_pvs._decoded), {'PV3', 'PV5'})
+
+
+class TestConnectionState(unittest.TestCase):
+    """
+    Index of connected and disconnected PVs. Connections are simulated by
+    calling the connection callback, as the PVs do not exist.
+    """
+
+    def setUp(self):
+        self.snapshot = Snapshot()
+        self.snapshot.add_pvs(['TEST:A', 'TEST:B', 'TEST:C'])
+
+    def tearDown(self):
+        self.snapshot.clear_pvs()
+
+    def connect(self, pvname, conn=True):
+        self.snapshot._handle_pv_conn(pvname=pvname, conn=conn)
+
+    def test_index(self):
+        snapshot = self.snapshot
+        self.assertEqual(sorted(snapshot.get_disconnected_pvs_names()), ['TEST:A', 'TEST:B', 'TEST:C'])
+        self.assertEqual(snapshot.get_connected_pvs_count(), 0)
+
+        self.connect('TEST:A')
+        self.connect('TEST:B')
+        self.assertEqual(sorted(snapshot.get_disconnected_pvs_names()), ['TEST:C'])
+        self.assertEqual(snapshot.get_disconnected_pvs_names(['TEST:A', 'TEST:X']), [])
+        self.assertEqual(snapshot.get_disconnected_pvs_names({'TEST:C'}), ['TEST:C'])
+        self.assertEqual((snapshot.get_connected_pvs_count(), snapshot.get_disconnected_pvs_count()), (2, 1))
+
+        self.connect('TEST:B', False)
+        self.assertEqual(sorted(snapshot.get_disconnected_pvs_names()), ['TEST:B', 'TEST:C'])
+
+        # Callbacks of PVs which are not in the snapshot are ignored.
+        self.connect('TEST:X')
+        self.assertEqual(snapshot.get_connected_pvs_count(), 1)
+        snapshot.remove_pvs(['TEST:C'])
+        self.assertEqual(snapshot.get_disconnected_pvs_names(), ['TEST:B'])
+
+    def test_padded_names(self):
+        # Names are indexed as reported by pyepics, without whitespace.
+        snapshot = self.snapshot
+        snapshot.add_pvs(['TEST:D ', ' TEST:A'])
+        self.assertEqual(sorted(snapshot.pvs), ['TEST:A', 'TEST:B', 'TEST:C', 'TEST:D'])
+        for pvname in ('TEST:A', 'TEST:B', 'TEST:C', 'TEST:D'):
+            self.connect(pvname)
+        self.assertEqual(snapshot.get_disconnected_pvs_names(), [])
+        self.assertTrue(snapshot.wait_for_connection(0.01))
+        snapshot.clear_pvs()
+        self.assertEqual((snapshot._connected_pvs, snapshot._disconnected_pvs), (set(), set()))
+
+    def test_connected_hint(self):
+        # Names of connected PVs are stored in the cache at exit.
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ReqFileCache(cache_dir)
+            with mock.patch.object(SnapshotReqFile, 'cache', cache):
+                self.connect('TEST:A')
+                self.assertEqual(cache.get_connected_pvs(), set())
+                snapshot_ca._store_connected_pv_names()
+                self.assertIn('TEST:A', cache.get_connected_pvs())
+                self.assertEqual(snapshot_ca._new_connected_pv_names, set())
+
+    def test_wait_selected(self):
+        self.connect('TEST:A')
+        self.assertTrue(self.snapshot.wait_for_connection(0.01, selected=['TEST:A', 'TEST:X']))
+        self.assertFalse(self.snapshot.wait_for_connection(0.01, selected=['TEST:A', 'TEST:B']))
+        self.assertEqual(self.snapshot._conn_waiters, [])
+
+        timer = Timer(0.05, self.connect, ('TEST:B',))
+        timer.start()
+        try:
+            self.assertTrue(self.snapshot.wait_for_connection(5, selected=['TEST:A', 'TEST:B']))
+        finally:
+            timer.join()
+
+    def test_wait_all(self):
+        self.connect('TEST:A')
+        self.assertFalse(self.snapshot.wait_for_connection(0.01))
+
+        timers = [Timer(0.05, self.connect, ('TEST:B',)), Timer(0.05, self.snapshot.remove_pvs, (['TEST:C'],))]
+        for timer in timers:
+            timer.start()
+        try:
+            self.assertTrue(self.snapshot.wait_for_connection(5))
+        finally:
+            for timer in timers:
+                timer.join()
+
+
+class _PacedSnapshot(Snapshot):
+    search_window_min = 10
+    search_window_max = 20
+    search_timeout = 0.05
+
+
+class TestChannelPacing(unittest.TestCase):
+    """
+    PVs which do not exist never connect, so channels are created one window
+    (of search_window_min channels) per search_timeout.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.created = list()
+        # If not None, searches are answered after this delay by calling the
+        # connection callback.
+        self.answer_delay = None
+        self.timers = list()
+        create = snapshot_ca.SnapshotPv
+
+        def record(*args, **kw):
+            self.created.append(time.monotonic())
+            pv_ref = create(*args, **kw)
+            if self.answer_delay is not None:
+                timer = Timer(self.answer_delay, kw['connection_callback'],
+                              kwargs={'pvname': pv_ref.pvname, 'conn': True})
+                timer.start()
+                self.timers.append(timer)
+            return pv_ref
+
+        patcher = mock.patch.object(snapshot_ca, 'SnapshotPv', side_effect=record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for timer in self.timers:
+            timer.join()
+        shutil.rmtree(self.dir)
+
+    def assertPaced(self, n_pvs, elapsed):
+        window = _PacedSnapshot.search_window_min
+        self.assertEqual(len(self.created), n_pvs)
+        for t1, t2 in zip(self.created, self.created[window:]):
+            self.assertGreater(t2 - t1, _PacedSnapshot.search_timeout * 0.9)
+        # Each window waits at most search_timeout.
+        self.assertLess(elapsed, (n_pvs / window + 5) * _PacedSnapshot.search_timeout + 0.5)
+
+    def construct(self, n_pvs):
+        # Time to construct a snapshot of n_pvs PVs which do not exist
+        path = os.path.join(self.dir, f'{n_pvs}.req')
+        with open(path, 'w') as f:
+            f.writelines(f'SNAPSHOT:TEST:NONE:{i}\n' for i in range(n_pvs))
+        start = time.monotonic()
+        snapshot = _PacedSnapshot(path)
+        elapsed = time.monotonic() - start
+        try:
+            self.assertEqual(len(snapshot.pvs), n_pvs)
+            self.assertTrue(all(pv is not None for pv in snapshot.pvs.values()))
+            self.assertEqual(snapshot.get_disconnected_pvs_count(), n_pvs)
+        finally:
+            snapshot.clear_pvs()
+        return elapsed
+
+    def test_unreachable(self):
+        # Channels are paced also when the whole request file arrives at
+        # once, e.g. from the cache, and after it is parsed.
+        n_pvs = 100
+        self.assertPaced(n_pvs, self.construct(n_pvs))
+
+    def test_add_pvs(self):
+        snapshot = _PacedSnapshot()
+        try:
+            snapshot.add_pvs(['TEST:A', 'TEST:B', 'TEST:A'])
+            self.assertEqual(list(snapshot.pvs), ['TEST:A', 'TEST:B'])
+            self.assertEqual(set(snapshot.get_disconnected_pvs_names()), {'TEST:A', 'TEST:B'})
+            self.assertIsNone(snapshot._channel_feeder)
+
+            self.created.clear()
+            start = time.monotonic()
+            snapshot.add_pvs([f'SNAPSHOT:TEST:NONE:{i}' for i in range(50)])
+            self.assertPaced(50, time.monotonic() - start)
+        finally:
+            snapshot.clear_pvs()
+
+    def test_answered(self):
+        # Answered searches free the window right away, without waiting for
+        # the search timeout.
+        snapshot = _PacedSnapshot()
+        snapshot.search_timeout = 5.
+        self.answer_delay = 0.05
+        try:
+            start = time.monotonic()
+            snapshot.add_pvs([f'SNAPSHOT:TEST:NONE:{i}' for i in range(50)])
+            self.assertLess(time.monotonic() - start, snapshot.search_timeout)
+            self.assertEqual(len(self.created), 50)
+            for timer in self.timers:
+                timer.join()
+            self.assertEqual(snapshot.get_connected_pvs_count(), 50)
+        finally:
+            snapshot.clear_pvs()
+
+    def test_milestones(self):
+        # Connections are simulated by calling the connection callback.
+        snapshot = _PacedSnapshot()
+        try:
+            snapshot.add_pvs([f'TEST:{i}' for i in range(10)])
+            self.assertEqual(snapshot.connection_times, {})
+            for i in range(5):
+                snapshot._handle_pv_conn(pvname=f'TEST:{i}', conn=True)
+            self.assertEqual(list(snapshot.connection_times), [50])
+            for i in range(5, 10):
+                snapshot._handle_pv_conn(pvname=f'TEST:{i}', conn=True)
+            self.assertEqual(list(snapshot.connection_times), [50, 90, 100])
+            self.assertTrue(all(t >= 0 for t in snapshot.connection_times.values()))
+        finally:
+            snapshot.clear_pvs()
+
+
+class TestPreviousSnapshot(unittest.TestCase):
+    """
+    Channels are taken over from the snapshot which is replaced.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_reuse(self):
+        old = Snapshot(self.write('a.req', 'TEST:A\n$(P):B\nTEST:C\n'), {'P': 'TEST'})
+        old_pvs = dict(old.pvs)
+        # As if connected, the PV does not exist
+        old_pvs['TEST:C'].connected = True
+
+        new = Snapshot(self.write('b.req', '$(P):C\nTEST:B\nTEST:D\n'), 'P=TEST', previous=old)
+        try:
+            self.assertEqual(list(new.pvs), ['TEST:C', 'TEST:B', 'TEST:D'])
+            self.assertIs(new.pvs['TEST:B'], old_pvs['TEST:B'])
+            self.assertIs(new.pvs['TEST:C'], old_pvs['TEST:C'])
+            self.assertIsNot(new.pvs['TEST:D'], None)
+            for pv_ref in new.pvs.values():
+                self.assertEqual(list(pv_ref.conn_callbacks.values()), [new._handle_pv_conn])
+            # The connection state is taken over as well.
+            self.assertEqual(new.get_connected_pvs_count(), 1)
+            self.assertEqual(sorted(new.get_disconnected_pvs_names()), ['TEST:B', 'TEST:D'])
+
+            # The rest of the old snapshot is cleared.
+            self.assertEqual(old.pvs, {})
+            self.assertEqual(old.get_connected_pvs_count() + old.get_disconnected_pvs_count(), 0)
+            self.assertEqual(old_pvs['TEST:A'].conn_callbacks, {})
+        finally:
+            new.clear_pvs()
+
+    def test_failed(self):
+        # The old snapshot is cleared also if the new request file cannot be
+        # read.
+        old = Snapshot(self.write('a.req', 'TEST:A\nTEST:B\n'))
+        with self.assertRaises(ReqParseError):
+            Snapshot(self.write('b.req', 'TEST:A\n$(X)\n'), previous=old)
+        self.assertEqual(old.pvs, {})
+
+
+class _FakePv(object):
+    # Enough of SnapshotPv for PvUpdater in monitor mode
+    def __init__(self, pvname):
+        self.pvname = pvname
+        self.connected = False
+        self._initialized = False
+        self._last_value = None
+
+    @staticmethod
+    def _uniform_value(value):
+        return value
+
+
+class _FakeGetPv(_FakePv):
+    # Enough of SnapshotPv for get_pvs_with_metadata(). The chid is the name.
+    def __init__(self, pvname, connected=True, read_access=True):
+        super().__init__(pvname)
+        self.chid = pvname
+        self.connected = connected
+        self.read_access = read_access
+        self._args = dict()
+
+
+class TestPipelinedGet(unittest.TestCase):
+    """
+    get_pvs_with_metadata() with the CA requests replaced. PVs named 'slow'
+    do not respond in time, 'fail' fail.
+    """
+
+    def setUp(self):
+        self.requested = list()
+        self.timeouts = list()
+        patcher = mock.patch.multiple(core.ca, promote_type=lambda chid, use_ctrl: 'ctrl',
+                                      get_with_metadata=self.get, get_complete_with_metadata=self.complete,
+                                      flush_io=lambda: None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, chid, ftype, wait, as_numpy):
+        self.assertFalse(wait)
+        self.requested.append(chid)
+
+    def complete(self, chid, ftype, as_numpy, timeout):
+        self.timeouts.append(timeout)
+        if chid.startswith('slow'):
+            time.sleep(timeout)
+            return None
+        if chid.startswith('fail'):
+            raise core.ca.ChannelAccessGetFailure('get failed', chid, 0)
+        return {'value': float(len(chid)), 'units': 'mm', 'precision': 2}
+
+    def test_connected(self):
+        pvs = [_FakeGetPv('a'), _FakeGetPv('not_conn', connected=False), _FakeGetPv('no_access', read_access=False),
+               _FakeGetPv('fail'), _FakeGetPv('bb')]
+        results = get_pvs_with_metadata(pvs, timeout=1.)
+        # Requests are only issued for connected and readable PVs, all of
+        # them before the first completion.
+        self.assertEqual(self.requested, ['a', 'fail', 'bb'])
+        self.assertEqual(len(self.timeouts), 3)
+        self.assertEqual(results, [{'value': 1., 'units': 'mm', 'precision': 2}, None, None, None,
+                                   {'value': 2., 'units': 'mm', 'precision': 2}])
+        # Results are cached in the PVs.
+        self.assertEqual((pvs[0]._last_value, pvs[0]._initialized, pvs[0]._args),
+                         (1., True, {'units': 'mm', 'precision': 2}))
+        for pv in pvs[1:4]:
+            self.assertEqual((pv._last_value, pv._initialized, pv._args), (None, False, {}))
+
+    def test_timeout(self):
+        # The timeout is for all PVs together, so PVs after a slow one get
+        # what is left of it (but not nothing).
+        pvs = [_FakeGetPv('a'), _FakeGetPv('slow'), _FakeGetPv('bb')]
+        start = time.monotonic()
+        results = get_pvs_with_metadata(pvs, timeout=0.1)
+        self.assertLess(time.monotonic() - start, 1.)
+        self.assertEqual([md['value'] if md is not None else None for md in results], [1., None, 2.])
+        self.assertTrue(all(t <= 0.1 for t in self.timeouts))
+        self.assertEqual(self.timeouts[-1], 1e-3)
+        self.assertFalse(pvs[1]._initialized)
+
+
+class TestPvUpdaterMonitors(unittest.TestCase):
+
+    def test_replaced_pv(self):
+        # A PV replaced by a new object with the same name is subscribed
+        # again, and values for the old object are ignored.
+        updater = PvUpdater(use_monitors=True)
+        old = _FakePv('TEST:A')
+        updater.set_pvs([old])
+        updater._subscriptions[id(old)] = (old, None)
+
+        new = _FakePv('TEST:A')
+        updater.set_pvs([new])
+        self.assertEqual(updater._unsubscribed, [new])
+        with updater._lock:
+            updater._monitor_task()
+        self.assertEqual(updater._subscriptions, {})
+
+        updater._on_monitor(old, value=1.)
+        self.assertIsNone(old._last_value)
+        self.assertEqual(updater._changes, {})
+
+        updater._subscriptions[id(new)] = (new, None)
+        updater._on_monitor(new, value=2.)
+        self.assertEqual(new._last_value, 2.)
+        self.assertEqual(updater._changes, {'TEST:A': 2.})
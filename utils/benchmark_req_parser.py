@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Measure how fast request files are parsed. Synthetic request files are
+generated in a temporary directory: a flat file with one PV per line, and a
+file which includes a template many times with different macros. Both mix in
+comments, empty lines and names with macros, like generated request files.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from snapshot.parser import SnapshotReqFile
+
+
+def write_flat(path, n_lines):
+    with open(path, 'w') as f:
+        f.write('{"labels": {"labels": ["a", "b"]}}\n')
+        for i in range(n_lines):
+            if i % 50 == 0:
+                f.write('# Section {}\n\n'.format(i // 50))
+            elif i % 3 == 0:
+                f.write('$(SYS)-DEV{}:SET{}, extra\n'.format(i % 997, i))
+            else:
+                f.write('SYS-DEV{}:VAL{}\n'.format(i % 997, i))
+
+
+def write_templated(path, n_lines, template_lines=100):
+    tpl_path = os.path.join(os.path.dirname(path), 'device.tpl')
+    with open(tpl_path, 'w') as f:
+        for i in range(template_lines):
+            f.write('$(SYS)-$(DEV):PARAM{}\n'.format(i))
+    with open(path, 'w') as f:
+        for i in range(n_lines // template_lines):
+            f.write('!device.tpl, "DEV=DEV{},SYS=$(SYS)"\n'.format(i))
+
+
+def benchmark(path, macros, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pvs, _ = SnapshotReqFile(path, changeable_macros=list(macros)).read()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(pvs), best
+
+
+def main():
+    args_pars = argparse.ArgumentParser(description=__doc__)
+    args_pars.add_argument('--lines', type=int, default=200000, help='number of PVs in each request file')
+    args_pars.add_argument('--repeat', type=int, default=5, help='number of runs, the fastest one is reported')
+    args_pars.add_argument('--processes', type=int, default=0, help='number of processes which read included files')
+    args = args_pars.parse_args()
+
+    # Measure parsing, not the cache of parsed files.
+    SnapshotReqFile.cache = None
+    SnapshotReqFile.processes = args.processes
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        flat = os.path.join(tmp_dir, 'flat.req')
+        write_flat(flat, args.lines)
+        templated = os.path.join(tmp_dir, 'templated.req')
+        write_templated(templated, args.lines)
+
+        for name, path in (('flat', flat), ('templated', templated)):
+            n_pvs, elapsed = benchmark(path, {'SYS': 'SYS'}, args.repeat)
+            print('{:10} {:8d} PVs in {:.3f} s, {:.0f} lines/s'.format(name, n_pvs, elapsed, n_pvs / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()